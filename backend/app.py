@@ -1,50 +1,122 @@
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
 from db.db import db
-from pydub import AudioSegment
-import io
-import base64
 
 # Clear only the 'story_assignment' table from the metadata
-from db.db import db, init_db, Conversation, Message, SenderType, ChildAccount, StoryAssignment, StoryTheme
+from db.db import (
+    db, init_db, Conversation, Message, SenderType, ChildAccount, StoryAssignment, StoryTheme
+)
 from llm.llm import handler, meta_prompt_generator, new_story_generator, add_to_story
-from firebase_auth import firebase_auth_required
+from db.purge import start_purger
+from db.story_compression import decompress_content
+from db.search import index_message, search_stories
+from db.archive import conversation_messages, is_archived, restore_conversation
+from db.export import iter_conversations, iter_account_export, ndjson_lines
+from db.unit_of_work import init_unit_of_work, unit_of_work, commit_or_defer, after_commit
+from db.story_cache import generated_content_id
+from db.routing import read_only, router
+from db.queries import (
+    assigned_stories_query, assigned_stories_list_query, conversations_query, message_delta_query
+)
+from cache import (
+    SqliteCacheBackend, read_cache, conversation_key, conversation_messages_key,
+    conversations_namespace, assigned_namespace
+)
+from firebase_auth import firebase_auth_required, request_firebase_user
+from principal_cache import principal_cache, child_subject
+from audio_store import (
+    AudioUploadError, audio_cache, audio_job_status, read_upload, submit_audio, delete_audio, lookup_audio,
+    stored_name, send_audio
+)
+from audio_jobs import AudioJobRejected, audio_jobs
+
+from werkzeug.utils import secure_filename
+from narration import (
+    NARRATION_PRERENDER, NARRATION_VOICE, NARRATION_PREFIX, narration_path, schedule_narration, valid_voice
+)
+from responses import init_responses, etag_variants
 from child_auth import (
     save_child_account, verify_child_credentials, generate_child_token,
-    child_auth_required
+    child_auth_required, get_child_accounts_for_parent, invalidate_child_accounts
 )
 import os
 from dotenv import load_dotenv
 import random
 import ast
-import heapq
+import hashlib
+import hmac
 
 # Load environment variables
 load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '.env'))
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all routes
+init_responses(app)  # Compact JSON and gzip/brotli compression
+init_unit_of_work(app)  # Commit deferred analytics writes at the end of the request
 
 # Initialize the SQLAlchemy db instance
 init_db(app)
+# Share read-your-writes markers between workers through the read cache backend, or a
+# SQLite file of their own when the read cache is per process
+router.sticky_store = read_cache.backend if read_cache.backend.shared \
+    else SqliteCacheBackend(os.getenv("REPLICA_STICKY_PATH", "replica_sticky.sqlite3"))
+
+# Soft-deleted conversations and accounts are purged by `python -m db.purge`, run from
+# cron. PURGE_IN_PROCESS=1 purges on a thread of this process instead, for single-process
+# deployments; it would otherwise start in every worker.
+if os.getenv("PURGE_IN_PROCESS", "0") == "1":
+    start_purger(app)
 
 @app.route('/log_message', methods=['POST'])
-def log_message(conversation_id, sender_type, code, content):
+def log_message(conversation_id, sender_type, code, content, content_id=None):
     # Process the data as needed
     # For example, you can log it or save it to a database
 
     try:
         print(
             f"Logging message with conversation_id: {conversation_id}, sender_type: {sender_type}, code: {code}, content: {content}")
-        message = Message(
-            conversation_id=conversation_id,
-            sender_type=sender_type,
-            code=code,
-            content=content
-        )
-        db.session.add(message)
-        db.session.commit()
+        # continuing an archived story brings it back into the message table first
+        restore_conversation(conversation_id)
+        # a savepoint, so a failure here doesn't discard the rest of the request's unit of work
+        with db.session.begin_nested():
+            if content_id is not None:
+                # the body is kept once in the shared story_content store
+                message = Message(
+                    conversation_id=conversation_id,
+                    sender_type=sender_type,
+                    code=code,
+                    content='',
+                    content_id=content_id
+                )
+            else:
+                message = Message(
+                    conversation_id=conversation_id,
+                    sender_type=sender_type,
+                    code=code,
+                    content=content
+                )
+            db.session.add(message)
+            Conversation.query.filter_by(id=conversation_id).update(
+                {'version': Conversation.version + 1}, synchronize_session=False)
+            conversation = db.session.get(Conversation, conversation_id)
+            if conversation and sender_type == SenderType.MODEL:
+                # keep the search index in the same transaction as the story text
+                db.session.flush()  # assigns the message id postings point at
+                index_message(conversation_id, conversation.user_id, content, code, message.id)
+        commit_or_defer()
         print(f"Message logged: {message}")
+        user_id = conversation.user_id if conversation else None
+
+        def invalidate():
+            # the conversation's messages and its owner's list pages are now stale
+            read_cache.invalidate(conversation_key(conversation_id), conversation_messages_key(conversation_id))
+            if user_id:
+                read_cache.invalidate_namespace(conversations_namespace(user_id))
+                if sender_type == SenderType.MODEL and code == 2:
+                    # a first story can make an existing assignment visible to the child
+                    read_cache.invalidate_namespace(assigned_namespace(user_id))
+
+        after_commit(invalidate)
     except Exception as e:
         print(f"Error logging message: {e}")
     return jsonify({'status': 'success', 'message': 'Log message received'}), 200
@@ -52,7 +124,7 @@ def log_message(conversation_id, sender_type, code, content):
 
 @app.route('/fetch_conversations_by_user', methods=['POST'])
 def fetch_conversations_by_user(user_id):
-    conversations = Conversation.query.filter_by(user_id=user_id).all()
+    conversations = Conversation.query.filter_by(user_id=user_id, deleted_at=None).all()
     return conversations
 
 
@@ -60,10 +132,161 @@ def fetch_conversations_by_user(user_id):
 def fetch_messages_by_user_and_conversation(user_id, conversation_id):
     messages = Message.query.join(Conversation).filter(
         Conversation.user_id == user_id,
+        Conversation.deleted_at.is_(None),
         Message.conversation_id == conversation_id
     ).order_by(Message.created_at).all()
     return messages
 
+
+def get_conversation_state(conversation_id):
+    """
+    Return the owner and version of a conversation as a dict, or None if it doesn't exist
+    or was deleted (cached when the cache is shared by every worker, as ETags use it)
+    """
+    def load():
+        conversation = Conversation.query.filter_by(id=conversation_id, deleted_at=None).first()
+        if not conversation:
+            return None
+        return {'user_id': conversation.user_id, 'version': conversation.version}
+
+    return read_cache.get_or_load(conversation_key(conversation_id), load, shared_only=True)
+
+
+def conversations_version(user_id):
+    """
+    Fingerprint of a user's live conversations (count, newest id, total version), which
+    changes whenever a conversation is created, deleted or gets a new message (cached when
+    the cache is shared by every worker, as ETags use it)
+    """
+    def load():
+        row = db.session.query(
+            db.func.count(Conversation.id),
+            db.func.max(Conversation.id),
+            db.func.sum(Conversation.version)
+        ).filter(Conversation.user_id == user_id, Conversation.deleted_at.is_(None)).one()
+        return [int(value or 0) for value in row]
+
+    return read_cache.get_or_load("version", load, conversations_namespace(user_id), shared_only=True)
+
+
+def assigned_version(username, parent_uid):
+    """
+    Fingerprint of a child's visible assignments (count, newest id). Previews come from the
+    first story message, which doesn't change once written, so messages aren't included
+    (cached when the cache is shared by every worker, as ETags use it)
+    """
+    def load():
+        row = assigned_stories_query(
+            username, db.func.count(StoryAssignment.id), db.func.max(StoryAssignment.id)).one()
+        return [int(value or 0) for value in row]
+
+    return read_cache.get_or_load(f"{username}:version", load, assigned_namespace(parent_uid), shared_only=True)
+
+
+def etag_response(version, build_payload):
+    """
+    Answer a GET with 304 Not Modified when the client's If-None-Match matches the ETag
+    derived from version and the request URL; otherwise build and send the JSON payload
+    """
+    etag = hashlib.sha1(repr((request.full_path, version)).encode()).hexdigest()
+    if any(request.if_none_match.contains(variant) for variant in etag_variants(etag)):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(build_payload())
+    response.set_etag(etag)
+    # clients may keep the response but must revalidate it before reuse
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def serialize_message(message):
+    return {
+        'id': message.id,
+        'sender_type': message.sender_type.name,
+        'content': message.content,
+        'created_at': message.created_at.isoformat(),
+        'code': message.code
+    }
+
+
+def get_message_list(conversation_id):
+    """
+    Return the serialized messages of a conversation in creation order (cached)
+    """
+    def load():
+        return [serialize_message(message) for message in conversation_messages(conversation_id)]
+
+    return read_cache.get_or_load(conversation_messages_key(conversation_id), load)
+
+
+def get_message_delta(conversation_id, since_message_id):
+    """
+    Return the serialized messages of a conversation newer than since_message_id,
+    read with one range scan over the (conversation_id, id) index
+    """
+    if is_archived(conversation_id):
+        return [message for message in get_message_list(conversation_id) if message['id'] > since_message_id]
+    messages = message_delta_query(conversation_id, since_message_id).all()
+    return [serialize_message(message) for message in messages]
+
+
+def conversation_messages_response(conversation_id, user_id, since_message_id=None):
+    """
+    Response for the conversation message endpoints: the full history, or only the
+    messages after since_message_id. Messages are never deleted one by one, only with
+    their conversation, so a delta for a live conversation carries no tombstones; once
+    the conversation is deleted (Conversation.deleted_at is set) the delta says so and
+    lists the ids of every message the client can hold, for it to drop.
+    """
+    conversation = get_conversation_state(conversation_id)
+    if conversation and conversation['user_id'] == user_id:
+        if since_message_id is None:
+            return etag_response(
+                conversation['version'],
+                lambda: {"messages": get_message_list(conversation_id)})
+        return etag_response(
+            conversation['version'],
+            lambda: {
+                "messages": get_message_delta(conversation_id, since_message_id),
+                "conversation_deleted": False
+            })
+
+    if since_message_id is not None:
+        # a soft-deleted conversation still waiting for the purger: tombstone
+        # everything the client can hold so it drops its local copy
+        deleted = Conversation.query.filter(
+            Conversation.id == conversation_id,
+            Conversation.user_id == user_id,
+            Conversation.deleted_at.isnot(None)
+        ).first()
+        if deleted:
+            if is_archived(conversation_id):
+                deleted_ids = sorted(
+                    message.id for message in conversation_messages(conversation_id)
+                    if message.id <= since_message_id)
+            else:
+                deleted_ids = db.session.scalars(db.select(Message.id).where(
+                    Message.conversation_id == conversation_id,
+                    Message.id <= since_message_id
+                ).order_by(Message.id)).all()
+            return jsonify({
+                "messages": [],
+                "deleted_message_ids": deleted_ids,
+                "conversation_deleted": True
+            })
+    return jsonify({"error": "Conversation not found or access denied"}), 404
+
+
+def invalidate_conversation_reads(conversation_ids, user_id):
+    """
+    Drop every cached read that can include the given conversations of a user
+    """
+    keys = []
+    for conversation_id in conversation_ids:
+        keys += [conversation_key(conversation_id), conversation_messages_key(conversation_id)]
+    read_cache.invalidate(*keys)
+    read_cache.invalidate_namespace(conversations_namespace(user_id), assigned_namespace(user_id))
+
 @app.route('/generate_meta_prompt', methods=['POST'])
 def generate_meta_prompt():
     data = request.get_json()
@@ -78,9 +301,38 @@ def generate_meta_prompt():
     else:
         return jsonify({"error": "User input is required"}), 400
 
+def story_reader():
+    """
+    The account a generated story is for: the child for child tokens, otherwise the parent.
+    The story cache uses it to avoid serving someone the same story twice.
+    """
+    child_user = getattr(request, 'child_user', None)
+    if child_user:
+        return f"child:{child_user.get('username')}"
+    firebase_user = getattr(request, 'firebase_user', None)
+    return firebase_user.get('localId') if firebase_user else None
+
+
+def log_story(conversation_id, code, response):
+    # the model's reply is written in its own unit of work once the LLM call has returned,
+    # together with the analytics rows and cache updates the generation deferred; the
+    # user's message was committed before the call, so a crash doesn't lose it
+    with unit_of_work():
+        content_id = None
+        if code == 2:
+            # new stories can repeat through the generation cache; keep each body once
+            try:
+                with db.session.begin_nested():
+                    content_id = generated_content_id(response)
+            except Exception as e:
+                content_id = None
+                print(f"Error writing the story cache: {e}")
+        log_message(conversation_id, SenderType.MODEL, code, response, content_id)
+
+
 def generate_new_story(query):
     try:
-        story = new_story_generator(query)
+        story = new_story_generator(query, story_reader())
     except ValueError:
         return jsonify({"message": "Invalid response from new_story_generator"})
     return story
@@ -116,18 +368,22 @@ def handle_request():
             code = 3 # set the code to 3 to add to the existing story
 
         if conversation_id:
-            conversation = Conversation.query.get(conversation_id)
+            conversation = Conversation.query.filter_by(
+                id=conversation_id, deleted_at=None).first()
             if not conversation:
                 return jsonify({"message": "Invalid conversation ID"})
-        else:
-            conversation = Conversation(user_id=user_id)
-            db.session.add(conversation)
-            db.session.commit()
-            conversation_id = conversation.id
 
-        print(
-            f"Calling log_message with conversation_id: {conversation.id}, sender_type: {SenderType.USER}, code: {code}, query: {query}")
-        log_message(conversation.id, SenderType.USER, code, query)
+        # the conversation and the user's message are committed together, before the LLM call
+        with unit_of_work():
+            if not conversation_id:
+                conversation = Conversation(user_id=user_id)
+                db.session.add(conversation)
+                db.session.flush()
+                conversation_id = conversation.id
+
+            print(
+                f"Calling log_message with conversation_id: {conversation.id}, sender_type: {SenderType.USER}, code: {code}, query: {query}")
+            log_message(conversation.id, SenderType.USER, code, query)
         ### the following is never reached if the code is 2 and is handled in CONFIRM_NEW_STORY_ROUTE ###
         if code == 0:  # If the user asks for something unrelated to telling a story
             response = "Sorry, I can only tell stories. Please ask me to tell you a story."
@@ -140,10 +396,10 @@ def handle_request():
                 story = story_data.get("story", "")
                 # Format the response with title and story
                 response = f"TITLE: {title}\n\n STORY, PART #1: {story}"
-                log_message(conversation.id, SenderType.MODEL, code, response)
+                log_story(conversation.id, code, response)
             else:
                 response = story_data.replace('STORY:', 'STORY, PART #1:')
-                log_message(conversation.id, SenderType.MODEL, code, response)
+                log_story(conversation.id, code, response)
         elif code == 3:  # If the user asks for an addition to an existing story
             story_data = add_to_existing_story(conversation.id, query)
             if isinstance(story_data, dict):
@@ -152,11 +408,11 @@ def handle_request():
                 part = story_data.get("part", 1)
                 # Format the response with title and story
                 response = f"TITLE: {title}\n\n STORY, PART #{part}: {story}"
-                log_message(conversation.id, SenderType.MODEL, code, response)
+                log_story(conversation.id, code, response)
             else:
                 print('continued story data:', story_data)
                 response = story_data
-                log_message(conversation.id, SenderType.MODEL, code, response)
+                log_story(conversation.id, code, response)
         else:
             response = f"Invalid code: {code}"
 
@@ -177,11 +433,13 @@ def confirm_new_story_route():
 
     if query and confirmation:
         if confirmation.lower() == 'y':
-            conversation = Conversation(user_id=user_id)
-            db.session.add(conversation)
-            db.session.commit()
-            # logging the user message
-            log_message(conversation.id, SenderType.USER, 2, query)
+            # the conversation and the user's message are committed together, before the LLM call
+            with unit_of_work():
+                conversation = Conversation(user_id=user_id)
+                db.session.add(conversation)
+                db.session.flush()
+                # logging the user message
+                log_message(conversation.id, SenderType.USER, 2, query)
 
             story_data = generate_new_story(query)
             if isinstance(story_data, dict):
@@ -189,10 +447,10 @@ def confirm_new_story_route():
                 story = story_data.get("story", "")
                 # Format the response with title and story
                 response = f"TITLE: {title}\n\n STORY, PART #1: {story}"
-                log_message(conversation.id, SenderType.MODEL, 2, response)
+                log_story(conversation.id, 2, response)
             else:
                 response = story_data.replace('STORY:', 'STORY, PART #1:')
-                log_message(conversation.id, SenderType.MODEL, 2, response)
+                log_story(conversation.id, 2, response)
 
             return jsonify({"message": "New story initiated.", "response": response, "conversation_id": conversation.id})
         elif confirmation.lower() == 'n':
@@ -216,29 +474,101 @@ def delete_conversation():
     try:
         # Verify the conversation belongs to the user
         conversation = Conversation.query.filter_by(
-            id=conversation_id, user_id=user_id).first()
+            id=conversation_id, user_id=user_id, deleted_at=None).first()
         if not conversation:
             return jsonify({"error": "Conversation not found or access denied"}), 404
 
-        # Delete any story assignments associated with this conversation
-        StoryAssignment.query.filter_by(
-            conversation_id=conversation_id).delete()
+        # Soft-delete: the conversation disappears from every read path now and
+        # its assignments and messages are removed later by the background purger
+        conversation.deleted_at = db.func.current_timestamp()
+        db.session.commit()
+        invalidate_conversation_reads([conversation.id], user_id)
+
+        return jsonify({"message": "Conversation deleted successfully"})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({"error": str(e)}), 500
 
-        # Delete all messages associated with this conversation
-        Message.query.filter_by(conversation_id=conversation_id).delete()
 
-        # Delete the conversation
-        db.session.delete(conversation)
+@app.route('/delete_account_data', methods=['DELETE'])
+@firebase_auth_required
+def delete_account_data():
+    # Use Firebase user ID from the token
+    user_id = request.firebase_user.get('localId', 'user_id_placeholder')
+
+    try:
+        # Soft-delete every conversation and child account of the user in two set-based
+        # statements; the purger removes the rows in batches later
+        deleted_at = db.session.scalar(db.select(db.func.current_timestamp()))
+        conversation_count = Conversation.query.filter_by(user_id=user_id, deleted_at=None) \
+            .update({'deleted_at': deleted_at}, synchronize_session=False)
+        child_usernames = db.session.scalars(db.select(ChildAccount.username).where(
+            ChildAccount.parent_uid == user_id, ChildAccount.deleted_at.is_(None))).all()
+        child_count = ChildAccount.query.filter_by(parent_uid=user_id, deleted_at=None) \
+            .update({'deleted_at': deleted_at}, synchronize_session=False)
         db.session.commit()
+        invalidate_child_accounts(user_id)
+        # signed-in children of the deleted account lose access right away
+        for username in child_usernames:
+            principal_cache.revoke_subject(child_subject(username))
+        # the conversations just deleted are read back in chunks to drop their cached reads
+        deleted_ids = db.session.scalars(db.select(Conversation.id).where(
+            Conversation.user_id == user_id, Conversation.deleted_at == deleted_at
+        ).execution_options(yield_per=1000)).partitions()
+        for conversation_ids in deleted_ids:
+            invalidate_conversation_reads(conversation_ids, user_id)
+        invalidate_conversation_reads([], user_id)
 
-        return jsonify({"message": "Conversation deleted successfully"})
+        return jsonify({
+            "message": "Account data deleted successfully",
+            "deleted_conversations": conversation_count,
+            "deleted_child_accounts": child_count
+        })
     except Exception as e:
         db.session.rollback()
         return jsonify({"error": str(e)}), 500
 
 
+def export_response(records):
+    """
+    Stream export records as NDJSON; each page of conversations is read as the response gets to it
+    """
+    return Response(stream_with_context(ndjson_lines(records)), mimetype='application/x-ndjson')
+
+
+@app.route('/export_stories', methods=['GET'])
+@firebase_auth_required
+@read_only
+def export_stories():
+    # Use Firebase user ID from the token
+    user_id = request.firebase_user.get('localId', 'user_id_placeholder')
+    # Optional: resume after the last conversation_id received
+    try:
+        after_id = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    return export_response(iter_conversations(user_id, after_id, router.read_engine()))
+
+
+@app.route('/export_account_data', methods=['GET'])
+@firebase_auth_required
+@read_only
+def export_account_data():
+    # Use Firebase user ID from the token
+    user_id = request.firebase_user.get('localId', 'user_id_placeholder')
+    # Optional: resume after the last conversation_id received
+    try:
+        after_id = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    return export_response(iter_account_export(user_id, after_id, router.read_engine()))
+
+
 @app.route('/get_conversations', methods=['GET'])
 @firebase_auth_required
+@read_only
 def get_conversations():
     # Use Firebase user ID from the token
     user_id = request.firebase_user.get('localId', 'user_id_placeholder')
@@ -247,25 +577,21 @@ def get_conversations():
     page = request.args.get('page')  # Optional
     limit = request.args.get('limit')  # Optional
 
-    try:
+    def load():
         # Fetch conversations for the user
-        conversations_query = Conversation.query.filter_by(user_id=user_id)
+        user_conversations = conversations_query(user_id)
 
         if page is not None and limit is not None:
             # Apply pagination if both page and limit are provided
-            page = int(page)
-            limit = int(limit)
-            conversations = conversations_query.order_by(Conversation.created_at.desc()) \
-                .offset(page * limit).limit(limit).all()
+            conversations = user_conversations.offset(int(page) * int(limit)).limit(int(limit)).all()
         else:
             # Fetch all conversations if pagination is not provided
-            conversations = conversations_query.order_by(Conversation.created_at.desc()).all()
+            conversations = user_conversations.all()
 
         result = []
         for conversation in conversations:
             # Get the first message (story) for each conversation
-            messages = Message.query.filter_by(
-                conversation_id=conversation.id).order_by(Message.created_at).all()
+            messages = conversation_messages(conversation.id)
             first_story = next(
                 (msg for msg in messages if msg.sender_type == SenderType.MODEL), None)
 
@@ -278,52 +604,75 @@ def get_conversations():
 
         # Include pagination metadata only if pagination is applied
         if page is not None and limit is not None:
-            return jsonify({
+            return {
                 "conversations": result,
-                "total_conversations": conversations_query.count(),
-                "page": page,
-                "limit": limit
-            })
+                "total_conversations": user_conversations.order_by(None).count(),
+                "page": int(page),
+                "limit": int(limit)
+            }
         else:
             # Return all conversations without pagination metadata
-            return jsonify({
+            return {
                 "conversations": result
-            })
+            }
+
+    try:
+        return etag_response(
+            conversations_version(user_id),
+            lambda: read_cache.get_or_load(f"page:{page}:{limit}", load, conversations_namespace(user_id)))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/search_stories', methods=['GET'])
+@firebase_auth_required
+@read_only
+def search_stories_endpoint():
+    # Use Firebase user ID from the token
+    user_id = request.firebase_user.get('localId', 'user_id_placeholder')
+    query = request.args.get('q', '').strip()
+    limit = request.args.get('limit', 20)
+
+    if not query:
+        return jsonify({"error": "Search query is required"}), 400
+    try:
+        limit = min(max(int(limit), 1), 100)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+    try:
+        # results live in the user's conversations namespace, so new stories and deletes drop them
+        key = "search:" + hashlib.sha1(f"{query.lower()}:{limit}".encode()).hexdigest()
+        results = read_cache.get_or_load(
+            key, lambda: search_stories(user_id, query, limit), conversations_namespace(user_id))
+        return jsonify({"query": query, "results": results}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.route('/get_conversation_messages', methods=['GET'])
 @firebase_auth_required
+@read_only
 def get_conversation_messages():
     # Use Firebase user ID from the token
     user_id = request.firebase_user.get('localId', 'user_id_placeholder')
     conversation_id = request.args.get('conversation_id')
+    # Optional: only return messages newer than this id (delta sync)
+    since_message_id = request.args.get('since_message_id')
 
     if not conversation_id:
         return jsonify({"error": "Conversation ID is required"}), 400
 
     try:
-        # Verify the conversation belongs to the user
-        conversation = Conversation.query.filter_by(
-            id=conversation_id, user_id=user_id).first()
-        if not conversation:
-            return jsonify({"error": "Conversation not found or access denied"}), 404
-
-        messages = fetch_messages_by_user_and_conversation(
-            user_id, conversation_id)
-        result = []
-
-        for message in messages:
-            result.append({
-                'id': message.id,
-                'sender_type': message.sender_type.name,
-                'content': message.content,
-                'created_at': message.created_at.isoformat(),
-                'code': message.code
-            })
+        conversation_id = int(conversation_id)
+        if since_message_id is not None:
+            since_message_id = int(since_message_id)
+    except ValueError:
+        return jsonify({"error": "Invalid conversation or message ID"}), 400
 
-        return jsonify({"messages": result})
+    try:
+        # Verify the conversation belongs to the user and return its messages
+        return conversation_messages_response(conversation_id, user_id, since_message_id)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -353,6 +702,8 @@ def create_child_account():
     success = save_child_account(username, pin, parent_uid, display_name, age)
 
     if success:
+        # this route has no token, so mark the parent's write explicitly
+        router.record_write(parent_uid)
         return jsonify({"message": "Child account created successfully"})
     else:
         return jsonify({"error": "Failed to create child account"}), 500
@@ -390,6 +741,7 @@ def child_login():
 
 @app.route('/get_child_accounts', methods=['POST'])
 @firebase_auth_required
+@read_only
 def get_child_accounts():
     data = request.get_json()
     parent_uid = data.get('parent_uid')  # Parent UID passed from the frontend
@@ -400,22 +752,11 @@ def get_child_accounts():
     # Print the parent_uid for debugging
     print(f"Parent UID: {parent_uid}")
 
-    # Query all child accounts 
-    child_accounts = ChildAccount.query.all()
-    # Filter child accounts by parent UID
-    child_accounts = [account for account in child_accounts if account.parent_uid == parent_uid]
+    # Query only this parent's child accounts (cached per parent)
+    result = get_child_accounts_for_parent(parent_uid)
 
     # Print the number of child accounts found
-    print(f"Found {len(child_accounts)} child accounts (all)")
-
-    # Format the results
-    result = []
-    for account in child_accounts:
-        result.append({
-            'username': account.username,
-            'display_name': account.display_name,
-            'age': account.age
-        })
+    print(f"Found {len(result)} child accounts")
 
     return jsonify({"child_accounts": result})
 
@@ -437,19 +778,23 @@ def handle_child_request():
             return jsonify({"message": "Invalid response from handler"})
 
         if conversation_id:
-            conversation = Conversation.query.get(conversation_id)
+            conversation = Conversation.query.filter_by(
+                id=conversation_id, deleted_at=None).first()
             if not conversation:
                 return jsonify({"message": "Invalid conversation ID"})
-        else:
-            conversation = Conversation(user_id=parent_uid)
-            db.session.add(conversation)
-            db.session.commit()
-            conversation_id = conversation.id
 
-        if code == 2 and conversation_id:  # If the user asks for a new story and there is an existing conversation
-            return jsonify({"confirmation": "Are you sure you want to start a new story? Please respond with 'yes' or 'no'.", "conversation_id": conversation_id})
+        # the conversation and the user's message are committed together, before the LLM call
+        with unit_of_work():
+            if not conversation_id:
+                conversation = Conversation(user_id=parent_uid)
+                db.session.add(conversation)
+                db.session.flush()
+                conversation_id = conversation.id
 
-        log_message(conversation.id, SenderType.USER, code, query)
+            if code == 2 and conversation_id:  # If the user asks for a new story and there is an existing conversation
+                return jsonify({"confirmation": "Are you sure you want to start a new story? Please respond with 'yes' or 'no'.", "conversation_id": conversation_id})
+
+            log_message(conversation.id, SenderType.USER, code, query)
 
         if code == 0:  # If the user asks for something unrelated to telling a story
             response = "Sorry, I can only tell stories. Please ask me to tell you a story."
@@ -462,17 +807,17 @@ def handle_child_request():
                 story = story_data.get("story", "")
                 # Format the response with title and story
                 response = f"TITLE: {title}\n\nSTORY: {story}"
-                log_message(conversation.id, SenderType.MODEL, code, response)
+                log_story(conversation.id, code, response)
             else:
                 response = story_data
-                log_message(conversation.id, SenderType.MODEL, code, response)
+                log_story(conversation.id, code, response)
         elif code == 3:  # If the user asks for an addition to an existing story
             story_data = add_to_existing_story(conversation.id, query)
             title = story_data.get("title", "New Story")
             story = story_data.get("story", "")
             # Format the response with title and story
             response = f"TITLE: {title}\n\nSTORY: {story}"
-            log_message(conversation.id, SenderType.MODEL, code, response)
+            log_story(conversation.id, code, response)
         else:
             response = f"Invalid code: {code}"
 
@@ -504,10 +849,10 @@ def confirm_child_new_story():
                 story = story_data.get("story", "")
                 # Format the response with title and story
                 response = f"TITLE: {title}\n\nSTORY: {story}"
-                log_message(conversation.id, SenderType.MODEL, 2, response)
+                log_story(conversation.id, 2, response)
             else:
                 response = story_data
-                log_message(conversation.id, SenderType.MODEL, 2, response)
+                log_story(conversation.id, 2, response)
 
             return jsonify({"message": "New story initiated.", "response": response, "conversation_id": conversation.id})
         elif confirmation.lower() == 'n':
@@ -518,8 +863,79 @@ def confirm_child_new_story():
         return jsonify({"message": "Query and confirmation required"})
 
 
+def load_child_conversations(parent_uid, page, limit, assigned_stories):
+    """
+    Build the get_child_conversations payload for a parent's conversations
+    """
+    # Fetch conversations for the parent
+    parent_conversations = conversations_query(parent_uid)
+    total_conversations = parent_conversations.order_by(None).count()
+    # Filter conversations based on assigned stories if provided
+    if assigned_stories:
+        # Fetch only conversations with assigned stories
+        #app.logger.info(f"Assigned stories: {assigned_stories}")
+        assigned_stories = [int(story_id) for story_id in assigned_stories]
+        #app.logger.info(f"Assigned stories: {assigned_stories}")
+        parent_conversations = parent_conversations.filter(
+            Conversation.id.in_(assigned_stories)
+        )
+        # log message to flask
+        #app.logger.info(f"Conversations query: {parent_conversations}")
+    if page is not None and limit is not None and len(assigned_stories) > limit:
+        # Apply pagination if both page and limit are provided & lots of assigned stories
+        page = int(page)
+        limit = int(limit)
+        
+        # if limit is greather than the total_conversations, set it to total_conversations
+        if limit >= total_conversations:
+            limit = total_conversations
+        print(f"Page: {page}, Limit: {limit}")
+        print(f"Total conversations: {total_conversations}")
+        # Check if all conversations have already been returned
+        if page * limit > total_conversations:
+            return {
+                "conversations": [],
+                "total_conversations": total_conversations,
+                "page": page,
+                "limit": limit
+            }
+        conversations = parent_conversations.offset(page * limit).limit(limit).all()
+    else:
+        # Fetch all conversations if pagination is not provided
+        conversations = parent_conversations.all()
+
+    result = []
+    for conversation in conversations:
+        # Get the first message (story) for each conversation
+        messages = conversation_messages(conversation.id)
+        first_story = next(
+            (msg for msg in messages if msg.sender_type == SenderType.MODEL), None)
+
+        result.append({
+            'id': conversation.id,
+            'created_at': conversation.created_at.isoformat(),
+            'preview': first_story.content[:100] + '...' if first_story else 'No story content',
+            'message_count': len(messages)
+        })
+
+    # Include pagination metadata only if pagination is applied
+    if page is not None and limit is not None:
+        return {
+            "conversations": result,
+            "total_conversations": parent_conversations.order_by(None).count(),
+            "page": page,
+            "limit": limit
+        }
+    else:
+        # Return all conversations without pagination metadata
+        return {
+            "conversations": result
+        }
+
+
 @app.route('/get_child_conversations', methods=['GET'])
 @child_auth_required
+@read_only
 def get_child_conversations():
     # accepts parent_uid and assigned stories parameters
     # Use parent UID from the child token for database operations
@@ -546,109 +962,42 @@ def get_child_conversations():
             "page": page,
             "limit": limit
         })
+    # cached with the parent's other list pages, keyed by the requested assignment set
+    cache_key = f"child:{page}:{limit}:{','.join(sorted(str(story_id) for story_id in assigned_stories or []))}"
     try:
-    
-        # Fetch conversations for the parent
-        conversations_query = Conversation.query.filter_by(user_id=parent_uid)
-        total_conversations = conversations_query.count()
-        # Filter conversations based on assigned stories if provided
-        if assigned_stories:
-            # Fetch only conversations with assigned stories
-            #app.logger.info(f"Assigned stories: {assigned_stories}")
-            assigned_stories = [int(story_id) for story_id in assigned_stories]
-            #app.logger.info(f"Assigned stories: {assigned_stories}")
-            conversations_query = conversations_query.filter(
-                Conversation.id.in_(assigned_stories)
-            )
-            # log message to flask
-            #app.logger.info(f"Conversations query: {conversations_query}")
-        if page is not None and limit is not None and len(assigned_stories) > limit:
-            # Apply pagination if both page and limit are provided & lots of assigned stories
-            page = int(page)
-            limit = int(limit)
-            
-            # if limit is greather than the total_conversations, set it to total_conversations
-            if limit >= total_conversations:
-                limit = total_conversations
-            print(f"Page: {page}, Limit: {limit}")
-            print(f"Total conversations: {total_conversations}")
-            # Check if all conversations have already been returned
-            if page * limit > total_conversations:
-                return jsonify({
-                    "conversations": [],
-                    "total_conversations": total_conversations,
-                    "page": page,
-                    "limit": limit
-                })
-            conversations = conversations_query.order_by(Conversation.created_at.desc()) \
-                .offset(page * limit).limit(limit).all()
-        else:
-            # Fetch all conversations if pagination is not provided
-            conversations = conversations_query.order_by(Conversation.created_at.desc()).all()
-
-        result = []
-        for conversation in conversations:
-            # Get the first message (story) for each conversation
-            messages = Message.query.filter_by(
-                conversation_id=conversation.id).order_by(Message.created_at).all()
-            first_story = next(
-                (msg for msg in messages if msg.sender_type == SenderType.MODEL), None)
-
-            result.append({
-                'id': conversation.id,
-                'created_at': conversation.created_at.isoformat(),
-                'preview': first_story.content[:100] + '...' if first_story else 'No story content',
-                'message_count': len(messages)
-            })
-
-        # Include pagination metadata only if pagination is applied
-        if page is not None and limit is not None:
-            return jsonify({
-                "conversations": result,
-                "total_conversations": conversations_query.count(),
-                "page": page,
-                "limit": limit
-            })
-        else:
-            # Return all conversations without pagination metadata
-            return jsonify({
-                "conversations": result
-            })
+        return etag_response(
+            conversations_version(parent_uid),
+            lambda: read_cache.get_or_load(
+                cache_key,
+                lambda: load_child_conversations(parent_uid, page, limit, assigned_stories),
+                conversations_namespace(parent_uid)))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
 @app.route('/get_child_conversation_messages', methods=['GET'])
 @child_auth_required
+@read_only
 def get_child_conversation_messages():
     # Use parent UID from the child token for database operations
     parent_uid = request.child_user.get('parent_uid', 'user_id_placeholder')
     conversation_id = request.args.get('conversation_id')
+    # Optional: only return messages newer than this id (delta sync)
+    since_message_id = request.args.get('since_message_id')
 
     if not conversation_id:
         return jsonify({"error": "Conversation ID is required"}), 400
 
     try:
-        # Verify the conversation belongs to the parent
-        conversation = Conversation.query.filter_by(
-            id=conversation_id, user_id=parent_uid).first()
-        if not conversation:
-            return jsonify({"error": "Conversation not found or access denied"}), 404
-
-        messages = fetch_messages_by_user_and_conversation(
-            parent_uid, conversation_id)
-        result = []
-
-        for message in messages:
-            result.append({
-                'id': message.id,
-                'sender_type': message.sender_type.name,
-                'content': message.content,
-                'created_at': message.created_at.isoformat(),
-                'code': message.code
-            })
+        conversation_id = int(conversation_id)
+        if since_message_id is not None:
+            since_message_id = int(since_message_id)
+    except ValueError:
+        return jsonify({"error": "Invalid conversation or message ID"}), 400
 
-        return jsonify({"messages": result})
+    try:
+        # Verify the conversation belongs to the parent and return its messages
+        return conversation_messages_response(conversation_id, parent_uid, since_message_id)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -670,14 +1019,14 @@ def assign_story():
 
     # Verify the conversation exists and belongs to the parent
     conversation = Conversation.query.filter_by(
-        id=conversation_id, user_id=parent_uid).first()
+        id=conversation_id, user_id=parent_uid, deleted_at=None).first()
     if not conversation:
         return jsonify({"error": "Conversation not found or access denied"}), 404
     print(f"Conversation found: {conversation}")
 
     # Verify the child account exists and belongs to the parent
     child_account = ChildAccount.query.filter_by(
-        username=child_username, parent_uid=parent_uid).first()
+        username=child_username, parent_uid=parent_uid, deleted_at=None).first()
     print(f"Child account found: {child_account}")
     if not child_account:
         return jsonify({"error": "Child account not found or access denied"}), 404
@@ -691,38 +1040,196 @@ def assign_story():
 
     db.session.add(assignment)
     db.session.commit()
+    read_cache.invalidate_namespace(assigned_namespace(parent_uid))
+    if NARRATION_PRERENDER:
+        # the narration is ready by the time the child opens the story
+        schedule_narration(conversation.id)
 
     return jsonify({"message": "Story assigned successfully", "assignment_id": assignment.id})
 
 
+# Most (conversation, child) pairs accepted by one bulk assignment request
+MAX_BULK_ASSIGNMENTS = 500
+
+
+@app.route('/assign_stories', methods=['POST'])
+@firebase_auth_required
+def assign_stories():
+    data = request.get_json()
+    items = data.get('assignments') if data else None
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "A list of assignments is required"}), 400
+    if len(items) > MAX_BULK_ASSIGNMENTS:
+        return jsonify({"error": f"At most {MAX_BULK_ASSIGNMENTS} assignments per request"}), 400
+
+    # Retrieve the parent UID from the Firebase token
+    parent_uid = request.firebase_user.get('localId')
+
+    results = []
+    pending = []
+    for index, item in enumerate(items):
+        item = item if isinstance(item, dict) else {}
+        result = {
+            'index': index,
+            'conversation_id': item.get('conversation_id'),
+            'child_username': item.get('child_username')
+        }
+        results.append(result)
+        try:
+            result['conversation_id'] = int(result['conversation_id'])
+        except (TypeError, ValueError):
+            result['conversation_id'] = None
+        if not isinstance(result['child_username'], str):
+            result['child_username'] = None
+        if not all([result['conversation_id'], result['child_username'], item.get('title')]):
+            result.update(status='invalid', error="conversation_id, child_username and title are required")
+        else:
+            pending.append((result, item['title']))
+
+    # Verify ownership of every conversation and child with one query each
+    conversation_ids = {result['conversation_id'] for result, _ in pending}
+    usernames = {result['child_username'] for result, _ in pending}
+    owned_conversations = set(db.session.scalars(db.select(Conversation.id).where(
+        Conversation.id.in_(conversation_ids), Conversation.user_id == parent_uid,
+        Conversation.deleted_at.is_(None))))
+    owned_children = set(db.session.scalars(db.select(ChildAccount.username).where(
+        ChildAccount.username.in_(usernames), ChildAccount.parent_uid == parent_uid,
+        ChildAccount.deleted_at.is_(None))))
+    # pairs that are already assigned are not assigned again
+    assigned = set(db.session.execute(db.select(
+        StoryAssignment.conversation_id, StoryAssignment.child_username
+    ).where(
+        StoryAssignment.conversation_id.in_(owned_conversations),
+        StoryAssignment.child_username.in_(owned_children)
+    )).tuples())
+
+    created = []
+    for result, title in pending:
+        pair = (result['conversation_id'], result['child_username'])
+        if result['conversation_id'] not in owned_conversations:
+            result.update(status='not_found', error="Conversation not found or access denied")
+        elif result['child_username'] not in owned_children:
+            result.update(status='not_found', error="Child account not found or access denied")
+        elif pair in assigned:
+            result['status'] = 'duplicate'
+        else:
+            assigned.add(pair)
+            assignment = StoryAssignment(conversation_id=pair[0], child_username=pair[1], title=title)
+            db.session.add(assignment)
+            created.append((result, assignment))
+
+    # Every new assignment is written in one transaction
+    if created:
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({"error": str(e)}), 500
+        read_cache.invalidate_namespace(assigned_namespace(parent_uid))
+    for result, assignment in created:
+        result.update(status='assigned', assignment_id=assignment.id)
+    if NARRATION_PRERENDER:
+        for conversation_id in {assignment.conversation_id for _, assignment in created}:
+            schedule_narration(conversation_id)
+
+    return jsonify({
+        "message": f"Assigned {len(created)} of {len(items)} stories",
+        "assigned": len(created),
+        "results": results
+    })
+
+
+def load_assigned_stories(username, page, limit):
+    """
+    Build the get_assigned_stories payload for a child
+    """
+    # One query for the assignments and their story previews
+    assignments_query = assigned_stories_list_query(username)
+
+    if page is not None and limit is not None:
+        # Apply pagination if both page and limit are provided
+        page = int(page)
+        limit = int(limit)
+        assignments = assignments_query.offset(page * limit).limit(limit).all()
+    else:
+        # Fetch all assigned stories if pagination is not provided
+        assignments = assignments_query.all()
+
+    result = []
+    for assignment in assignments:
+        preview = assignment.preview
+        if assignment.content_zstd is not None:
+            preview = decompress_content(assignment.content_zstd, assignment.content_dict_id)[:101]
+        result.append({
+            'id': assignment.id,
+            'conversation_id': assignment.conversation_id,
+            'title': assignment.title,
+            'assigned_at': assignment.assigned_at.isoformat(),
+            'preview': preview[:100] + '...' if len(preview) > 100 else preview
+        })
+
+    # Include pagination metadata only if pagination is applied
+    if page is not None and limit is not None:
+        return {
+            "assigned_stories": result,
+            "total_assigned_stories": assignments_query.order_by(None).count(),
+            "page": page,
+            "limit": limit
+        }
+    return {"assigned_stories": result}
+
+
+@app.route('/get_story_narration', methods=['GET'])
+@child_auth_required
+def get_story_narration():
+    child_username = request.child_user.get('username')
+    conversation_id = request.args.get('conversation_id', type=int)
+    voice = request.args.get('voice', NARRATION_VOICE)
+    if not conversation_id:
+        return jsonify({"error": "conversation_id is required"}), 400
+    if not valid_voice(voice):
+        return jsonify({"error": "Invalid voice"}), 400
+
+    # Only stories assigned to the child can be narrated for it
+    assignment = StoryAssignment.query.join(Conversation).filter(
+        StoryAssignment.conversation_id == conversation_id,
+        StoryAssignment.child_username == child_username,
+        Conversation.deleted_at.is_(None)
+    ).first()
+    if not assignment:
+        return jsonify({"error": "Story not found or access denied"}), 404
+
+    # Ready narrations are fetched with /download_audio?file_path=...
+    file_path = narration_path(assignment, voice)
+    if file_path:
+        return jsonify({"status": "ready", "file_path": file_path})
+    if not schedule_narration(conversation_id, voice):
+        return jsonify({"error": "Narration is not available"}), 503
+    return jsonify({"status": "pending"}), 202
+
+
 @app.route('/get_assigned_stories', methods=['GET'])
 @child_auth_required
+@read_only
 def get_assigned_stories():
     # Get the child username from the token
     username = request.child_user.get('username')
+    parent_uid = request.child_user.get('parent_uid', 'user_id_placeholder')
 
-    # Query assigned stories for this child
-    assignments = StoryAssignment.query.filter_by(
-        child_username=username).all()
-
-    result = []
-    for assignment in assignments:
-        # Get the first model message from the conversation (the story content)
-        first_story = Message.query.filter_by(
-            conversation_id=assignment.conversation_id,
-            sender_type=SenderType.MODEL
-        ).order_by(Message.created_at).first()
-
-        if first_story:
-            result.append({
-                'id': assignment.id,
-                'conversation_id': assignment.conversation_id,
-                'title': assignment.title,
-                'assigned_at': assignment.assigned_at.isoformat(),
-                'preview': first_story.content[:100] + '...' if len(first_story.content) > 100 else first_story.content
-            })
+    # Get pagination parameters from the query string
+    page = request.args.get('page')  # Optional
+    limit = request.args.get('limit')  # Optional
 
-    return jsonify({"assigned_stories": result})
+    try:
+        # cached per parent, since assigning and deleting stories happen on the parent side
+        return etag_response(
+            assigned_version(username, parent_uid),
+            lambda: read_cache.get_or_load(
+                f"{username}:{page}:{limit}",
+                lambda: load_assigned_stories(username, page, limit),
+                assigned_namespace(parent_uid)))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
 
 
 @app.route('/generate_themed_story', methods=['POST'])
@@ -790,13 +1297,12 @@ def generate_themed_story():
     # Use parent UID from the child token for database operations
     parent_uid = request.child_user.get('parent_uid', 'user_id_placeholder')
 
-    # Create a new conversation
-    conversation = Conversation(user_id=parent_uid)
-    db.session.add(conversation)
-    db.session.commit()
-
-    # Log the user message
-    log_message(conversation.id, SenderType.USER, 2, prompt)
+    # Create a new conversation and log the user message, committed together before the LLM call
+    with unit_of_work():
+        conversation = Conversation(user_id=parent_uid)
+        db.session.add(conversation)
+        db.session.flush()
+        log_message(conversation.id, SenderType.USER, 2, prompt)
 
     # Generate the story
     story_data = generate_new_story(prompt)
@@ -805,11 +1311,11 @@ def generate_themed_story():
         story = story_data.get("story", "")
         # Format the response with title and story
         response = f"TITLE: {title}\n\nSTORY: {story}"
-        log_message(conversation.id, SenderType.MODEL, 2, response)
+        log_story(conversation.id, 2, response)
     else:
         response = story_data
         title = f"{story_theme.value.title()} Story"
-        log_message(conversation.id, SenderType.MODEL, 2, response)
+        log_story(conversation.id, 2, response)
 
     return jsonify({
         "response": response,
@@ -818,92 +1324,128 @@ def generate_themed_story():
         "theme": theme
     })
 
-# heap data structure to store the audio files based on their filesize and the time they were created to delete the oldest & largest files first
-class AudioHeap:
-    def __init__(self):
-        self.heap = []
-
-    def push(self, file_path):
-        file_size = os.path.getsize(file_path)
-        created_at = os.path.getctime(file_path)
-        heapq.heappush(self.heap, (file_size, created_at, file_path))
+# Seconds an upload waits for its transcode before answering 202 with the job handle;
+# by default the handle is returned at once and the client polls /audio_jobs/<job_id>
+AUDIO_UPLOAD_WAIT = int(os.getenv("AUDIO_UPLOAD_WAIT", 0))
 
-    def pop(self):
-        return heapq.heappop(self.heap)[2]  # Return only the file path
-
-    def remove(self, file_path):
-        self.heap = [item for item in self.heap if item[2] != file_path]
-        heapq.heapify(self.heap)
-
-    # return size of the heap
-    def size(self):
-        return len(self.heap)
-# Initialize the heap
-audio_heap = AudioHeap()
-# Set the maximum size of the heap
-MAX_HEAP_SIZE = 10  # Maximum number of audio files to keep
 
 # post method to recieve bytes of audio file from the frontend and save it to the server
 @app.route('/upload_audio', methods=['POST'])
 def upload_audio():
-    request_data = request.get_json()
-    # Get the audio file bytes and filename from the request
-    audio_bytes = request_data.get('bytes')  # 'bytes' should match the key used in the frontend
-    audio_filename = request_data.get('filename')
-    if not audio_bytes:
-        return jsonify({"error": "No audio file provided"}), 400
-    if not audio_filename:
-        return jsonify({"error": "No filename provided"}), 400
-    
-    # Ensure the 'uploads' directory exists
-    upload_dir = 'uploads'
-    save_path = os.path.join(upload_dir, audio_filename) + '.mp3'
-    if not os.path.exists(upload_dir):
-        os.makedirs(upload_dir)
-    # base case check if the filename is in the heap
-    if save_path in [item[2] for item in audio_heap.heap]:
-        print(f"File {audio_filename} already cached. Returning existing file.")
-        return jsonify({"message": "File already cached", "file_path": save_path}), 200
+    # The audio can be sent as a raw body (audio/mpeg, ?filename=...), as multipart form
+    # data, or base64-encoded in JSON as the app does
+    # Optional: a parent's Firebase token makes the upload theirs, so only they can delete it
+    owner = request_firebase_user()
+    if request.headers.get('Authorization') and not owner:
+        return jsonify({'error': 'Invalid or expired token'}), 401
 
-    # Decode the bytes (if they are base64-encoded)
-    audio_data = base64.b64decode(audio_bytes)
-    # Convert the bytes to an MP3 file
     try:
-        audio = AudioSegment.from_file(io.BytesIO(audio_data), format="mp3")
-        try:
-            audio.export(save_path, format="mp3")
-            # check if the size of the heap is greater than the max size
-            if audio_heap.size() >= MAX_HEAP_SIZE:
-                # remove the largest file from the heap
-                largest_file = audio_heap.pop()
-                os.remove(largest_file)
-                print(f"Removed file {largest_file} from the server to make space for new files.")
-            # add the new file to the heap
-            audio_heap.push(save_path)
-            print(f"File {audio_filename} saved to {save_path}")
-        except Exception as e:
-            print(f"Error exporting audio: {e}")
-            return jsonify({"error": "Failed to save audio file"}), 500
+        audio_filename, audio_stream = read_upload(request)
+    except AudioUploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    if audio_filename.startswith(NARRATION_PREFIX):
+        return jsonify({"error": "Filename is reserved"}), 400
 
+    try:
+        # stored under the hash of its content; an identical upload reuses the stored file.
+        # MP3 is stored right away, other formats are transcoded on the audio worker pool
+        result, job_id = submit_audio(audio_filename, audio_stream, owner['localId'] if owner else None)
+    except AudioJobRejected as e:
+        print(f"Rejected audio upload {audio_filename}: {e}")
+        return jsonify({"error": "Audio processing is busy, try again shortly"}), 503, {"Retry-After": "5"}
+    except AudioUploadError as e:
+        return jsonify({"error": str(e)}), e.status_code
     except Exception as e:
-        return jsonify({"error": f"Failed to process audio file: {e}"}), 500
+        db.session.rollback()
+        print(f"Error saving audio: {e}")
+        return jsonify({"error": "Failed to save audio file"}), 500
+
+    if job_id is not None:
+        job = audio_jobs.wait(job_id, AUDIO_UPLOAD_WAIT) if AUDIO_UPLOAD_WAIT else audio_jobs.status(job_id)
+        if job['status'] == 'failed':
+            return jsonify({"error": job['error']}), 400
+        if job['status'] != 'done':
+            return audio_job_response(job), 202
+        result = job['result']
+
+    if result['duplicate']:
+        print(f"File {audio_filename} already cached. Returning existing file.")
+        return jsonify({"message": "File already cached", "file_path": result['file_path']}), 200
+    print(f"File {audio_filename} saved to {result['file_path']}{' (transcoded)' if result['transcoded'] else ''}")
+
+    return jsonify({"message": "Audio file uploaded successfully", "file_path": result['file_path']}), 200
 
-    return jsonify({"message": "Audio file uploaded successfully", "file_path": save_path}), 200
+
+def audio_job_response(job):
+    response = {"job_id": job['job_id'], "status": job['status'], "status_url": f"/audio_jobs/{job['job_id']}"}
+    if job['status'] == 'done':
+        response["file_path"] = job['result']['file_path']
+    elif job['status'] == 'failed':
+        response["error"] = job['error']
+    return jsonify(response)
+
+
+@app.route('/audio_jobs/<job_id>', methods=['GET'])
+def get_audio_job(job_id):
+    # answered from the database when another server process accepted the upload
+    job = audio_job_status(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return audio_job_response(job)
+
+
+@app.route('/delete_audio', methods=['DELETE'])
+@firebase_auth_required
+def delete_audio_route():
+    audio_filename = request.args.get('filename')
+    if not audio_filename:
+        return jsonify({"error": "No filename provided"}), 400
+    # only the parent who uploaded a name can delete it; the file itself is removed once
+    # no other name refers to it
+    if not delete_audio(secure_filename(audio_filename), request.firebase_user['localId']):
+        return jsonify({"error": "File not found"}), 404
+    return jsonify({"message": "Audio file deleted successfully"}), 200
 
 # get method to download the audio file from the server
 @app.route('/download_audio', methods=['GET'])
 def download_audio():
     file_path = request.args.get('file_path')
+    # Optional: the name the audio was uploaded under instead of its path
+    audio_filename = request.args.get('filename')
     print(f"Received file path: {file_path}")
+    if audio_filename:
+        file_path = lookup_audio(secure_filename(audio_filename))
+        if not file_path:
+            return jsonify({"error": "File not found"}), 404
     if not file_path:
         return jsonify({"error": "No file path provided"}), 400
 
-    # Check if the file exists
-    if not os.path.exists(file_path):
+    # Only files in the audio directory can be downloaded
+    name = stored_name(file_path)
+    path = audio_cache.get(name) if name else None
+    if not path:
         return jsonify({"error": "File not found"}), 404
 
-    # Send the mp3 back
-    return send_file(file_path, as_attachment=True, mimetype='audio/mpeg')
+    # Send the mp3 back; supports Range requests and revalidation
+    return send_audio(name, path)
+
+
+# Bearer token for /metrics; the endpoint is disabled when it isn't set
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    if not METRICS_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({'error': 'No valid authorization token provided'}), 401
+    return jsonify({
+        "read_cache": read_cache.stats(),
+        "principal_cache": principal_cache.stats(),
+        "audio_cache": audio_cache.stats(),
+        "audio_jobs": audio_jobs.stats()
+    })
 
 
 if __name__ == '__main__':
@@ -0,0 +1,153 @@
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Worker processes for CPU-heavy audio work such as ffmpeg transcoding
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", 2))
+# Jobs waiting or running at once; more are rejected so bursts can't pile up
+AUDIO_QUEUE_DEPTH = int(os.getenv("AUDIO_QUEUE_DEPTH", 8))
+# How long finished jobs can still be looked up
+AUDIO_JOB_RETENTION = int(os.getenv("AUDIO_JOB_RETENTION", 3600))
+# Workers start from a fork server rather than forking the threaded web server, which can
+# deadlock on locks held by other threads. They import the job function's module (and the
+# main script, when the server isn't started by gunicorn).
+AUDIO_WORKER_START_METHOD = os.getenv("AUDIO_WORKER_START_METHOD", "forkserver")
+
+
+class AudioJobRejected(Exception):
+    """
+    Raised when the job queue is full
+    """
+
+
+class AudioJobs:
+    """
+    Bounded pool of worker processes. submit returns a job id at once; the job's status
+    can be polled or waited on. Jobs are only known to the process that submitted them;
+    pass done to record their outcome somewhere shared. A pool whose worker died is
+    replaced on the next submit.
+    """
+    def __init__(self, workers=AUDIO_WORKERS, queue_depth=AUDIO_QUEUE_DEPTH):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.executor = None
+        self.jobs = {}  # job id -> job record
+        self.in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def _pool(self):
+        if self.executor is not None and getattr(self.executor, '_broken', False):
+            print("Audio worker pool is broken; starting a new one")
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context(AUDIO_WORKER_START_METHOD))
+        return self.executor
+
+    def _prune(self):
+        cutoff = time.time() - AUDIO_JOB_RETENTION
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job['finished_at'] is not None and job['finished_at'] < cutoff]:
+            del self.jobs[job_id]
+
+    def submit(self, fn, *args, finish=None, done=None, job_id=None):
+        """
+        Run fn(*args) in a worker process and return the job id. finish(result), if given,
+        runs in this process once fn returns and its return value becomes the job's result.
+        done(status), if given, runs once the job has finished either way.
+        Raises AudioJobRejected when queue_depth jobs are already waiting or running.
+        """
+        job = {
+            'id': job_id or uuid.uuid4().hex,
+            'status': 'queued',
+            'result': None,
+            'error': None,
+            'future': None,
+            'finished_at': None,
+            'done': threading.Event()
+        }
+        with self.lock:
+            self._prune()
+            if self.in_flight >= self.queue_depth:
+                self.rejected += 1
+                raise AudioJobRejected(f"{self.in_flight} audio jobs are already queued")
+            try:
+                job['future'] = self._pool().submit(fn, *args)
+            except BrokenProcessPool:
+                job['future'] = self._pool().submit(fn, *args)
+            self.in_flight += 1
+            self.submitted += 1
+            self.jobs[job['id']] = job
+        job['future'].add_done_callback(lambda future: self._complete(job, future, finish, done))
+        return job['id']
+
+    def _complete(self, job, future, finish, done):
+        try:
+            result = future.result()
+            job['result'] = finish(result) if finish else result
+            job['status'] = 'done'
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                e = "Audio worker process died"
+            print(f"Audio job {job['id']} failed: {e}")
+            job['error'] = str(e)
+            job['status'] = 'failed'
+        with self.lock:
+            self.in_flight -= 1
+            if job['status'] == 'done':
+                self.completed += 1
+            else:
+                self.failed += 1
+        job['finished_at'] = time.time()
+        if done:
+            try:
+                done(self.status(job['id']))
+            except Exception as e:
+                print(f"Error recording audio job {job['id']}: {e}")
+        job['done'].set()
+
+    def status(self, job_id):
+        """
+        The job as {'job_id', 'status', 'result', 'error'}, or None if it is unknown.
+        status is queued, running, done or failed.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        status = job['status']
+        if status == 'queued' and job['future'].running():
+            status = 'running'
+        return {'job_id': job['id'], 'status': status, 'result': job['result'], 'error': job['error']}
+
+    def wait(self, job_id, timeout=None):
+        """
+        Wait up to timeout seconds for a job to finish and return its status
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            job['done'].wait(timeout)
+        return self.status(job_id)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+        }
+
+
+audio_jobs = AudioJobs()
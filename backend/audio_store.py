@@ -0,0 +1,601 @@
+import base64
+import fcntl
+import hashlib
+import io
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from itertools import islice
+from flask import Response, current_app, send_file
+from pydub import AudioSegment
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+from datetime import datetime, timedelta
+from db.db import db, AudioName, AudioJob
+from audio_jobs import AUDIO_JOB_RETENTION, audio_jobs
+
+# Uploaded narrations are stored here as <sha256 of the content>.mp3
+AUDIO_UPLOAD_DIR = os.getenv("AUDIO_UPLOAD_DIR", "uploads")
+# Larger uploads are rejected with 413
+AUDIO_MAX_UPLOAD_BYTES = int(os.getenv("AUDIO_MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+# Base64 length of the largest upload, for uploads sent in JSON
+AUDIO_MAX_BASE64_BYTES = 4 * -(-AUDIO_MAX_UPLOAD_BYTES // 3)
+AUDIO_CHUNK_SIZE = 64 * 1024
+# Total size the stored audio may take before the least valuable files are evicted
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# "lru" evicts the least recently used file; "size" evicts the largest of the
+# AUDIO_CACHE_EVICTION_SAMPLE least recently used files, freeing space with fewer evictions
+AUDIO_CACHE_POLICY = os.getenv("AUDIO_CACHE_POLICY", "lru")
+AUDIO_CACHE_EVICTION_SAMPLE = int(os.getenv("AUDIO_CACHE_EVICTION_SAMPLE", 8))
+# Other workers add and evict files too; the index is rescanned from disk this often
+AUDIO_CACHE_RESCAN_SECONDS = int(os.getenv("AUDIO_CACHE_RESCAN_SECONDS", 60))
+# Files named after the hash of their content never change and may be cached for a year;
+# others are revalidated with their ETag on every play
+AUDIO_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# With nginx in front, the internal location that serves AUDIO_UPLOAD_DIR (e.g. /protected-audio/);
+# downloads are then handed to nginx with X-Accel-Redirect
+AUDIO_ACCEL_REDIRECT = os.getenv("AUDIO_ACCEL_REDIRECT", "")
+# How far past the ID3 tag to look for the first MPEG frame (encoder padding)
+MP3_SYNC_WINDOW = 4096
+
+# Layer III bitrates in kbit/s by bitrate index, for MPEG-1 and for MPEG-2/2.5
+_BITRATES = {
+    3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_BITRATES[0] = _BITRATES[2]
+# sample rates by MPEG version bits (0 = 2.5, 2 = 2, 3 = 1) and sample rate index
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+class AudioUploadError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def parse_frame_header(header):
+    """
+    Decode a 4-byte MPEG audio frame header. Returns (version bits, sample rate, frame
+    length in bytes) for a Layer III frame, or None if it isn't one.
+    """
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 0x03
+    padding = (header[2] >> 1) & 0x01
+    # only Layer III (MP3); free-format and reserved values are rejected
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = _BITRATES[version][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    samples_per_byte = 144 if version == 3 else 72
+    return version, sample_rate, samples_per_byte * bitrate // sample_rate + padding
+
+
+def _skip_id3(audio_file):
+    """
+    Return the offset just past any ID3v2 tags at the start of the file
+    """
+    offset = 0
+    while True:
+        audio_file.seek(offset)
+        tag = audio_file.read(10)
+        if len(tag) < 10 or tag[:3] != b'ID3':
+            return offset
+        # the size is stored as four 7-bit bytes and excludes the header and footer
+        size = (tag[6] << 21) | (tag[7] << 14) | (tag[8] << 7) | tag[9]
+        offset += 10 + size + (10 if tag[5] & 0x10 else 0)
+
+
+def is_mp3(audio_file):
+    """
+    True if the file holds MPEG Layer III audio: a valid frame header after the ID3 tag,
+    followed by a second matching frame (or the end of the file)
+    """
+    audio_file.seek(0, os.SEEK_END)
+    file_size = audio_file.tell()
+    start = _skip_id3(audio_file)
+    audio_file.seek(start)
+    window = audio_file.read(MP3_SYNC_WINDOW + 4)
+    for position in range(max(len(window) - 3, 0)):
+        frame = parse_frame_header(window[position:position + 4])
+        if frame is None:
+            continue
+        next_offset = start + position + frame[2]
+        if next_offset == file_size:
+            return True
+        audio_file.seek(next_offset)
+        following = parse_frame_header(audio_file.read(4))
+        if following is not None and following[:2] == frame[:2]:
+            return True
+    return False
+
+
+def _copy_to_file(stream, path):
+    """
+    Write a stream to path in chunks, hashing it on the way. Returns (size, sha256 hex digest).
+    """
+    size = 0
+    digest = hashlib.sha256()
+    with open(path, 'wb') as output:
+        while True:
+            chunk = stream.read(AUDIO_CHUNK_SIZE)
+            if not chunk:
+                return size, digest.hexdigest()
+            size += len(chunk)
+            if size > AUDIO_MAX_UPLOAD_BYTES:
+                raise AudioUploadError("Audio file is too large", 413)
+            digest.update(chunk)
+            output.write(chunk)
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as audio_file:
+        for chunk in iter(lambda: audio_file.read(AUDIO_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_file(content_hash):
+    return f"{content_hash}.mp3"
+
+
+def _discard(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def receive_audio(stream, directory):
+    """
+    Stream an upload into a temporary file in directory, in chunks, hashing it on the way.
+    Returns (temporary path, content hash, whether it has to be transcoded to MP3).
+    """
+    os.makedirs(directory, exist_ok=True)
+    # write next to the target and rename, so downloads never see a partial file
+    temporary_path = os.path.join(directory, f"{uuid.uuid4().hex}.tmp")
+    try:
+        size, content_hash = _copy_to_file(stream, temporary_path)
+        if not size:
+            raise AudioUploadError("No audio file provided")
+        with open(temporary_path, 'rb') as audio_file:
+            transcode = not is_mp3(audio_file)
+    except Exception:
+        _discard(temporary_path)
+        raise
+    return temporary_path, content_hash, transcode
+
+
+def transcode_audio(temporary_path):
+    """
+    Convert a received upload to MP3 in place with ffmpeg and return its new content hash
+    """
+    try:
+        AudioSegment.from_file(temporary_path).export(temporary_path + '.mp3', format="mp3")
+    except Exception as e:
+        raise AudioUploadError(f"Failed to process audio file: {e}")
+    os.replace(temporary_path + '.mp3', temporary_path)
+    return _hash_file(temporary_path)
+
+
+def commit_audio(temporary_path, content_hash, directory):
+    """
+    Move a received upload to its content address. Returns True if identical audio was
+    already stored, in which case the upload is discarded.
+    """
+    save_path = os.path.join(directory, content_file(content_hash))
+    duplicate = os.path.exists(save_path)
+    if duplicate:
+        os.remove(temporary_path)
+    else:
+        os.replace(temporary_path, save_path)
+    return duplicate
+
+
+def _transcode_and_commit(temporary_path, directory):
+    # runs in an audio worker process
+    try:
+        content_hash = transcode_audio(temporary_path)
+        return content_hash, commit_audio(temporary_path, content_hash, directory)
+    except Exception:
+        _discard(temporary_path, temporary_path + '.mp3')
+        raise
+
+
+def read_upload(request):
+    """
+    Return (filename, stream) for an upload sent as a raw body (?filename=...), as
+    multipart form data (fields 'file' and optionally 'filename'), or as base64 in JSON
+    """
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('file')
+        if upload is None:
+            raise AudioUploadError("No audio file provided")
+        filename = request.form.get('filename') or os.path.splitext(upload.filename or '')[0]
+        stream = upload.stream
+    elif request.is_json:
+        # the body is parsed and decoded in memory, so check its size before doing either;
+        # the 64 KiB allows for the filename and JSON around the base64
+        if request.content_length is not None and request.content_length > AUDIO_MAX_BASE64_BYTES + 64 * 1024:
+            raise AudioUploadError("Audio file is too large", 413)
+        # 'bytes' should match the key used in the frontend
+        request_data = request.get_json()
+        if not request_data.get('bytes'):
+            raise AudioUploadError("No audio file provided")
+        if len(request_data['bytes']) > AUDIO_MAX_BASE64_BYTES:
+            raise AudioUploadError("Audio file is too large", 413)
+        filename = request_data.get('filename')
+        try:
+            stream = io.BytesIO(base64.b64decode(request_data['bytes']))
+        except ValueError:
+            raise AudioUploadError("Audio bytes are not valid base64")
+    else:
+        filename = request.args.get('filename')
+        stream = request.stream
+    if not filename:
+        raise AudioUploadError("No filename provided")
+    name = secure_filename(filename)
+    if not name:
+        raise AudioUploadError("Invalid filename")
+    return name, stream
+
+
+class AudioCache:
+    """
+    Index of the audio files in a directory under a byte budget. Lookups are a dict hit
+    plus a stat. Recency is kept in each file's access time, so the LRU order survives
+    restarts and is shared by every worker process. Workers serialise adds and
+    evictions with a lock file next to the audio.
+    """
+    def __init__(self, directory, max_bytes=AUDIO_CACHE_MAX_BYTES, policy=AUDIO_CACHE_POLICY):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.entries = OrderedDict()  # file name -> size, least recently used first
+        self.total_bytes = 0
+        self.scanned_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.deduplicated = 0
+        self.lock = threading.RLock()
+        self.rebuild()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def rebuild(self):
+        """
+        Reload the index from the files on disk, ordered by last access
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        with os.scandir(self.directory) as scan:
+            for entry in scan:
+                if entry.is_file() and entry.name.endswith('.mp3'):
+                    stat = entry.stat()
+                    files.append((stat.st_atime, entry.name, stat.st_size))
+        files.sort()
+        with self.lock:
+            self.entries = OrderedDict((name, size) for _, name, size in files)
+            self.total_bytes = sum(size for _, _, size in files)
+            self.scanned_at = time.time()
+
+    def _touch(self, path):
+        # record the access on disk without changing the modification time
+        try:
+            stat = os.stat(path)
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            pass
+
+    def get(self, name):
+        """
+        Return the path of a stored file and mark it recently used, or None if it isn't stored
+        """
+        path = self.path(name)
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            with self.lock:
+                self.misses += 1
+                if name in self.entries:
+                    # evicted by another worker
+                    self.total_bytes -= self.entries.pop(name)
+            return None
+        with self.lock:
+            self.hits += 1
+            if name not in self.entries:
+                # added by another worker
+                self.total_bytes += size
+                self.entries[name] = size
+            self.entries.move_to_end(name)
+        self._touch(path)
+        return path
+
+    def record_miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def _victim(self, keep):
+        candidates = [name for name in islice(self.entries, AUDIO_CACHE_EVICTION_SAMPLE + 1) if name != keep]
+        if not candidates:
+            return None
+        if self.policy == 'size':
+            return max(candidates[:AUDIO_CACHE_EVICTION_SAMPLE], key=lambda name: self.entries[name])
+        return candidates[0]
+
+    def put(self, name):
+        """
+        Index a file just written (or stored again) in the directory and evict others until the directory
+        fits the budget again. Returns the evicted file names.
+        """
+        evicted = []
+        with self.lock, open(os.path.join(self.directory, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if time.time() - self.scanned_at > AUDIO_CACHE_RESCAN_SECONDS:
+                self.rebuild()
+            try:
+                size = os.path.getsize(self.path(name))
+            except FileNotFoundError:
+                # evicted by another worker as soon as it was stored
+                return evicted
+            self._touch(self.path(name))
+            self.total_bytes += size - self.entries.get(name, 0)
+            self.entries[name] = size
+            self.entries.move_to_end(name)
+            while self.total_bytes > self.max_bytes:
+                victim = self._victim(keep=name)
+                if victim is None:
+                    break
+                self.evicted_bytes += self.entries[victim]
+                self.evictions += 1
+                self.remove(victim)
+                evicted.append(victim)
+        for victim in evicted:
+            print(f"Removed file {victim} from the server to make space for new files.")
+        return evicted
+
+    def remove(self, name):
+        with self.lock:
+            size = self.entries.pop(name, None)
+            if size is not None:
+                self.total_bytes -= size
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'policy': self.policy,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'evicted_bytes': self.evicted_bytes,
+            'deduplicated': self.deduplicated,
+        }
+
+
+audio_cache = AudioCache(AUDIO_UPLOAD_DIR)
+
+
+def lookup_audio(name):
+    """
+    Path of the audio stored under a logical name, or None. A name whose file was
+    evicted is dropped.
+    """
+    entry = db.session.get(AudioName, name)
+    if entry is None:
+        audio_cache.record_miss()
+        return None
+    path = audio_cache.get(content_file(entry.content_hash))
+    if path is None:
+        db.session.delete(entry)
+        db.session.commit()
+    return path
+
+
+def _release(content_hash):
+    # delete a stored file once no logical name refers to it
+    if not AudioName.query.filter_by(content_hash=content_hash).first():
+        audio_cache.remove(content_file(content_hash))
+        print(f"Removed unreferenced audio {content_hash}")
+
+
+def _check_owner(name, owner_uid):
+    entry = db.session.get(AudioName, name)
+    if entry is not None and entry.owner_uid is not None and entry.owner_uid != owner_uid:
+        raise AudioUploadError("Audio name belongs to another account", 403)
+
+
+def _point_name(name, content_hash, transcoded, duplicate, owner_uid=None):
+    """
+    Index stored audio and point the logical name at it. Returns the upload result.
+    """
+    if duplicate:
+        audio_cache.deduplicated += 1
+    # evicts least recently used files once the directory is over its byte budget;
+    # the names of evicted audio go with it
+    evicted = audio_cache.put(content_file(content_hash))
+    if evicted:
+        AudioName.query.filter(AudioName.content_hash.in_(
+            [os.path.splitext(file_name)[0] for file_name in evicted]
+        )).delete(synchronize_session=False)
+
+    entry = db.session.get(AudioName, name)
+    previous = entry.content_hash if entry else None
+    if entry is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(AudioName(name=name, content_hash=content_hash, owner_uid=owner_uid))
+        except IntegrityError:
+            # a concurrent upload created the name first; this upload replaces it
+            entry = db.session.get(AudioName, name)
+            previous = entry.content_hash
+            entry.content_hash = content_hash
+    else:
+        entry.content_hash = content_hash
+    db.session.commit()
+    if previous and previous != content_hash:
+        _release(previous)
+    return {
+        'file_path': audio_cache.path(content_file(content_hash)),
+        'transcoded': transcoded,
+        'duplicate': duplicate
+    }
+
+
+def submit_audio(name, stream, owner_uid=None):
+    """
+    Receive an upload and store it by content under a logical name. MP3 is stored right
+    away and (result, None) returned; anything else is transcoded on the audio worker pool
+    and (None, job id) returned, the job's result being the same dict. Raises
+    AudioJobRejected when the pool's queue is full, and AudioUploadError (403) when the
+    name belongs to another owner. A new name is owned by owner_uid.
+    """
+    _check_owner(name, owner_uid)
+    temporary_path, content_hash, transcode = receive_audio(stream, audio_cache.directory)
+    if not transcode:
+        duplicate = commit_audio(temporary_path, content_hash, audio_cache.directory)
+        return _point_name(name, content_hash, False, duplicate, owner_uid), None
+
+    app = current_app._get_current_object()
+
+    def finish(result):
+        with app.app_context():
+            return _point_name(name, result[0], True, result[1], owner_uid)
+
+    def done(job):
+        with app.app_context():
+            _record_job(job)
+
+    job_id = uuid.uuid4().hex
+    _record_job({'job_id': job_id, 'status': 'queued', 'result': None, 'error': None})
+    try:
+        return None, audio_jobs.submit(_transcode_and_commit, temporary_path, audio_cache.directory,
+                                       finish=finish, done=done, job_id=job_id)
+    except Exception:
+        _discard(temporary_path)
+        AudioJob.query.filter_by(id=job_id).delete()
+        db.session.commit()
+        raise
+
+
+def _record_job(job):
+    # job status is kept in the database so every server process can report it
+    entry = db.session.get(AudioJob, job['job_id'])
+    if entry is None:
+        cutoff = datetime.utcnow() - timedelta(seconds=AUDIO_JOB_RETENTION)
+        AudioJob.query.filter(AudioJob.finished_at < cutoff).delete(synchronize_session=False)
+        entry = AudioJob(id=job['job_id'])
+        db.session.add(entry)
+    entry.status = job['status']
+    entry.error = job['error']
+    if job['status'] in ('done', 'failed'):
+        entry.file_path = job['result']['file_path'] if job['result'] else None
+        entry.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def audio_job_status(job_id):
+    """
+    A transcoding job as {'job_id', 'status', 'result', 'error'}, whichever server process
+    accepted it, or None if it is unknown or expired
+    """
+    job = audio_jobs.status(job_id)
+    if job is not None:
+        return job
+    entry = db.session.get(AudioJob, job_id)
+    if entry is None:
+        return None
+    return {
+        'job_id': entry.id,
+        'status': entry.status,
+        'result': {'file_path': entry.file_path} if entry.status == 'done' else None,
+        'error': entry.error
+    }
+
+
+def save_audio(name, stream, timeout=None):
+    """
+    Store an upload by content under a logical name, waiting up to timeout seconds for any
+    transcoding. Returns {'file_path', 'transcoded', 'duplicate'}. Raises AudioUploadError
+    (504) on timeout; the job carries on and points the name at the audio when it is done.
+    """
+    result, job_id = submit_audio(name, stream)
+    if job_id is None:
+        return result
+    job = audio_jobs.wait(job_id, timeout)
+    if job['status'] in ('queued', 'running'):
+        raise AudioUploadError(f"Audio job {job_id} did not finish within {timeout} seconds", 504)
+    if job['status'] != 'done':
+        raise AudioUploadError(job['error'] or "Failed to process audio file")
+    return job['result']
+
+
+def delete_audio(name, owner_uid):
+    """
+    Drop a logical name owned by owner_uid; the file goes once no other name refers to it.
+    Returns False if the name doesn't exist or isn't theirs.
+    """
+    entry = db.session.get(AudioName, name)
+    if entry is None or entry.owner_uid is None or entry.owner_uid != owner_uid:
+        return False
+    content_hash = entry.content_hash
+    db.session.delete(entry)
+    db.session.commit()
+    _release(content_hash)
+    return True
+
+
+def is_content_addressed(name):
+    return re.fullmatch(r"[0-9a-f]{64}\.mp3", name) is not None
+
+
+def stored_name(file_path):
+    """
+    The name of the stored file a client-supplied path refers to, or None if the path
+    points outside the audio directory
+    """
+    path = os.path.realpath(file_path)
+    if os.path.dirname(path) != os.path.realpath(audio_cache.directory):
+        return None
+    return os.path.basename(path)
+
+
+def send_audio(name, path):
+    """
+    Response for a stored file with conditional (ETag, Last-Modified) and Range support.
+    Full-file responses use the server's wsgi.file_wrapper, which sends with sendfile()
+    under gunicorn; with AUDIO_ACCEL_REDIRECT nginx serves the file and its ranges.
+    """
+    immutable = is_content_addressed(name)
+    if AUDIO_ACCEL_REDIRECT:
+        response = Response(mimetype='audio/mpeg')
+        response.headers['X-Accel-Redirect'] = AUDIO_ACCEL_REDIRECT + name
+        if immutable:
+            response.cache_control.public = True
+            response.cache_control.max_age = AUDIO_IMMUTABLE_MAX_AGE
+        else:
+            response.cache_control.no_cache = True
+    else:
+        # without a max_age send_file marks the response no-cache
+        response = send_file(path, mimetype='audio/mpeg', as_attachment=True, conditional=True,
+                             max_age=AUDIO_IMMUTABLE_MAX_AGE if immutable else None)
+    if immutable:
+        response.cache_control.immutable = True
+    return response
@@ -0,0 +1,83 @@
+"""
+Benchmark JSON serialization time and bytes on the wire for a 50-part story,
+comparing the stock Flask jsonify output with the FastJSONProvider + compression.
+
+Usage: python bench_serialization.py [--parts 50] [--repeat 200]
+"""
+import argparse
+import random
+import timeit
+from datetime import datetime, timedelta
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+from responses import FastJSONProvider, compress, brotli, orjson
+
+WORDS = ("dragon village friendly little mountain sparkly river brave laugh cloud whisper "
+         "moon forest giggle treasure wings glow gentle puzzle shimmering").split()
+
+
+def build_story_messages(parts):
+    """
+    Messages as returned by /get_conversation_messages for a story with the given number of parts
+    """
+    rng = random.Random(42)
+    created_at = datetime(2025, 1, 1, 12, 0, 0)
+    messages = []
+    message_id = 1
+    for part in range(1, parts + 1):
+        prompt = "Tell me a story about a friendly dragon" if part == 1 else "What happens next?"
+        story = " ".join(rng.choice(WORDS) for _ in range(100))
+        for sender_type, content in (
+                ("USER", prompt),
+                ("MODEL", f"TITLE: Sparky the Fire-Breathing Friend\n\n STORY, PART #{part}: {story}")):
+            messages.append({
+                'id': message_id,
+                'sender_type': sender_type,
+                'content': content,
+                'created_at': created_at.isoformat(),
+                'code': 2 if part == 1 else 3
+            })
+            message_id += 1
+            created_at += timedelta(seconds=30)
+    return {"messages": messages}
+
+
+def measure(name, app, payload, repeat):
+    with app.app_context():
+        body = app.json.response(payload).get_data()
+        seconds = timeit.timeit(lambda: app.json.response(payload).get_data(), number=repeat) / repeat
+    row = [name, f"{seconds * 1000:.3f}", len(body), len(compress(body, 'gzip'))]
+    row.append(len(compress(body, 'br')) if brotli is not None else '-')
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parts', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    payload = build_story_messages(args.parts)
+
+    # today's server runs with debug=True, where jsonify pretty-prints with sorted keys
+    debug_app = Flask(__name__)
+    debug_app.debug = True
+    debug_app.json = DefaultJSONProvider(debug_app)
+    stock_app = Flask(__name__)
+    stock_app.json = DefaultJSONProvider(stock_app)
+    fast_app = Flask(__name__)
+    fast_app.json = FastJSONProvider(fast_app)
+
+    rows = [
+        measure("jsonify (debug, current)", debug_app, payload, args.repeat),
+        measure("jsonify (compact)", stock_app, payload, args.repeat),
+        measure(f"FastJSONProvider ({'orjson' if orjson else 'json'})", fast_app, payload, args.repeat),
+    ]
+    print(f"{args.parts}-part story, {len(payload['messages'])} messages")
+    header = ["encoder", "ms/response", "raw bytes", "gzip bytes", "br bytes"]
+    widths = [max(len(str(row[i])) for row in rows + [header]) for i in range(len(header))]
+    for row in [header] + rows:
+        print("  ".join(str(value).ljust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == '__main__':
+    main()
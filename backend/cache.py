@@ -0,0 +1,248 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCacheBackend:
+    """
+    In-process LRU backend with a per-entry TTL and a maximum number of entries. Each worker
+    process has its own, so invalidations don't reach the others: only use it with one.
+    """
+    shared = False
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires_at, value)
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] is not None and entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def size(self):
+        return len(self.entries)
+
+
+class SqliteCacheBackend:
+    """
+    Shared backend stored in a local SQLite file, so every worker process on the host sees
+    the same entries and invalidations. Stands in for a networked cache such as Redis.
+    Values must be JSON serializable.
+    """
+    shared = True
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.evictions = 0
+        self.local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        if not hasattr(self.local, 'connection'):
+            self.local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+        return self.local.connection
+
+    def get(self, key):
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= now:
+            connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+            return None
+        connection.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        connection = self._connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), expires_at, now))
+        overflow = self.size() - self.max_entries
+        if overflow > 0:
+            connection.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed_at LIMIT ?)", (overflow,))
+            self.evictions += overflow
+
+    def delete(self, *keys):
+        connection = self._connection()
+        connection.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key in keys])
+
+    def size(self):
+        return self._connection().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class RedisCacheBackend:
+    """
+    Shared backend on a Redis server (requires the optional `redis` package); use it when
+    the workers run on more than one host
+    """
+    shared = True
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.evictions = 0  # evictions happen server side under Redis' maxmemory policy
+
+    def get(self, key):
+        value = self.client.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, json.dumps(value), ex=int(ttl) if ttl else None)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def size(self):
+        return self.client.dbsize()
+
+
+class ReadThroughCache:
+    """
+    Read-through cache for query results.
+
+    Entries are either invalidated by key, or grouped in a namespace (e.g. all list pages of
+    one user) that is invalidated at once by moving the namespace to a new version.
+    """
+    def __init__(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def _namespace_version(self, namespace):
+        version_key = f"ns:{namespace}"
+        version = self.backend.get(version_key)
+        if version is None:
+            # a fresh, unique version so entries from an evicted version are never reused
+            version = time.time_ns()
+            self.backend.set(version_key, version)
+        return version
+
+    def _key(self, key, namespace):
+        if namespace is None:
+            return key
+        return f"{namespace}@{self._namespace_version(namespace)}:{key}"
+
+    def get_or_load(self, key, loader, namespace=None, shared_only=False):
+        """
+        Return the cached value for key, calling loader() on a miss. None results are not cached.
+        With shared_only, the value is only cached by a backend shared between worker
+        processes; use it for values that must agree across workers, such as ETag versions.
+        """
+        if shared_only and not self.backend.shared:
+            return loader()
+        full_key = self._key(key, namespace)
+        value = self.backend.get(full_key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = loader()
+        if value is not None:
+            self.backend.set(full_key, value, self.ttl)
+        return value
+
+    def invalidate(self, *keys):
+        self.invalidations += len(keys)
+        self.backend.delete(*keys)
+
+    def invalidate_namespace(self, *namespaces):
+        for namespace in namespaces:
+            self.invalidations += 1
+            self.backend.set(f"ns:{namespace}", time.time_ns())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'entries': self.backend.size(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'invalidations': self.invalidations,
+            'evictions': self.backend.evictions,
+        }
+
+
+def create_read_cache():
+    """
+    Build the read cache from the READ_CACHE_* environment variables. The default SQLite
+    backend is shared by the worker processes on a host; use redis across hosts, and memory
+    only with a single worker process.
+    """
+    backend_name = os.getenv("READ_CACHE_BACKEND", "sqlite")
+    max_entries = int(os.getenv("READ_CACHE_MAX_ENTRIES", 1024))
+    ttl = int(os.getenv("READ_CACHE_TTL", 300))
+    if backend_name == "memory":
+        backend = MemoryCacheBackend(max_entries)
+    elif backend_name == "redis":
+        backend = RedisCacheBackend(os.getenv("READ_CACHE_URL", "redis://localhost:6379/0"))
+    else:
+        backend = SqliteCacheBackend(os.getenv("READ_CACHE_PATH", "read_cache.sqlite3"), max_entries)
+    return ReadThroughCache(backend, ttl)
+
+
+read_cache = create_read_cache()
+
+
+# Key helpers shared by the endpoints that read and the ones that invalidate
+
+def conversation_key(conversation_id):
+    return f"conversation:{int(conversation_id)}"
+
+
+def conversation_messages_key(conversation_id):
+    return f"conversation:{int(conversation_id)}:messages"
+
+
+def conversations_namespace(user_id):
+    return f"conversations:{user_id}"
+
+
+def assigned_namespace(parent_uid):
+    return f"assigned:{parent_uid}"
+
+
+def child_accounts_namespace(parent_uid):
+    return f"child_accounts:{parent_uid}"
@@ -5,10 +5,36 @@ import json
 from datetime import datetime, timedelta
 import jwt
 from db.db import db, ChildAccount
+from db.queries import child_accounts_query
+from principal_cache import principal_cache, child_token_subject
+from cache import read_cache, child_accounts_namespace
 
 # Secret key for JWT
 SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'dev_secret_key')
 
+def invalidate_child_accounts(*parent_uids):
+    """
+    Drop the cached child lists of the given parents in every worker process
+    """
+    read_cache.invalidate_namespace(*[child_accounts_namespace(parent_uid) for parent_uid in parent_uids])
+
+def get_child_accounts_for_parent(parent_uid):
+    """
+    Return the child accounts of a parent as a new list of dicts. The list is cached only
+    when the cache is shared by every worker, so a change is seen by all of them at once.
+    """
+    def load():
+        # Indexed on parent_uid, so the cost follows family size rather than total users
+        return [{
+            'username': account.username,
+            'display_name': account.display_name,
+            'age': account.age
+        } for account in child_accounts_query(parent_uid)]
+
+    accounts = read_cache.get_or_load("list", load, child_accounts_namespace(parent_uid), shared_only=True)
+    # a copy, so callers can't change what the cache holds
+    return [dict(account) for account in accounts]
+
 def save_child_account(username, pin, parent_uid, display_name, age):
     """
     Save a child account to the database
@@ -23,6 +49,7 @@ def save_child_account(username, pin, parent_uid, display_name, age):
         )
         db.session.add(child_account)
         db.session.commit()
+        invalidate_child_accounts(parent_uid)
         return True
     except Exception as e:
         db.session.rollback()
@@ -33,7 +60,7 @@ def verify_child_credentials(username, pin):
     """
     Verify child login credentials
     """
-    child_account = ChildAccount.query.filter_by(username=username, pin=pin).first()
+    child_account = ChildAccount.query.filter_by(username=username, pin=pin, deleted_at=None).first()
     if child_account:
         return {
             'pin': child_account.pin,
@@ -53,6 +80,7 @@ def generate_child_token(username, parent_uid, display_name, age):
         'display_name': display_name,
         'age': age,
         'is_child': True,
+        'iat': datetime.utcnow(),
         'exp': datetime.utcnow() + timedelta(days=1)  # Token expires in 1 day
     }
     return jwt.encode(payload, SECRET_KEY, algorithm='HS256')
@@ -86,8 +114,8 @@ def child_auth_required(f):
         # Extract the token
         token = auth_header.split('Bearer ')[1]
         
-        # Verify the token
-        child_data = verify_child_token(token)
+        # Verify the token, or reuse the result for a token we've already seen
+        child_data = principal_cache.verify(token, 'child', verify_child_token, child_token_subject)
         
         if not child_data:
             return jsonify({'error': 'Invalid or expired token'}), 401
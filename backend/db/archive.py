@@ -0,0 +1,294 @@
+import fcntl
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from db.db import db, Conversation, Message, SenderType, ArchivedConversation
+from db.unit_of_work import commit_or_defer, after_commit
+from db.queries import conversation_messages_query
+
+# Optional dependency; only needed once conversations have been archived
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Segment files live under this directory as <user>/<YYYY-MM>/<segment>.parquet
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# Conversations without messages for this many days are moved out of the message table
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 120))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", 200))
+# Parsed segments kept in memory per process
+ARCHIVE_SEGMENT_CACHE_SIZE = int(os.getenv("ARCHIVE_SEGMENT_CACHE_SIZE", 32))
+
+_lock = threading.Lock()
+_segments = OrderedDict()  # (segment, mtime) -> pyarrow.Table
+
+
+def _require_pyarrow():
+    if pyarrow is None:
+        raise RuntimeError("Archived conversations need the pyarrow package")
+
+
+def _segment_path(segment):
+    return os.path.join(ARCHIVE_DIR, segment)
+
+
+def _read_segment(segment):
+    _require_pyarrow()
+    path = _segment_path(segment)
+    key = (segment, os.path.getmtime(path))
+    with _lock:
+        table = _segments.get(key)
+        if table is not None:
+            _segments.move_to_end(key)
+            return table
+    table = pyarrow.parquet.read_table(path)
+    with _lock:
+        _segments[key] = table
+        while len(_segments) > ARCHIVE_SEGMENT_CACHE_SIZE:
+            _segments.popitem(last=False)
+    return table
+
+
+def _write_segment(segment, rows):
+    _require_pyarrow()
+    path = _segment_path(segment)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pyarrow.Table.from_pylist(rows, schema=pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('conversation_id', pyarrow.int64()),
+        ('sender_type', pyarrow.string()),
+        ('code', pyarrow.int32()),
+        ('content', pyarrow.string()),
+        ('created_at', pyarrow.timestamp('us')),
+    ]))
+    # write next to the target and rename, so readers never see a partial file
+    temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    pyarrow.parquet.write_table(table, temporary_path, compression='zstd')
+    os.replace(temporary_path, path)
+
+
+def _drop_from_segment(segment, conversation_ids):
+    """
+    Rewrite a segment without the given conversations, removing it once it is empty
+    """
+    _require_pyarrow()
+    path = _segment_path(segment)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(ARCHIVE_DIR, '.lock'), 'w') as lock_file:
+        # segments are shared between worker processes and the archiver
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            return
+        table = pyarrow.parquet.read_table(path)
+        keep = pyarrow.compute.invert(pyarrow.compute.is_in(
+            table['conversation_id'], value_set=pyarrow.array(list(conversation_ids), pyarrow.int64())))
+        remaining = table.filter(keep)
+        if remaining.num_rows:
+            _write_segment(segment, remaining.to_pylist())
+        else:
+            os.remove(path)
+
+
+def _user_directory(user_id):
+    return re.sub(r"[^A-Za-z0-9_-]", "_", user_id) or "_"
+
+
+def load_archived_messages(entry):
+    """
+    Read an archived conversation's messages back as detached Message objects in creation order
+    """
+    table = _read_segment(entry.segment)
+    rows = table.filter(pyarrow.compute.equal(table['conversation_id'], entry.conversation_id)).to_pylist()
+    messages = []
+    for row in sorted(rows, key=lambda row: (row['created_at'], row['id'])):
+        message = Message(
+            id=row['id'],
+            conversation_id=row['conversation_id'],
+            sender_type=SenderType[row['sender_type']],
+            code=row['code'],
+            created_at=row['created_at']
+        )
+        # set the column directly; these objects are never written back
+        message._content = row['content']
+        messages.append(message)
+    return messages
+
+
+def conversation_messages(conversation_id):
+    """
+    Messages of a conversation in creation order, from the message table or its archive segment
+    """
+    entry = db.session.get(ArchivedConversation, conversation_id)
+    if entry is None:
+        return conversation_messages_query(conversation_id).all()
+    return load_archived_messages(entry)
+
+
+def is_archived(conversation_id):
+    return db.session.get(ArchivedConversation, conversation_id) is not None
+
+
+def restore_conversation(conversation_id):
+    """
+    Move an archived conversation back into the message table before it is written to.
+    Returns True if it was archived.
+    """
+    entry = db.session.get(ArchivedConversation, conversation_id)
+    if entry is None:
+        return False
+    segment = entry.segment
+    try:
+        with db.session.begin_nested():
+            for archived in load_archived_messages(entry):
+                db.session.add(Message(
+                    id=archived.id,
+                    conversation_id=archived.conversation_id,
+                    sender_type=archived.sender_type,
+                    code=archived.code,
+                    content=archived.content,
+                    created_at=archived.created_at
+                ))
+            db.session.delete(entry)
+    except IntegrityError:
+        # another request restored it first
+        return True
+    commit_or_defer()
+    print(f"Restored archived conversation {conversation_id}")
+    # the segment copy is only dropped once the rows are safely back in the message table
+    after_commit(lambda: _drop_from_segment(segment, [conversation_id]))
+    return True
+
+
+def _archive_group(user_id, month, conversations):
+    """
+    Write one segment for a user's conversations from one month and drop their messages
+    from the hot table. Conversations that got new messages meanwhile stay hot.
+    """
+    versions = {conversation.id: conversation.version for conversation in conversations}
+    messages = Message.query.filter(Message.conversation_id.in_(list(versions))) \
+        .order_by(Message.conversation_id, Message.id).all()
+    rows = [{
+        'id': message.id,
+        'conversation_id': message.conversation_id,
+        'sender_type': message.sender_type.name,
+        'code': message.code,
+        'content': message.content,
+        'created_at': message.created_at
+    } for message in messages]
+    segment = f"{_user_directory(user_id)}/{month}/{int(time.time())}-{uuid.uuid4().hex[:8]}.parquet"
+    _write_segment(segment, rows)
+
+    # the segment is durable; now swap the hot rows for manifest entries in one transaction,
+    # locking the conversations so log_message can't add a message halfway through
+    locked = Conversation.query.filter(Conversation.id.in_(list(versions))) \
+        .with_for_update().populate_existing().all()
+    archived_ids = [
+        conversation.id for conversation in locked
+        if conversation.version == versions[conversation.id] and conversation.deleted_at is None
+    ]
+    for conversation_id in archived_ids:
+        conversation_rows = [row for row in rows if row['conversation_id'] == conversation_id]
+        first_story = next((row for row in conversation_rows if row['sender_type'] == SenderType.MODEL.name), None)
+        db.session.add(ArchivedConversation(
+            conversation_id=conversation_id,
+            user_id=user_id,
+            segment=segment,
+            message_count=len(conversation_rows),
+            preview=first_story['content'][:101] if first_story else None
+        ))
+    if archived_ids:
+        Message.query.filter(Message.conversation_id.in_(archived_ids)).delete(synchronize_session=False)
+    db.session.commit()
+
+    skipped = set(versions) - set(archived_ids)
+    if skipped:
+        _drop_from_segment(segment, skipped)
+    return len(archived_ids)
+
+
+def archive_cold_conversations(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move conversations whose last message is older than older_than_days into Parquet
+    segments, batch_size conversations at a time. Returns the number archived.
+    """
+    _require_pyarrow()
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+    total = 0
+    last_id = 0
+    while True:
+        # walk the live conversations by id, so each batch only aggregates its own messages
+        page = db.session.scalars(
+            db.select(Conversation.id)
+            .where(Conversation.id > last_id, Conversation.deleted_at.is_(None))
+            .order_by(Conversation.id).limit(batch_size)
+        ).all()
+        if not page:
+            return total
+        last_id = page[-1]
+        # conversations already archived have no rows left in the message table
+        cold_ids = db.select(Message.conversation_id) \
+            .where(Message.conversation_id.in_(page)) \
+            .group_by(Message.conversation_id) \
+            .having(db.func.max(Message.created_at) < cutoff)
+        candidates = Conversation.query.filter(Conversation.id.in_(cold_ids)) \
+            .order_by(Conversation.user_id, Conversation.created_at).all()
+        if not candidates:
+            continue
+        groups = OrderedDict()
+        for conversation in candidates:
+            month = conversation.created_at.strftime('%Y-%m')
+            groups.setdefault((conversation.user_id, month), []).append(conversation)
+        for (user_id, month), conversations in groups.items():
+            # conversations that got new messages while we were writing stay hot until the next run
+            total += _archive_group(user_id, month, conversations)
+        print(f"Archived {total} conversations so far")
+
+
+def purge_batch(batch_size):
+    """
+    Remove soft-deleted conversations from their segments and the manifest.
+    Returns the number of conversations removed.
+    """
+    entries = ArchivedConversation.query.join(
+        Conversation, Conversation.id == ArchivedConversation.conversation_id
+    ).filter(Conversation.deleted_at.isnot(None)).limit(batch_size).all()
+    segments = OrderedDict()
+    for entry in entries:
+        segments.setdefault(entry.segment, []).append(entry.conversation_id)
+    for segment, conversation_ids in segments.items():
+        _drop_from_segment(segment, conversation_ids)
+    conversation_ids = [entry.conversation_id for entry in entries]
+    if conversation_ids:
+        ArchivedConversation.query.filter(
+            ArchivedConversation.conversation_id.in_(conversation_ids)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+    return len(conversation_ids)
+
+
+if __name__ == '__main__':
+    # python -m db.archive run [days] | restore <conversation_id>
+    from flask import Flask
+    from dotenv import load_dotenv
+    from db.db import init_db
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
+    app = Flask(__name__)
+    init_db(app)
+    with app.app_context():
+        if len(sys.argv) > 1 and sys.argv[1] == 'run':
+            days = int(sys.argv[2]) if len(sys.argv) > 2 else ARCHIVE_AFTER_DAYS
+            print(f"Archived {archive_cold_conversations(days)} conversations")
+        elif len(sys.argv) > 2 and sys.argv[1] == 'restore':
+            restore_conversation(int(sys.argv[2]))
+        else:
+            print("Usage: python -m db.archive run [days] | restore <conversation_id>")
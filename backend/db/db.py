@@ -2,8 +2,10 @@ from flask_sqlalchemy import SQLAlchemy
 import os
 from sqlalchemy import Enum, inspect
 import enum
+from db.routing import RoutingSession, router
 
-db = SQLAlchemy()
+# RoutingSession lets read-only endpoints read from replicas (see db/routing.py)
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 
 class SenderType(enum.Enum):
@@ -26,6 +28,16 @@ class Conversation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     user_id = db.Column(db.String(255), nullable=False)
+    # set when the conversation is deleted; the row is purged later by db/purge.py
+    deleted_at = db.Column(db.DateTime, nullable=True)
+    # bumped on every new message, used to build ETags without reading messages
+    version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        # list endpoints filter by user and order by newest first
+        db.Index('ix_conversation_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_conversation_deleted_at', 'deleted_at'),
+    )
 
 
 class Message(db.Model):
@@ -34,12 +46,44 @@ class Message(db.Model):
         'conversation.id'), nullable=False)
     sender_type = db.Column(Enum(SenderType), nullable=False)
     code = db.Column(db.Integer, nullable=False)
-    content = db.Column(db.String(5000), nullable=False)
+    _content = db.Column('content', db.String(5000), nullable=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    # zstd-compressed content and the dictionary it was compressed with; when set,
+    # the content column holds an empty string (see db/story_compression.py)
+    content_zstd = db.Column(db.LargeBinary, nullable=True)
+    content_dict_id = db.Column(db.Integer, nullable=True)
+    # body kept once in the shared story_content store (see db/story_cache.py); when set,
+    # the content column holds an empty string
+    content_id = db.Column(db.Integer, db.ForeignKey('story_content.id'), nullable=True)
+    shared_content = db.relationship('StoryContent', lazy='joined')
+
+    def _get_content(self):
+        if self.content_id is not None:
+            return self.shared_content.body
+        # decompressed lazily, only when the content is actually read
+        if self.content_zstd is None:
+            return self._content
+        from db.story_compression import decompress_content
+        return decompress_content(self.content_zstd, self.content_dict_id)
+
+    def _set_content(self, value):
+        from db.story_compression import compress_content
+        self.content_zstd, self.content_dict_id = compress_content(value)
+        self._content = '' if self.content_zstd is not None else value
+
+    content = db.synonym('_content', descriptor=property(_get_content, _set_content))
 
     conversation = db.relationship(
         'Conversation', backref=db.backref('messages', lazy=True))
 
+    __table_args__ = (
+        # message fetches filter by conversation and order by creation time
+        db.Index('ix_message_conversation_id_created_at', 'conversation_id', 'created_at'),
+        # delta sync reads the messages after a known id
+        db.Index('ix_message_conversation_id_id', 'conversation_id', 'id'),
+        db.Index('ix_message_content_id', 'content_id'),
+    )
+
 
 class ChildAccount(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -49,6 +93,12 @@ class ChildAccount(db.Model):
     age = db.Column(db.Integer, nullable=False)
     parent_uid = db.Column(db.String(255), nullable=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    # set when the parent account is deleted; the row is purged later by db/purge.py
+    deleted_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_child_account_parent_uid', 'parent_uid'),
+    )
 
 
 class StoryAssignment(db.Model):
@@ -59,11 +109,140 @@ class StoryAssignment(db.Model):
         'child_account.username'), nullable=False)
     title = db.Column(db.String(255), nullable=False)
     assigned_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    # sha256 of the story text and the conversation version it was taken at, so the
+    # narration can be found without reading the story again (see narration.py)
+    story_digest = db.Column(db.String(64), nullable=True)
+    story_digest_version = db.Column(db.Integer, nullable=True)
     conversation = db.relationship(
         'Conversation', backref=db.backref('story_assignments', lazy=True))
     child_account = db.relationship(
         'ChildAccount', backref=db.backref('assigned_stories', lazy=True))
 
+    __table_args__ = (
+        # assigned stories are listed per child in assignment order
+        db.Index('ix_story_assignment_child_username_assigned_at', 'child_username', 'assigned_at'),
+    )
+
+
+class CompressionDictionary(db.Model):
+    # zstd dictionaries trained on our own stories; rows are never changed once written
+    # because compressed messages reference them by id
+    id = db.Column(db.Integer, primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+    sample_count = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+
+class StoryContent(db.Model):
+    # generated story bodies stored once and referenced by messages and the generation cache
+    id = db.Column(db.Integer, primary_key=True)
+    content_hash = db.Column(db.String(64), unique=True, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+
+class GenerationCache(db.Model):
+    # writer output for a canonical prompt hash, reused under the policy in db/story_cache.py
+    id = db.Column(db.Integer, primary_key=True)
+    prompt_hash = db.Column(db.String(64), unique=True, nullable=False)
+    content_id = db.Column(db.Integer, db.ForeignKey(
+        'story_content.id'), nullable=False)
+    reuse_count = db.Column(db.Integer, nullable=False, default=0)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    content = db.relationship('StoryContent')
+
+
+class GenerationCacheUse(db.Model):
+    # which accounts have been served a cached story body
+    id = db.Column(db.Integer, primary_key=True)
+    content_id = db.Column(db.Integer, db.ForeignKey(
+        'story_content.id'), nullable=False)
+    user_id = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    __table_args__ = (
+        db.Index('ix_generation_cache_use_content_id_user_id', 'content_id', 'user_id'),
+    )
+
+
+class ArchivedConversation(db.Model):
+    # manifest of conversations whose messages were moved to Parquet segments (see db/archive.py)
+    conversation_id = db.Column(db.Integer, db.ForeignKey(
+        'conversation.id'), primary_key=True)
+    user_id = db.Column(db.String(255), nullable=False)
+    # segment file path relative to ARCHIVE_DIR
+    segment = db.Column(db.String(512), nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    # start of the first story, so assignment lists don't have to open the segment
+    preview = db.Column(db.String(101), nullable=True)
+    archived_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    __table_args__ = (
+        db.Index('ix_archived_conversation_user_id', 'user_id'),
+        db.Index('ix_archived_conversation_segment', 'segment'),
+    )
+
+
+class SearchTerm(db.Model):
+    # inverted index over story titles and bodies, one posting per (conversation, term);
+    # maintained by db/search.py when story messages are logged
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.String(255), nullable=False)
+    term = db.Column(db.String(64), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey(
+        'conversation.id'), nullable=False)
+    weight = db.Column(db.Integer, nullable=False, default=1)
+    # first message of the conversation with the term, which search snippets are cut from
+    message_id = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        # search looks up term prefixes within one user's stories
+        db.Index('ix_search_term_user_id_term', 'user_id', 'term'),
+        db.Index('ix_search_term_conversation_id_term', 'conversation_id', 'term'),
+    )
+
+
+class AudioName(db.Model):
+    # logical audio names (the app's upload filename) mapped to the stored file, which is
+    # named after the sha256 of its content; see audio_store.py
+    name = db.Column(db.String(255), primary_key=True)
+    content_hash = db.Column(db.String(64), nullable=False)
+    # Firebase uid of the parent who uploaded it; None for narrations and anonymous uploads,
+    # which can't be deleted through the API
+    owner_uid = db.Column(db.String(128), nullable=True)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    __table_args__ = (
+        db.Index('ix_audio_name_content_hash', 'content_hash'),
+    )
+
+
+class AudioJob(db.Model):
+    # status of transcoding jobs, so any server process can answer /audio_jobs/<id>
+    # (see audio_jobs.py and audio_store.py)
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), nullable=False)
+    file_path = db.Column(db.String(255), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class SyncWatermark(db.Model):
+    # how far a sync job has processed its source, e.g. Firebase users changed up to synced_until
+    name = db.Column(db.String(64), primary_key=True)
+    synced_until = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, default=db.func.current_timestamp(),
+                           onupdate=db.func.current_timestamp())
+
+
+class SchemaVersion(db.Model):
+    # single row holding the version of the last applied migration (see db/migrations.py)
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    applied_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
 
 def init_db(app):
     db_user = os.getenv("DB_USER")
@@ -71,18 +250,35 @@ def init_db(app):
     db_host = os.getenv("DB_HOST")
     db_name = os.getenv("DB_NAME")
 
+    # Read replicas share the primary's credentials and database name
+    replica_hosts = [host for host in os.getenv("DB_REPLICA_HOSTS", "").split(",") if host]
+
     print(f"Connecting to database at {db_host} with user {db_user}")
     print(f"Using database {db_name}")
 
     app.config['SQLALCHEMY_DATABASE_URI'] = (
         f"mysql+mysqlconnector://{db_user}:{db_password}@{db_host}/{db_name}"
     )
+    replica_urls = [
+        f"mysql+mysqlconnector://{db_user}:{db_password}@{host}/{db_name}" for host in replica_hosts
+    ]
+    # Full URLs override the MySQL settings, e.g. two SQLite files for local testing
+    if os.getenv("DATABASE_URL"):
+        app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL")
+    if os.getenv("DATABASE_REPLICA_URLS"):
+        replica_urls = os.getenv("DATABASE_REPLICA_URLS").split(",")
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     db.init_app(app)
+    router.configure(replica_urls)
     with app.app_context():
         inspector=inspect(db.engine)
         for table_name in db.metadata.tables.keys():
             if not inspector.has_table(table_name):
                 print(f"Creating table: {table_name}")
                 db.create_all()
+        # bring existing databases up to the current schema version
+        from db.migrations import run_migrations, check_schema_version
+        if os.getenv("DB_AUTO_MIGRATE", "1") == "1":
+            run_migrations(db.engine)
+        check_schema_version(db.engine)
         print("Database setup completed!")
@@ -0,0 +1,169 @@
+import os
+from flask import current_app
+from db.db import db, Conversation, Message, StoryAssignment, StoryContent, ArchivedConversation
+from db.queries import child_accounts_query
+from db.archive import load_archived_messages
+from db.search import split_title
+from db.story_compression import decompress_content
+
+# Conversations read per page, with their messages and assignments
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 100))
+
+messages_table = Message.__table__
+
+
+def _shared_bodies(rows):
+    """
+    Map content id -> body for the shared story bodies a chunk of rows refers to, in one query
+    """
+    content_ids = {row.content_id for row in rows if row.content_id is not None}
+    if not content_ids:
+        return {}
+    return dict(db.session.execute(
+        db.select(StoryContent.id, StoryContent.body).where(StoryContent.id.in_(content_ids))
+    ).all())
+
+
+def _message_content(row, bodies):
+    # the same resolution as Message.content, for rows read without the ORM
+    if row.content_id is not None:
+        return bodies[row.content_id]
+    if row.content_zstd is not None:
+        return decompress_content(row.content_zstd, row.content_dict_id)
+    return row.content
+
+
+def _build_parts(messages):
+    """
+    Pair each prompt with the story part that answered it. messages are
+    (id, sender_type name, code, content, created_at) tuples in id order.
+    """
+    parts = []
+    for message_id, sender_type, code, content, created_at in messages:
+        if sender_type == 'USER' or not parts or parts[-1]['story'] is not None:
+            parts.append({
+                'number': len(parts) + 1,
+                'code': code,
+                'prompt': None,
+                'prompt_message_id': None,
+                'story': None,
+                'story_message_id': None,
+                'created_at': created_at.isoformat()
+            })
+        if sender_type == 'USER':
+            parts[-1].update(prompt=content, prompt_message_id=message_id)
+        else:
+            parts[-1].update(story=content, story_message_id=message_id, code=code)
+    return parts
+
+
+def _record(conversation, messages):
+    first_story = next((content for _, sender_type, _, content, _ in messages if sender_type == 'MODEL'), None)
+    return {
+        'type': 'conversation',
+        'conversation_id': conversation.id,
+        'user_id': conversation.user_id,
+        'created_at': conversation.created_at.isoformat(),
+        'title': split_title(first_story)[0] if first_story else None,
+        'parts': _build_parts(messages),
+        'assignments': []
+    }
+
+
+def _with_assignments(records):
+    """
+    Fill in the assignments of a batch of records with one query
+    """
+    by_id = {record['conversation_id']: record for record in records}
+    assignments = StoryAssignment.query.filter(StoryAssignment.conversation_id.in_(list(by_id))) \
+        .order_by(StoryAssignment.id).all()
+    for assignment in assignments:
+        by_id[assignment.conversation_id]['assignments'].append({
+            'child_username': assignment.child_username,
+            'title': assignment.title,
+            'assigned_at': assignment.assigned_at.isoformat()
+        })
+    return records
+
+
+def iter_conversations(user_id=None, after_id=0, engine=None):
+    """
+    Yield one export record per live conversation with an id above after_id, in id order;
+    pass the last conversation_id received as after_id to resume. Conversations are read
+    in keyset pages of EXPORT_BATCH_SIZE (id > last id of the previous page), each page's
+    messages with one more query, so memory is bounded by one page whatever the library
+    size. With user_id None every user's conversations are exported.
+    """
+    page_statement = db.select(
+        Conversation.id, Conversation.user_id, Conversation.created_at, ArchivedConversation.segment
+    ).select_from(Conversation) \
+        .outerjoin(ArchivedConversation, ArchivedConversation.conversation_id == Conversation.id) \
+        .where(Conversation.deleted_at.is_(None)) \
+        .order_by(Conversation.id).limit(EXPORT_BATCH_SIZE)
+    if user_id is not None:
+        page_statement = page_statement.where(Conversation.user_id == user_id)
+
+    # conversations and messages come from the given engine (a read replica for the
+    # endpoints); content, archive and assignment lookups use the session's
+    with (engine or db.engine).connect() as connection:
+        last_id = after_id
+        while True:
+            conversations = connection.execute(page_statement.where(Conversation.id > last_id)).all()
+            if not conversations:
+                return
+            last_id = conversations[-1].id
+            rows = connection.execute(db.select(
+                messages_table.c.id, messages_table.c.conversation_id, messages_table.c.sender_type,
+                messages_table.c.code, messages_table.c.content, messages_table.c.content_zstd,
+                messages_table.c.content_dict_id, messages_table.c.content_id, messages_table.c.created_at
+            ).where(
+                messages_table.c.conversation_id.in_([conversation.id for conversation in conversations])
+            ).order_by(messages_table.c.conversation_id, messages_table.c.id)).all()
+            # shared bodies are looked up once per page rather than per message
+            bodies = _shared_bodies(rows)
+            messages = {}
+            for row in rows:
+                messages.setdefault(row.conversation_id, []).append(
+                    (row.id, row.sender_type.name, row.code, _message_content(row, bodies), row.created_at))
+
+            records = []
+            for conversation in conversations:
+                if conversation.segment is not None:
+                    entry = db.session.get(ArchivedConversation, conversation.id)
+                    conversation_messages = [
+                        (message.id, message.sender_type.name, message.code, message.content, message.created_at)
+                        for message in load_archived_messages(entry)
+                    ]
+                else:
+                    conversation_messages = messages.get(conversation.id, [])
+                records.append(_record(conversation, conversation_messages))
+            yield from _with_assignments(records)
+
+
+def iter_account_export(user_id, after_id=0, engine=None):
+    """
+    Yield everything stored for an account: its child accounts (on the first page only)
+    followed by its conversations as in iter_conversations
+    """
+    if not after_id:
+        for child in child_accounts_query(user_id):
+            yield {
+                'type': 'child_account',
+                'username': child.username,
+                'display_name': child.display_name,
+                'age': child.age,
+                'created_at': child.created_at.isoformat()
+            }
+    yield from iter_conversations(user_id, after_id, engine)
+
+
+def ndjson_lines(records):
+    """
+    Serialize records as NDJSON lines for a streaming response. An error mid-stream ends
+    the response early; clients resume from the last conversation_id they received.
+    """
+    try:
+        for record in records:
+            yield current_app.json.dumps(record) + "\n"
+    except Exception as e:
+        print(f"Error streaming export: {e}")
@@ -0,0 +1,243 @@
+import sys
+from sqlalchemy import inspect, text
+from db.db import (
+    db, Conversation, Message, ChildAccount, StoryAssignment, SchemaVersion, CompressionDictionary,
+    SearchTerm, StoryContent, GenerationCache, GenerationCacheUse, ArchivedConversation, SyncWatermark,
+    AudioName, AudioJob
+)
+from db.queries import (
+    assigned_stories_list_query, conversations_query, conversation_messages_query, message_delta_query,
+    child_accounts_query
+)
+
+
+def _create_index(connection, model, index_name):
+    """
+    Create one of the indexes declared in a model's __table_args__ if it is missing
+    """
+    table = model.__table__
+    existing = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+    if index_name in existing:
+        print(f"Index {index_name} already exists on {table.name}")
+        return
+    index = next(index for index in table.indexes if index.name == index_name)
+    print(f"Creating index {index_name} on {table.name}")
+    index.create(connection)
+
+
+def _add_column(connection, model, column_name):
+    """
+    Add a column declared on a model to an existing table if it is missing
+    """
+    table = model.__table__
+    existing = {column['name'] for column in inspect(connection).get_columns(table.name)}
+    if column_name in existing:
+        print(f"Column {column_name} already exists on {table.name}")
+        return
+    column = table.columns[column_name]
+    column_type = column.type.compile(dialect=connection.dialect)
+    nullable = "" if column.nullable else " NOT NULL"
+    default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+    print(f"Adding column {column_name} to {table.name}")
+    connection.execute(text(
+        f"ALTER TABLE {table.name} ADD COLUMN {column_name} {column_type}{nullable}{default}"))
+
+
+def _add_list_indexes(connection):
+    _create_index(connection, Conversation, 'ix_conversation_user_id_created_at')
+    _create_index(connection, Message, 'ix_message_conversation_id_created_at')
+    _create_index(connection, ChildAccount, 'ix_child_account_parent_uid')
+    _create_index(connection, StoryAssignment, 'ix_story_assignment_child_username_assigned_at')
+
+
+def _add_soft_delete(connection):
+    _add_column(connection, Conversation, 'deleted_at')
+    _add_column(connection, ChildAccount, 'deleted_at')
+    _create_index(connection, Conversation, 'ix_conversation_deleted_at')
+
+
+def _add_conversation_version(connection):
+    _add_column(connection, Conversation, 'version')
+
+
+def _add_message_delta_index(connection):
+    _create_index(connection, Message, 'ix_message_conversation_id_id')
+
+
+def _add_content_compression(connection):
+    _add_column(connection, Message, 'content_zstd')
+    _add_column(connection, Message, 'content_dict_id')
+    CompressionDictionary.__table__.create(connection, checkfirst=True)
+
+
+def _add_search_index(connection):
+    # existing stories are indexed with `python -m db.search reindex`
+    SearchTerm.__table__.create(connection, checkfirst=True)
+
+
+def _add_story_cache(connection):
+    StoryContent.__table__.create(connection, checkfirst=True)
+    GenerationCache.__table__.create(connection, checkfirst=True)
+    GenerationCacheUse.__table__.create(connection, checkfirst=True)
+    _add_column(connection, Message, 'content_id')
+    _create_index(connection, Message, 'ix_message_content_id')
+
+
+def _add_archive_manifest(connection):
+    ArchivedConversation.__table__.create(connection, checkfirst=True)
+
+
+def _add_sync_watermark(connection):
+    SyncWatermark.__table__.create(connection, checkfirst=True)
+
+
+def _add_audio_names(connection):
+    AudioName.__table__.create(connection, checkfirst=True)
+
+
+def _add_audio_owner(connection):
+    _add_column(connection, AudioName, 'owner_uid')
+
+
+def _add_audio_jobs(connection):
+    AudioJob.__table__.create(connection, checkfirst=True)
+
+
+def _add_story_digest(connection):
+    _add_column(connection, StoryAssignment, 'story_digest')
+    _add_column(connection, StoryAssignment, 'story_digest_version')
+
+
+def _add_search_term_message(connection):
+    # existing postings get it from `python -m db.search reindex`
+    _add_column(connection, SearchTerm, 'message_id')
+
+
+# Ordered list of (version, description, function). Append new migrations to the end
+# and never renumber or edit one that has already shipped.
+MIGRATIONS = [
+    (1, "composite indexes for the list endpoint access paths", _add_list_indexes),
+    (2, "soft-delete columns for conversations and child accounts", _add_soft_delete),
+    (3, "conversation version counter for ETags", _add_conversation_version),
+    (4, "message index for delta sync range scans", _add_message_delta_index),
+    (5, "compressed message content and compression dictionaries", _add_content_compression),
+    (6, "inverted index for story search", _add_search_index),
+    (7, "generation cache and shared story content store", _add_story_cache),
+    (8, "manifest of conversations archived to Parquet segments", _add_archive_manifest),
+    (9, "watermark for incremental child account sync", _add_sync_watermark),
+    (10, "logical names for content-addressed audio", _add_audio_names),
+    (11, "owner of each logical audio name", _add_audio_owner),
+    (12, "transcoding job status shared between server processes", _add_audio_jobs),
+    (13, "story text digest on assignments for narration lookups", _add_story_digest),
+    (14, "message of each search posting for snippets", _add_search_term_message),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(connection):
+    """
+    Return the version recorded in the schema_version table (0 if none)
+    """
+    if not inspect(connection).has_table(SchemaVersion.__tablename__):
+        return 0
+    row = connection.execute(
+        SchemaVersion.__table__.select().order_by(SchemaVersion.__table__.c.version.desc())
+    ).first()
+    return row.version if row else 0
+
+
+def run_migrations(engine):
+    """
+    Apply every migration newer than the database's schema version, each in its own transaction
+    """
+    with engine.begin() as connection:
+        SchemaVersion.__table__.create(connection, checkfirst=True)
+        current = get_schema_version(connection)
+
+    for version, description, migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        print(f"Applying migration {version}: {description}")
+        with engine.begin() as connection:
+            migrate(connection)
+            connection.execute(SchemaVersion.__table__.delete())
+            connection.execute(SchemaVersion.__table__.insert().values(version=version))
+        current = version
+    print(f"Database schema is at version {current}")
+    return current
+
+
+def check_schema_version(engine):
+    """
+    Refuse to start against a database whose schema version differs from this code's
+    """
+    with engine.connect() as connection:
+        current = get_schema_version(connection)
+    if current != SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema version is {current} but the application expects {SCHEMA_VERSION}. "
+            "Run the migrations with `python -m db.migrations` before starting the server."
+        )
+
+
+def list_queries():
+    """
+    The queries behind the list endpoints, keyed by a readable name, used for plan checks.
+    Each is built by the same function the endpoint uses, so the plans can't drift apart.
+    """
+    from db.search import matching_postings
+    return {
+        'get_conversations': conversations_query('uid'),
+        'get_conversation_messages': conversation_messages_query(1),
+        'get_conversation_messages_delta': message_delta_query(1, 1),
+        'get_child_accounts': child_accounts_query('uid'),
+        'get_assigned_stories': assigned_stories_list_query('child'),
+        'search_stories': matching_postings('uid', ['dragon']),
+    }
+
+
+def _is_full_scan(dialect_name, plan_rows):
+    if dialect_name == 'sqlite':
+        # EXPLAIN QUERY PLAN reports "SCAN <table>" without an index for full scans
+        return any(
+            row[-1].startswith('SCAN') and 'USING' not in row[-1] for row in plan_rows
+        )
+    # MySQL reports access type ALL for full table scans
+    return any(row._mapping.get('type') == 'ALL' for row in plan_rows)
+
+
+def check_query_plans(engine):
+    """
+    EXPLAIN every list query and return the names of those that fall back to a full scan
+    """
+    explain = 'EXPLAIN QUERY PLAN' if engine.dialect.name == 'sqlite' else 'EXPLAIN'
+    full_scans = []
+    with engine.connect() as connection:
+        for name, query in list_queries().items():
+            sql = str(query.statement.compile(
+                dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+            plan_rows = connection.execute(text(f"{explain} {sql}")).fetchall()
+            if _is_full_scan(engine.dialect.name, plan_rows):
+                print(f"Full scan in {name}: {plan_rows}")
+                full_scans.append(name)
+    return full_scans
+
+
+if __name__ == '__main__':
+    # python -m db.migrations [--check-plans]
+    from flask import Flask
+    from dotenv import load_dotenv
+    import os
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
+    os.environ["DB_AUTO_MIGRATE"] = "1"
+    app = Flask(__name__)
+    from db.db import init_db
+    init_db(app)
+    if '--check-plans' in sys.argv:
+        with app.app_context():
+            full_scans = check_query_plans(db.engine)
+        if full_scans:
+            print(f"Query plans with full scans: {', '.join(full_scans)}")
+            sys.exit(1)
+        print("All list queries use an index")
@@ -4,10 +4,12 @@
 # In[ ]:
 
 
+# run from backend/ (python -m db.process_model_data) so the db package resolves
 import mysql.connector
 from mysql.connector import Error
 import pandas as pd
-from db import db, Conversation, Message, SenderType
+from db.db import init_db
+from db.export import iter_conversations
 from flask import Flask
 from dotenv import load_dotenv
 import os
@@ -28,58 +30,31 @@ database = os.getenv("DB_NAME")
 # In[12]:
 
 
-try:
-    # Establish the connection
-    connection = mysql.connector.connect(
-        host=host,
-        database=database,
-        user=user,
-        password=password
-    )
-
-    if connection.is_connected():
-        print("Connected to the database")
-
-except Error as e:
-    print(f"Error: {e}")
+# the export engine pages through live conversations by id, so the extraction reads
+# the same records as account exports and skips deleted stories
+app = Flask(__name__)
+init_db(app)
 
 
 # In[ ]:
 
 
-# Create a cursor to execute  queries
-cursor = connection.cursor()
-
-# Execute a query to fetch data from the conversation and message tables
-query = """
-SELECT 
-    c.id AS conversation_id, 
-    c.created_at, 
-    m.id AS message_id, 
-    m.code, 
-    m.sender_type, 
-    m.content
-FROM conversation c
-JOIN message m ON c.id = m.conversation_id
-"""
-
-cursor.execute(query)
-# Fetch all rows from the executed query
-rows = cursor.fetchall()
+# flatten the export records back into one row per message
+rows = []
+with app.app_context():
+    for record in iter_conversations():
+        for part in record['parts']:
+            if part['prompt_message_id'] is not None:
+                rows.append((record['conversation_id'], record['created_at'], part['prompt_message_id'],
+                             part['code'], 'USER', part['prompt']))
+            if part['story_message_id'] is not None:
+                rows.append((record['conversation_id'], record['created_at'], part['story_message_id'],
+                             part['code'], 'MODEL', part['story']))
 
 #  save as a pandas dataframe
 df = pd.DataFrame(rows, columns=['conversation_id', 'created_at', 'message_id', 'code', 'sender_type', 'content'])
 
 
-# In[18]:
-
-
-# Close the connection
-if connection.is_connected():
-    connection.close()
-    print("Database connection closed")
-
-
 # In[149]:
 
 
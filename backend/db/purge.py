@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from db.db import db, Conversation, Message, ChildAccount, StoryAssignment, SearchTerm
+from db import archive, story_cache
+
+# Rows deleted per transaction; keeps each delete's lock footprint small
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", 500))
+# Pause between batches while there is work, so purging yields to live traffic
+PURGE_THROTTLE_SECONDS = float(os.getenv("PURGE_THROTTLE_SECONDS", 0.2))
+# Pause between polls once everything has been purged
+PURGE_INTERVAL_SECONDS = float(os.getenv("PURGE_INTERVAL_SECONDS", 30))
+
+
+def _delete_ids(model, ids):
+    model.query.filter(model.id.in_(ids)).delete(synchronize_session=False)
+    db.session.commit()
+    return len(ids)
+
+
+def purge_batch(batch_size=PURGE_BATCH_SIZE):
+    """
+    Delete one bounded batch of soft-deleted rows, dependents first.
+    Returns the number of rows deleted (0 when there is nothing left to purge).
+    """
+    deleted_conversations = db.select(Conversation.id).where(Conversation.deleted_at.isnot(None))
+    deleted_children = db.select(ChildAccount.username).where(ChildAccount.deleted_at.isnot(None))
+
+    message_ids = db.session.scalars(
+        db.select(Message.id).where(Message.conversation_id.in_(deleted_conversations))
+        .limit(batch_size)
+    ).all()
+    if message_ids:
+        return _delete_ids(Message, message_ids)
+
+    assignment_ids = db.session.scalars(
+        db.select(StoryAssignment.id).where(db.or_(
+            StoryAssignment.conversation_id.in_(deleted_conversations),
+            StoryAssignment.child_username.in_(deleted_children)
+        )).limit(batch_size)
+    ).all()
+    if assignment_ids:
+        return _delete_ids(StoryAssignment, assignment_ids)
+
+    posting_ids = db.session.scalars(
+        db.select(SearchTerm.id).where(SearchTerm.conversation_id.in_(deleted_conversations))
+        .limit(batch_size)
+    ).all()
+    if posting_ids:
+        return _delete_ids(SearchTerm, posting_ids)
+
+    # archived conversations are removed from their segment files and the manifest
+    archived = archive.purge_batch(batch_size)
+    if archived:
+        return archived
+
+    # conversations and children no longer have dependent rows at this point
+    conversation_ids = db.session.scalars(deleted_conversations.limit(batch_size)).all()
+    if conversation_ids:
+        return _delete_ids(Conversation, conversation_ids)
+
+    child_ids = db.session.scalars(
+        db.select(ChildAccount.id).where(ChildAccount.deleted_at.isnot(None)).limit(batch_size)
+    ).all()
+    if child_ids:
+        return _delete_ids(ChildAccount, child_ids)
+
+    # expired generation cache entries and story bodies no message references any more
+    return story_cache.purge_batch(batch_size)
+
+
+def purge_all(batch_size=PURGE_BATCH_SIZE, throttle=PURGE_THROTTLE_SECONDS):
+    """
+    Purge batches until nothing soft-deleted remains. Returns the total number of rows deleted.
+    """
+    total = 0
+    while True:
+        deleted = purge_batch(batch_size)
+        if not deleted:
+            return total
+        total += deleted
+        time.sleep(throttle)
+
+
+def _purge_loop(app):
+    while True:
+        deleted = 0
+        try:
+            with app.app_context():
+                deleted = purge_batch()
+        except Exception as e:
+            print(f"Error purging deleted rows: {e}")
+        time.sleep(PURGE_THROTTLE_SECONDS if deleted else PURGE_INTERVAL_SECONDS)
+
+
+def start_purger(app):
+    """
+    Start the background purger thread for this process
+    """
+    thread = threading.Thread(target=_purge_loop, args=(app,), name="purger", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    # python -m db.purge: drain all soft-deleted rows and exit (e.g. from a cron job)
+    from flask import Flask
+    from dotenv import load_dotenv
+    from db.db import init_db
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
+    app = Flask(__name__)
+    init_db(app)
+    with app.app_context():
+        print(f"Purged {purge_all()} rows")
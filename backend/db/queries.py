@@ -0,0 +1,82 @@
+from db.db import db, Conversation, Message, SenderType, StoryAssignment, ArchivedConversation, ChildAccount, StoryContent
+
+
+# Queries shared by the endpoints and the plan checks in db/migrations.py, so the plans
+# checked are the ones the endpoints run
+
+def conversations_query(user_id):
+    """
+    A user's live conversations, newest first
+    """
+    return Conversation.query.filter_by(user_id=user_id, deleted_at=None) \
+        .order_by(Conversation.created_at.desc())
+
+
+def conversation_messages_query(conversation_id):
+    """
+    The messages of a conversation in the message table, in creation order
+    """
+    return Message.query.filter_by(conversation_id=conversation_id).order_by(Message.created_at)
+
+
+def message_delta_query(conversation_id, since_message_id):
+    """
+    The messages of a conversation newer than since_message_id, one range scan over the
+    (conversation_id, id) index
+    """
+    return Message.query.filter(
+        Message.conversation_id == conversation_id,
+        Message.id > since_message_id
+    ).order_by(Message.id)
+
+
+def child_accounts_query(parent_uid):
+    """
+    A parent's live child accounts in creation order
+    """
+    return ChildAccount.query.filter_by(parent_uid=parent_uid, deleted_at=None).order_by(ChildAccount.id)
+
+
+def assigned_stories_query(username, *columns):
+    """
+    Query a child's assignments whose conversation is live and has a story, joined to that
+    first story message (or the archive manifest entry, for archived conversations) so the
+    given columns can read from them
+    """
+    # id of the first model message (the story content) of the assignment's conversation
+    first_story_id = db.select(db.func.min(Message.id)).where(
+        Message.conversation_id == StoryAssignment.conversation_id,
+        Message.sender_type == SenderType.MODEL
+    ).correlate(StoryAssignment).scalar_subquery()
+
+    return db.session.query(*columns) \
+        .select_from(StoryAssignment) \
+        .outerjoin(Message, Message.id == first_story_id) \
+        .outerjoin(ArchivedConversation, ArchivedConversation.conversation_id == StoryAssignment.conversation_id) \
+        .join(Conversation, Conversation.id == StoryAssignment.conversation_id) \
+        .filter(StoryAssignment.child_username == username, Conversation.deleted_at.is_(None),
+                db.or_(Message.id.isnot(None), ArchivedConversation.preview.isnot(None)))
+
+
+def assigned_stories_list_query(username):
+    """
+    The get_assigned_stories listing: a child's assignments with their story previews,
+    newest first. Only the first 101 characters of each story are read, enough to build
+    the preview, including for stories kept in the shared content store.
+    """
+    return assigned_stories_query(
+        username,
+        StoryAssignment.id,
+        StoryAssignment.conversation_id,
+        StoryAssignment.title,
+        StoryAssignment.assigned_at,
+        db.func.coalesce(
+            db.func.substr(StoryContent.body, 1, 101),
+            db.func.substr(Message.content, 1, 101),
+            ArchivedConversation.preview
+        ).label('preview'),
+        # compressed stories keep an empty content column and are decompressed here
+        Message.content_zstd,
+        Message.content_dict_id
+    ).outerjoin(StoryContent, StoryContent.id == Message.content_id) \
+        .order_by(StoryAssignment.assigned_at.desc(), StoryAssignment.id.desc())
@@ -0,0 +1,142 @@
+import os
+import itertools
+import threading
+import time
+from functools import wraps
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+
+# After a user writes, their reads stay on the primary for this long (covers replication lag)
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", 5))
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", 10))
+
+
+def _current_user_key():
+    """
+    The account whose data the request touches: the parent for both parent and child tokens
+    """
+    if not has_request_context():
+        return None
+    firebase_user = getattr(request, 'firebase_user', None)
+    if firebase_user:
+        return firebase_user.get('localId')
+    child_user = getattr(request, 'child_user', None)
+    if child_user:
+        return child_user.get('parent_uid')
+    return None
+
+
+class ReplicaRouter:
+    """
+    Keeps the replica engines, their health, and the recent writers that must read from the primary
+    """
+    def __init__(self):
+        self.replicas = []  # [{'engine': Engine, 'healthy': bool}]
+        self._round_robin = itertools.count()
+        self._recent_writes = {}  # user key -> sticky until (used when no shared store is set)
+        self._lock = threading.Lock()
+        # optional shared store with get(key) / set(key, value, ttl), e.g. the read cache
+        # backend, so read-your-writes holds across worker processes
+        self.sticky_store = None
+
+    def configure(self, replica_urls, engine_options=None):
+        self.replicas = [
+            {'engine': create_engine(url, pool_pre_ping=True, **(engine_options or {})), 'healthy': True}
+            for url in replica_urls
+        ]
+        if self.replicas:
+            print(f"Routing read-only endpoints to {len(self.replicas)} replica(s)")
+            threading.Thread(target=self._health_loop, name="replica-health", daemon=True).start()
+
+    def check_health(self):
+        for replica in self.replicas:
+            try:
+                with replica['engine'].connect() as connection:
+                    connection.execute(text("SELECT 1"))
+                healthy = True
+            except Exception as e:
+                print(f"Replica {replica['engine'].url.host or replica['engine'].url.database} unhealthy: {e}")
+                healthy = False
+            replica['healthy'] = healthy
+
+    def _health_loop(self):
+        while True:
+            time.sleep(REPLICA_HEALTH_INTERVAL)
+            self.check_health()
+
+    def record_write(self, user_key):
+        if user_key is None:
+            return
+        if self.sticky_store is not None:
+            self.sticky_store.set(f"primary:{user_key}", True, REPLICA_STICKY_SECONDS)
+        else:
+            with self._lock:
+                self._recent_writes[user_key] = time.monotonic() + REPLICA_STICKY_SECONDS
+
+    def wrote_recently(self, user_key):
+        if user_key is None:
+            return False
+        if self.sticky_store is not None:
+            return self.sticky_store.get(f"primary:{user_key}") is not None
+        with self._lock:
+            sticky_until = self._recent_writes.get(user_key)
+            if sticky_until is not None and sticky_until <= time.monotonic():
+                del self._recent_writes[user_key]
+                sticky_until = None
+        return sticky_until is not None
+
+    def read_engine(self):
+        """
+        The replica engine for the current request, or None if it must use the primary
+        """
+        if not self.replicas or not has_request_context() or not g.get('db_read_only'):
+            return None
+        if self.wrote_recently(_current_user_key()):
+            return None
+        healthy = [replica for replica in self.replicas if replica['healthy']]
+        if not healthy:
+            return None
+        return healthy[next(self._round_robin) % len(healthy)]['engine']
+
+
+router = ReplicaRouter()
+
+
+class RoutingSession(Session):
+    """
+    Flask-SQLAlchemy session that sends reads made by read_only endpoints to a replica.
+    Flushes and DML statements always go to the primary.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.info['wrote'] = True
+        elif bind is None:
+            engine = router.read_engine()
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _record_write(session):
+    if session.info.pop('wrote', False):
+        router.record_write(_current_user_key())
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _forget_write(session):
+    session.info.pop('wrote', None)
+
+
+def read_only(f):
+    """
+    Decorator for endpoints that only read: their queries may be served by a replica.
+    Place it below the auth decorator so the user is known.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+
+    return decorated_function
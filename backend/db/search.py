@@ -0,0 +1,229 @@
+import math
+import os
+import re
+import sys
+from db.db import db, Conversation, Message, SenderType, SearchTerm
+from db.archive import conversation_messages
+
+# Title words count this many times a body occurrence
+TITLE_WEIGHT = 5
+SNIPPET_RADIUS = 80
+MAX_QUERY_TERMS = 8
+# Terms are cut to the width of search_term.term, for indexing and lookups alike
+MAX_TERM_LENGTH = 64
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'had', 'has', 'he',
+    'her', 'his', 'in', 'is', 'it', 'its', 'of', 'on', 'or', 'she', 'so', 'that', 'the', 'their',
+    'them', 'then', 'there', 'they', 'this', 'to', 'was', 'were', 'with', 'story', 'part', 'title'
+}
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text):
+    return [
+        word[:MAX_TERM_LENGTH] for word in (match.group(0).lower() for match in WORD_PATTERN.finditer(text or ''))
+        if len(word) > 1 and word not in STOPWORDS
+    ]
+
+
+def split_title(content):
+    """
+    Split a stored story message into (title, body) following the "TITLE: ...\\n\\n STORY..." format
+    """
+    match = re.match(r"\s*TITLE:\s*(.*?)\n\n(.*)", content or '', re.DOTALL)
+    if not match:
+        return None, content or ''
+    return match.group(1).strip(), re.sub(r"^\s*STORY(, PART #\d+)?:\s*", "", match.group(2))
+
+
+def index_message(conversation_id, user_id, content, code, message_id=None):
+    """
+    Add a story message to the user's search index. Runs in the caller's transaction.
+    Only new stories (code 2) index their title; continuations repeat it. A new posting
+    remembers message_id, the first message with the term, to build snippets from.
+    """
+    title, body = split_title(content)
+    weights = {}
+    for term in tokenize(body):
+        weights[term] = weights.get(term, 0) + 1
+    if code == 2 and title:
+        for term in tokenize(title):
+            weights[term] = weights.get(term, 0) + TITLE_WEIGHT
+    if not weights:
+        return
+
+    existing = {
+        posting.term: posting for posting in SearchTerm.query.filter(
+            SearchTerm.conversation_id == conversation_id,
+            SearchTerm.term.in_(list(weights))
+        )
+    }
+    for term, weight in weights.items():
+        if term in existing:
+            existing[term].weight += weight
+        else:
+            db.session.add(SearchTerm(
+                user_id=user_id, term=term, conversation_id=conversation_id, weight=weight, message_id=message_id))
+
+
+def _term_filter(term):
+    # prefix match so "dragon" also finds "dragons"; uses the (user_id, term) index range
+    return SearchTerm.term.like(term.replace('\\', '').replace('%', '').replace('_', r'\_') + '%', escape='\\')
+
+
+def _live_postings(user_id):
+    return SearchTerm.query.join(Conversation, Conversation.id == SearchTerm.conversation_id) \
+        .filter(SearchTerm.user_id == user_id, Conversation.deleted_at.is_(None))
+
+
+def matching_postings(user_id, terms):
+    """
+    A user's live postings for any of the terms (as prefixes); the query search ranks
+    """
+    return _live_postings(user_id).filter(db.or_(*[_term_filter(term) for term in terms]))
+
+
+def _snippet(text, terms):
+    """
+    Return (snippet, highlights) around the first query term match, with highlight
+    [start, end) offsets into the snippet for every term occurrence
+    """
+    pattern = re.compile(r"\b(?:" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+    first = pattern.search(text)
+    if not first:
+        return None, []
+    start = max(0, first.start() - SNIPPET_RADIUS)
+    end = min(len(text), first.end() + SNIPPET_RADIUS)
+    snippet = ('...' if start > 0 else '') + text[start:end] + ('...' if end < len(text) else '')
+    offset = 3 if start > 0 else 0
+    highlights = [
+        [match.start() + offset, match.end() + offset] for match in pattern.finditer(text[start:end])
+    ]
+    return snippet, highlights
+
+
+def search_stories(user_id, query, limit=20):
+    """
+    Rank a user's live stories against the query with tf-idf over the inverted index and
+    return the top results with a title and a highlighted snippet
+    """
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    if not terms:
+        return []
+
+    total = Conversation.query.filter_by(user_id=user_id, deleted_at=None).count()
+    score = 0
+    for term in terms:
+        # one indexed range count per term for its document frequency
+        document_frequency = _live_postings(user_id).filter(_term_filter(term)) \
+            .with_entities(db.func.count(db.distinct(SearchTerm.conversation_id))).scalar()
+        if not document_frequency:
+            continue
+        idf = math.log(1 + total / document_frequency)
+        score = score + db.case((_term_filter(term), SearchTerm.weight * idf), else_=0)
+    if isinstance(score, int):
+        return []
+
+    score = db.func.sum(score).label('score')
+    ranked = matching_postings(user_id, terms) \
+        .with_entities(SearchTerm.conversation_id, score) \
+        .group_by(SearchTerm.conversation_id) \
+        .order_by(score.desc(), SearchTerm.conversation_id.desc()) \
+        .limit(limit).all()
+
+    conversation_ids = [row.conversation_id for row in ranked]
+    conversations = {
+        conversation.id: conversation for conversation in
+        Conversation.query.filter(Conversation.id.in_(conversation_ids))
+    }
+    # the snippet comes from the first message with a query term and the title from the
+    # first story message; only those two messages of each conversation are loaded
+    matching_ids = dict(
+        matching_postings(user_id, terms).filter(SearchTerm.conversation_id.in_(conversation_ids))
+        .with_entities(SearchTerm.conversation_id, db.func.min(SearchTerm.message_id))
+        .group_by(SearchTerm.conversation_id).all()
+    )
+    first_story_ids = dict(
+        db.session.query(Message.conversation_id, db.func.min(Message.id))
+        .filter(Message.conversation_id.in_(conversation_ids), Message.sender_type == SenderType.MODEL)
+        .group_by(Message.conversation_id).all()
+    )
+    wanted = {message_id for message_id in list(matching_ids.values()) + list(first_story_ids.values()) if message_id}
+    messages = {message.id: message for message in Message.query.filter(Message.id.in_(wanted))} if wanted else {}
+
+    results = []
+    for row in ranked:
+        first_story = messages.get(first_story_ids.get(row.conversation_id))
+        matching = messages.get(matching_ids.get(row.conversation_id))
+        if first_story is None or matching is None:
+            # archived, or indexed before postings recorded their message
+            stories = [
+                message for message in conversation_messages(row.conversation_id)
+                if message.sender_type == SenderType.MODEL
+            ]
+            first_story = stories[0] if stories else None
+        else:
+            stories = [matching]
+        title = split_title(first_story.content)[0] if first_story else None
+        snippet, highlights = None, []
+        for story in stories:
+            snippet, highlights = _snippet(split_title(story.content)[1], terms)
+            if snippet:
+                break
+        results.append({
+            'conversation_id': row.conversation_id,
+            'title': title or 'Untitled Story',
+            'created_at': conversations[row.conversation_id].created_at.isoformat(),
+            'score': round(float(row.score), 4),
+            'snippet': snippet or '',
+            'highlights': highlights
+        })
+    return results
+
+
+def _reindex_conversations(conversations):
+    """
+    Replace the postings of some conversations with ones built from their story messages,
+    read from the archive for archived conversations. Runs in the caller's transaction.
+    """
+    SearchTerm.query.filter(SearchTerm.conversation_id.in_([conversation.id for conversation in conversations])) \
+        .delete(synchronize_session=False)
+    for conversation in conversations:
+        for message in conversation_messages(conversation.id):
+            if message.sender_type == SenderType.MODEL:
+                index_message(conversation.id, conversation.user_id, message.content, message.code, message.id)
+                db.session.flush()
+
+
+def reindex_all(batch_size=100):
+    """
+    Rebuild the search index of every live conversation, archived ones included,
+    batch_size conversations per transaction. Postings are replaced conversation by
+    conversation, so search keeps working meanwhile and an interrupted run can be repeated.
+    """
+    last_id = 0
+    while True:
+        conversations = Conversation.query.filter(
+            Conversation.id > last_id, Conversation.deleted_at.is_(None)
+        ).order_by(Conversation.id).limit(batch_size).all()
+        if not conversations:
+            break
+        _reindex_conversations(conversations)
+        last_id = conversations[-1].id
+        db.session.commit()
+        print(f"Indexed conversations up to id {last_id}")
+
+
+if __name__ == '__main__':
+    # python -m db.search reindex
+    from flask import Flask
+    from dotenv import load_dotenv
+    from db.db import init_db
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
+    app = Flask(__name__)
+    init_db(app)
+    with app.app_context():
+        if len(sys.argv) > 1 and sys.argv[1] == 'reindex':
+            reindex_all()
+        else:
+            print("Usage: python -m db.search reindex")
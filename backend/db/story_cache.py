@@ -0,0 +1,171 @@
+import hashlib
+import os
+from datetime import datetime, timedelta
+from flask import g, has_request_context
+from sqlalchemy.exc import IntegrityError
+from db.db import db, Message, StoryContent, GenerationCache, GenerationCacheUse
+
+# Reuse writer output for identical prompts and store new story bodies once
+STORY_CACHE = os.getenv("STORY_CACHE", "0") == "1"
+# How long a cached generation may be handed out
+STORY_CACHE_TTL = int(os.getenv("STORY_CACHE_TTL", 7 * 24 * 3600))
+# How many times a cached generation may be handed out after it was first written
+STORY_CACHE_MAX_REUSE = int(os.getenv("STORY_CACHE_MAX_REUSE", 20))
+# Whether an account may be served a story body it has already received
+STORY_CACHE_REUSE_SAME_USER = os.getenv("STORY_CACHE_REUSE_SAME_USER", "0") == "1"
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def prompt_hash(system_prompt, prompt):
+    """
+    Hash of the final writer prompt with case and whitespace normalised, so prompts
+    that only differ in formatting share a cache entry
+    """
+    canonical = "\n".join(" ".join(part.split()).lower() for part in (system_prompt, prompt))
+    return _sha256(canonical)
+
+
+def store_content(body):
+    """
+    Return the id of the shared row holding this body, adding it if it is new.
+    Runs in the caller's transaction.
+    """
+    digest = _sha256(body)
+    existing = db.session.scalar(db.select(StoryContent.id).where(StoryContent.content_hash == digest))
+    if existing is not None:
+        return existing
+    try:
+        with db.session.begin_nested():
+            content = StoryContent(content_hash=digest, body=body)
+            db.session.add(content)
+        return content.id
+    except IntegrityError:
+        # another worker stored the same body first
+        return db.session.scalar(db.select(StoryContent.id).where(StoryContent.content_hash == digest))
+
+
+def _record_use(content_id, user_id):
+    if user_id is not None:
+        db.session.add(GenerationCacheUse(content_id=content_id, user_id=user_id))
+
+
+def cached_generation(digest, user_id=None):
+    """
+    Return (content id, body) of the cached story for a prompt hash, or None when there
+    is no entry or the reuse policy doesn't allow handing it out. Only reads; the reuse
+    is counted by generated_content_id when the story is logged.
+    """
+    entry = GenerationCache.query.filter(
+        GenerationCache.prompt_hash == digest,
+        GenerationCache.expires_at > datetime.utcnow(),
+        GenerationCache.reuse_count < STORY_CACHE_MAX_REUSE
+    ).first()
+    if entry is None:
+        return None
+    if not STORY_CACHE_REUSE_SAME_USER and user_id is not None and GenerationCacheUse.query.filter_by(
+            content_id=entry.content_id, user_id=user_id).first():
+        return None
+    return entry.content_id, entry.content.body
+
+
+def _count_reuse(digest, content_id, user_id):
+    # conditional increment so concurrent hits don't push the entry past the reuse limit;
+    # the story was already handed out, so a request that loses the race is served once
+    # past it rather than failed
+    claimed = GenerationCache.query.filter(
+        GenerationCache.prompt_hash == digest,
+        GenerationCache.content_id == content_id,
+        GenerationCache.reuse_count < STORY_CACHE_MAX_REUSE
+    ).update({'reuse_count': GenerationCache.reuse_count + 1}, synchronize_session=False)
+    if not claimed:
+        print(f"Cached story for prompt hash {digest} was served past its reuse limit")
+    _record_use(content_id, user_id)
+
+
+def remember_generation(digest, content_id, user_id=None):
+    """
+    Cache a freshly written story, stored as story_content row content_id, for a prompt
+    hash, replacing an expired or used-up entry. Runs in the caller's transaction.
+    """
+    expires_at = datetime.utcnow() + timedelta(seconds=STORY_CACHE_TTL)
+    entry = GenerationCache.query.filter_by(prompt_hash=digest).first()
+    if entry is None:
+        try:
+            with db.session.begin_nested():
+                db.session.add(GenerationCache(
+                    prompt_hash=digest, content_id=content_id, reuse_count=0, expires_at=expires_at))
+        except IntegrityError:
+            # a concurrent request cached the same prompt; keep its entry
+            pass
+    elif entry.expires_at <= datetime.utcnow() or entry.reuse_count >= STORY_CACHE_MAX_REUSE:
+        entry.content_id = content_id
+        entry.reuse_count = 0
+        entry.expires_at = expires_at
+    _record_use(content_id, user_id)
+
+
+def note_generation(digest, user_id=None, cached=None):
+    """
+    Remember for the rest of the request which prompt hash its new story was generated
+    for, and the (content id, body) it was served from the cache, if it was
+    """
+    g.story_generation = {'digest': digest, 'user_id': user_id, 'cached': cached}
+
+
+def generated_content_id(body):
+    """
+    Return the story_content id for the message body of the request's new story. A body
+    served from the cache keeps its row and counts as a reuse; any other is stored once
+    and, when the writer produced it, cached under its prompt hash. None when the story
+    cache is off. Runs in the caller's transaction.
+    """
+    if not STORY_CACHE:
+        return None
+    generation = g.pop('story_generation', None) if has_request_context() else None
+    if generation and generation['cached']:
+        _count_reuse(generation['digest'], generation['cached'][0], generation['user_id'])
+        if generation['cached'][1] == body:
+            return generation['cached'][0]
+    content_id = store_content(body)
+    if generation and not generation['cached']:
+        remember_generation(generation['digest'], content_id, generation['user_id'])
+    return content_id
+
+
+def purge_batch(batch_size):
+    """
+    Delete one bounded batch of expired cache entries, their use records, and story
+    bodies nothing references any more. Returns the number of rows deleted.
+    """
+    expired_ids = db.session.scalars(
+        db.select(GenerationCache.id).where(GenerationCache.expires_at <= datetime.utcnow())
+        .limit(batch_size)
+    ).all()
+    if expired_ids:
+        GenerationCache.query.filter(GenerationCache.id.in_(expired_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        return len(expired_ids)
+
+    cached_contents = db.select(GenerationCache.content_id)
+    use_ids = db.session.scalars(
+        db.select(GenerationCacheUse.id).where(GenerationCacheUse.content_id.notin_(cached_contents))
+        .limit(batch_size)
+    ).all()
+    if use_ids:
+        GenerationCacheUse.query.filter(GenerationCacheUse.id.in_(use_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        return len(use_ids)
+
+    orphan_ids = db.session.scalars(
+        db.select(StoryContent.id).where(
+            StoryContent.id.notin_(cached_contents),
+            StoryContent.id.notin_(db.select(Message.content_id).where(Message.content_id.isnot(None)))
+        ).limit(batch_size)
+    ).all()
+    if orphan_ids:
+        StoryContent.query.filter(StoryContent.id.in_(orphan_ids)).delete(synchronize_session=False)
+        db.session.commit()
+    return len(orphan_ids)
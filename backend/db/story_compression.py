@@ -0,0 +1,175 @@
+import os
+import sys
+import threading
+import time
+from db.db import db, Message, CompressionDictionary, SenderType
+
+# Optional dependency; without it new content is stored as plain text
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compress new message content (requires zstandard and a trained dictionary)
+STORY_COMPRESSION = os.getenv("STORY_COMPRESSION", "0") == "1"
+COMPRESSION_LEVEL = int(os.getenv("STORY_COMPRESSION_LEVEL", 9))
+DICTIONARY_SIZE = int(os.getenv("STORY_DICTIONARY_SIZE", 16 * 1024))
+# How often writers look for a newer dictionary
+DICTIONARY_REFRESH_SECONDS = 300
+
+# zstd compressor and decompressor objects aren't thread-safe, so each request thread
+# keeps its own; only the dictionary bytes are shared between threads
+_lock = threading.Lock()
+_dictionaries = {}  # dictionary id -> dictionary bytes
+_latest = {'checked_at': 0.0, 'dictionary_id': None}
+_local = threading.local()
+
+
+def _dictionary_data(dictionary_id):
+    with _lock:
+        data = _dictionaries.get(dictionary_id)
+    if data is None:
+        row = db.session.get(CompressionDictionary, dictionary_id)
+        if row is None:
+            raise LookupError(f"Compression dictionary {dictionary_id} not found")
+        data = row.data
+        with _lock:
+            _dictionaries[dictionary_id] = data
+    return data
+
+
+def _decompressor(dictionary_id):
+    decompressors = getattr(_local, 'decompressors', None)
+    if decompressors is None:
+        decompressors = _local.decompressors = {}  # dictionary id -> ZstdDecompressor
+    decompressor = decompressors.get(dictionary_id)
+    if decompressor is None:
+        if dictionary_id is None:
+            decompressor = zstandard.ZstdDecompressor()
+        else:
+            decompressor = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(_dictionary_data(dictionary_id)))
+        decompressors[dictionary_id] = decompressor
+    return decompressor
+
+
+def _latest_dictionary_id():
+    """
+    The newest dictionary's id, or None if there is none
+    """
+    now = time.monotonic()
+    with _lock:
+        if now - _latest['checked_at'] < DICTIONARY_REFRESH_SECONDS:
+            return _latest['dictionary_id']
+    dictionary_id = db.session.scalar(db.select(db.func.max(CompressionDictionary.id)))
+    with _lock:
+        _latest.update(checked_at=now, dictionary_id=dictionary_id)
+    return dictionary_id
+
+
+def _latest_compressor():
+    """
+    Return (dictionary id, compressor) for the newest dictionary, or (None, None) if there is none
+    """
+    dictionary_id = _latest_dictionary_id()
+    if dictionary_id is None:
+        return None, None
+    cached = getattr(_local, 'compressor', None)
+    if cached is None or cached[0] != dictionary_id:
+        cached = _local.compressor = (dictionary_id, zstandard.ZstdCompressor(
+            level=COMPRESSION_LEVEL,
+            dict_data=zstandard.ZstdCompressionDict(_dictionary_data(dictionary_id))))
+    return cached
+
+
+def compress_content(text):
+    """
+    Return (compressed bytes, dictionary id) for a message body, or (None, None) when it
+    should be stored as plain text (compression off, no dictionary, or no gain)
+    """
+    if not STORY_COMPRESSION or zstandard is None or text is None:
+        return None, None
+    dictionary_id, compressor = _latest_compressor()
+    if compressor is None:
+        return None, None
+    raw = text.encode('utf-8')
+    compressed = compressor.compress(raw)
+    if len(compressed) >= len(raw):
+        return None, None
+    return compressed, dictionary_id
+
+
+def decompress_content(data, dictionary_id):
+    if zstandard is None:
+        raise RuntimeError("Message content is compressed but the zstandard package is not installed")
+    return _decompressor(dictionary_id).decompress(data).decode('utf-8')
+
+
+def train_dictionary(sample_limit=5000):
+    """
+    Train a new dictionary on the most recent stories and store it as the newest version.
+    Only the model's story text is sampled, as that is the content worth compressing.
+    """
+    samples = [
+        message.content.encode('utf-8')
+        for code in (2, 3)
+        for message in Message.query.filter_by(sender_type=SenderType.MODEL, code=code)
+            .order_by(Message.id.desc()).limit(sample_limit)
+        if message.content
+    ]
+    if not samples:
+        raise ValueError("No stories to train a dictionary on")
+    trained = zstandard.train_dictionary(DICTIONARY_SIZE, samples)
+    dictionary = CompressionDictionary(data=trained.as_bytes(), sample_count=len(samples))
+    db.session.add(dictionary)
+    db.session.commit()
+    with _lock:
+        _latest['checked_at'] = 0.0  # pick the new dictionary up on the next write
+    print(f"Trained dictionary {dictionary.id} ({len(dictionary.data)} bytes) on {len(samples)} messages")
+    return dictionary.id
+
+
+def compress_existing(batch_size=500, throttle=0.1):
+    """
+    Compress stored plain-text messages in batches of batch_size, one commit per batch.
+    Safe to stop and re-run: it continues with the rows that are still uncompressed.
+    """
+    last_id = 0
+    compressed_count = 0
+    while True:
+        # bodies kept in the shared content store are left where they are
+        messages = Message.query.filter(
+            Message.id > last_id, Message.content_zstd.is_(None), Message.content_id.is_(None)
+        ).order_by(Message.id).limit(batch_size).all()
+        if not messages:
+            break
+        for message in messages:
+            # re-assigning runs the text through compress_content
+            message.content = message.content
+            if message.content_zstd is not None:
+                compressed_count += 1
+        last_id = messages[-1].id
+        db.session.commit()
+        print(f"Compressed messages up to id {last_id} ({compressed_count} so far)")
+        time.sleep(throttle)
+    return compressed_count
+
+
+if __name__ == '__main__':
+    # python -m db.story_compression train|compress
+    os.environ["STORY_COMPRESSION"] = "1"
+    from flask import Flask
+    from dotenv import load_dotenv
+    from db.db import init_db
+    # the module as imported by Message, so its settings and dictionary caches are shared
+    from db import story_compression
+    load_dotenv(dotenv_path=os.path.join(os.path.dirname(__file__), '..', '..', '.env'))
+    app = Flask(__name__)
+    init_db(app)
+    with app.app_context():
+        if len(sys.argv) > 1 and sys.argv[1] == 'train':
+            story_compression.train_dictionary()
+        elif len(sys.argv) > 1 and sys.argv[1] == 'compress':
+            print(f"Compressed {story_compression.compress_existing()} messages")
+        else:
+            print("Usage: python -m db.story_compression train|compress")
@@ -0,0 +1,102 @@
+from contextlib import contextmanager
+from flask import g, has_request_context
+from db.db import db
+
+
+def in_unit_of_work():
+    return has_request_context() and g.get('unit_of_work') is not None
+
+
+def commit_or_defer():
+    """
+    Commit the session now, or leave it to the enclosing unit of work
+    """
+    if not in_unit_of_work():
+        db.session.commit()
+
+
+def after_commit(callback):
+    """
+    Run callback once the current changes are committed: at the end of the unit of work,
+    or right away outside one. Use it for side effects such as cache invalidation.
+    """
+    if in_unit_of_work():
+        g.unit_of_work.append(callback)
+    else:
+        callback()
+
+
+def defer_write(write):
+    """
+    Run write (a function adding changes to the session) in the request's next unit of
+    work, so writes made around a slow call such as the LLM's are committed with the
+    request's result instead of on their own. Runs right away inside a unit of work, and
+    runs and commits outside a request. write should keep its failures to itself, e.g.
+    in a savepoint.
+    """
+    if in_unit_of_work() or not has_request_context():
+        write()
+        commit_or_defer()
+    else:
+        g.setdefault('deferred_writes', []).append(write)
+
+
+def _run_deferred_writes():
+    for write in g.pop('deferred_writes', []):
+        try:
+            write()
+        except Exception as e:
+            print(f"Error running deferred write: {e}")
+
+
+def _finish():
+    _run_deferred_writes()
+    callbacks, g.unit_of_work = g.unit_of_work, None
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            print(f"Error running post-commit callback: {e}")
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Commit everything written in the block once, when it ends. Keep it around the writes
+    only, never around a slow call such as the LLM's, so its locks are held briefly.
+    If the block raises, what was recorded before the failure is still committed before
+    the error propagates. A block inside another joins the outer one.
+    """
+    if in_unit_of_work():
+        yield
+        return
+    g.unit_of_work = []
+    try:
+        yield
+    except Exception:
+        try:
+            _finish()
+        except Exception as e:
+            print(f"Error committing after a failed request: {e}")
+        raise
+    _finish()
+
+
+def init_unit_of_work(app):
+    """
+    Commit the writes a request deferred but never reached a unit of work for (e.g. the
+    analytics rows of /generate_meta_prompt) when the request ends
+    """
+    @app.teardown_request
+    def commit_deferred_writes(exception=None):
+        if g.get('deferred_writes'):
+            try:
+                with unit_of_work():
+                    pass
+            except Exception as e:
+                print(f"Error committing deferred writes: {e}")
@@ -1,31 +1,193 @@
+import json
 import os
+import threading
+import time
+import jwt
 import requests
 from functools import wraps
 from flask import request, jsonify
+from principal_cache import principal_cache, firebase_subject
+
+# Optional dependency; RS256 signatures can't be checked locally without it
+try:
+    from cryptography.x509 import load_pem_x509_certificate
+except ImportError:
+    load_pem_x509_certificate = None
 
 # Firebase project ID
 FIREBASE_PROJECT_ID = 'wonder-words-bac10'
+FIREBASE_ISSUER = f'https://securetoken.google.com/{FIREBASE_PROJECT_ID}'
+# Google's public certificates for Firebase ID tokens, keyed by key id. Point this at a
+# local file (file:///path/certs.json) to verify tokens signed with your own keys offline.
+FIREBASE_CERTS_URL = os.getenv(
+    "FIREBASE_CERTS_URL",
+    "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+)
+# Ask the Firebase Auth REST API when tokens can't be verified locally (no keys or no cryptography)
+FIREBASE_REST_FALLBACK = os.getenv("FIREBASE_REST_FALLBACK", "0") == "1"
+FIREBASE_HTTP_TIMEOUT = float(os.getenv("FIREBASE_HTTP_TIMEOUT", 5))
+# Seconds of clock skew tolerated on exp and iat
+FIREBASE_CLOCK_SKEW = int(os.getenv("FIREBASE_CLOCK_SKEW", 60))
+# Used when the certificate response has no Cache-Control max-age
+FIREBASE_CERTS_DEFAULT_MAX_AGE = 3600
+# Don't refetch the certificates more often than this for tokens with an unknown key id
+FIREBASE_CERTS_MIN_REFRESH = 60
+
+_session = requests.Session()
+
+
+class KeyUnavailable(Exception):
+    """
+    Raised when there is no public key to check a token against, as opposed to a bad token
+    """
+
+
+def _max_age(cache_control):
+    for directive in (cache_control or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age' and value.isdigit():
+            return int(value)
+    return FIREBASE_CERTS_DEFAULT_MAX_AGE
+
+
+def fetch_certificates(url=None):
+    """
+    Load the {key id: PEM certificate} map and how long it may be cached, in seconds
+    """
+    url = url or FIREBASE_CERTS_URL
+    if url.startswith('file://'):
+        with open(url[len('file://'):]) as certs_file:
+            return json.load(certs_file), FIREBASE_CERTS_DEFAULT_MAX_AGE
+    response = _session.get(url, timeout=FIREBASE_HTTP_TIMEOUT)
+    response.raise_for_status()
+    return response.json(), _max_age(response.headers.get('Cache-Control'))
+
+
+class PublicKeyCache:
+    """
+    Public signing keys by key id, refetched once Google's max-age runs out or when a
+    token names a key we haven't seen. Pass a fetch function returning
+    ({key id: PEM certificate}, max age) to use locally generated keys.
+    """
+
+    def __init__(self, fetch=fetch_certificates):
+        self.fetch = fetch
+        self.keys = {}
+        self.expires_at = 0
+        self.fetched_at = 0
+        self.lock = threading.Lock()
+
+    def _refresh(self):
+        certificates, max_age = self.fetch()
+        keys = {}
+        for kid, pem in certificates.items():
+            if isinstance(pem, str):
+                pem = load_pem_x509_certificate(pem.encode('utf-8')).public_key()
+            keys[kid] = pem
+        now = time.time()
+        self.keys, self.fetched_at, self.expires_at = keys, now, now + max_age
+
+    def get(self, kid):
+        if load_pem_x509_certificate is None:
+            raise KeyUnavailable("Verifying Firebase tokens locally needs the cryptography package")
+        with self.lock:
+            now = time.time()
+            stale = now >= self.expires_at
+            unknown = kid not in self.keys and now - self.fetched_at >= FIREBASE_CERTS_MIN_REFRESH
+            if stale or unknown:
+                try:
+                    self._refresh()
+                except Exception as e:
+                    print(f"Error fetching Firebase public keys: {e}")
+                    if self.keys:
+                        # keep the old keys for a while rather than failing every request
+                        self.expires_at = now + FIREBASE_CERTS_MIN_REFRESH
+            if not self.keys:
+                raise KeyUnavailable("No Firebase public keys available")
+            return self.keys.get(kid)
+
+
+public_keys = PublicKeyCache()
 
-def verify_firebase_token(id_token):
+
+def decode_firebase_token(id_token, keys=None):
+    """
+    Check an ID token's signature and claims locally and return its claims.
+    Raises jwt.InvalidTokenError for a bad token and KeyUnavailable when it can't be checked.
+    """
+    header = jwt.get_unverified_header(id_token)
+    if header.get('alg') != 'RS256':
+        raise jwt.InvalidAlgorithmError("Firebase ID tokens are signed with RS256")
+    key = (keys or public_keys).get(header.get('kid'))
+    if key is None:
+        raise jwt.InvalidTokenError("Token was signed with an unknown key")
+    claims = jwt.decode(
+        id_token,
+        key,
+        algorithms=['RS256'],
+        audience=FIREBASE_PROJECT_ID,
+        issuer=FIREBASE_ISSUER,
+        leeway=FIREBASE_CLOCK_SKEW,
+        options={'require': ['exp', 'iat', 'aud', 'iss', 'sub']}
+    )
+    if not isinstance(claims['sub'], str) or not claims['sub'] or len(claims['sub']) > 128:
+        raise jwt.InvalidTokenError("Token has an invalid subject")
+    if claims.get('auth_time', 0) > time.time() + FIREBASE_CLOCK_SKEW:
+        raise jwt.ImmatureSignatureError("Token was authenticated in the future")
+    return claims
+
+
+def lookup_firebase_token(id_token):
     """
     Verify the Firebase ID token using the Firebase Auth REST API
     """
+    url = f'https://identitytoolkit.googleapis.com/v1/accounts:lookup?key={os.environ.get("FIREBASE_API_KEY")}'
+    response = _session.post(url, json={'idToken': id_token}, timeout=FIREBASE_HTTP_TIMEOUT)
+    if response.status_code == 200:
+        user_data = response.json()
+        if 'users' in user_data and len(user_data['users']) > 0:
+            return user_data['users'][0]
+    return None
+
+
+def verify_firebase_token(id_token, keys=None):
+    """
+    Verify the Firebase ID token against Google's public keys and return the user in the
+    shape the REST lookup used ('localId', 'email', ...), or None if it isn't valid
+    """
     try:
-        # Use Firebase Auth REST API to verify the token
-        url = f'https://identitytoolkit.googleapis.com/v1/accounts:lookup?key={os.environ.get("FIREBASE_API_KEY")}'
-        payload = {'idToken': id_token}
-        response = requests.post(url, json=payload)
-        
-        if response.status_code == 200:
-            user_data = response.json()
-            if 'users' in user_data and len(user_data['users']) > 0:
-                return user_data['users'][0]
-        
+        claims = decode_firebase_token(id_token, keys)
+        return {
+            'localId': claims['sub'],
+            'email': claims.get('email'),
+            'emailVerified': claims.get('email_verified', False),
+            'claims': claims
+        }
+    except jwt.InvalidTokenError as e:
+        print(f"Rejected Firebase token: {e}")
         return None
+    except KeyUnavailable as e:
+        if not FIREBASE_REST_FALLBACK:
+            print(f"Error verifying Firebase token: {e}")
+            return None
+    try:
+        return lookup_firebase_token(id_token)
     except Exception as e:
         print(f"Error verifying Firebase token: {e}")
         return None
 
+def request_firebase_user():
+    """
+    The Firebase user of the request's bearer token, or None if it has no valid one
+    """
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    id_token = auth_header.split('Bearer ')[1]
+    # Verify the token, or reuse the result for a token we've already seen
+    return principal_cache.verify(id_token, 'firebase', verify_firebase_token, firebase_subject)
+
+
 def firebase_auth_required(f):
     """
     Decorator to require Firebase authentication for a route
@@ -34,22 +196,18 @@ def firebase_auth_required(f):
     def decorated_function(*args, **kwargs):
         # Get the authorization header
         auth_header = request.headers.get('Authorization')
-        
+
         if not auth_header or not auth_header.startswith('Bearer '):
             return jsonify({'error': 'No valid authorization token provided'}), 401
-        
-        # Extract the token
-        id_token = auth_header.split('Bearer ')[1]
-        
-        # Verify the token
-        user = verify_firebase_token(id_token)
-        
+
+        user = request_firebase_user()
+
         if not user:
             return jsonify({'error': 'Invalid or expired token'}), 401
-        
+
         # Add the user to the request context
         request.firebase_user = user
-        
+
         return f(*args, **kwargs)
-    
+
     return decorated_function
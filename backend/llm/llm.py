@@ -3,8 +3,9 @@ from dotenv import load_dotenv
 from flask import jsonify
 from openai import OpenAI
 from db.db import db, Conversation, Message, SenderType
-import mysql
-from mysql.connector import Error
+from db.story_cache import STORY_CACHE, prompt_hash, cached_generation, note_generation
+from db.unit_of_work import defer_write
+from sqlalchemy import text
 import pandas as pd
 import re
 
@@ -16,70 +17,45 @@ load_dotenv(dotenv_path=os.path.join(
 client = OpenAI(
     api_key=os.getenv("OPENAI_API_KEY"),
 )
-# Database connection details
-host = os.getenv("DB_HOST")
-user = os.getenv("DB_USER")
-password = os.getenv("DB_PASSWORD")
-database = os.getenv("DB_NAME")
-
-def connect_to_database():
-    """Create a connection to the MySQL database."""
-    try:
-        connection = mysql.connector.connect(
-            host=host,
-            user=user,
-            password=password,
-            database=database
-        )
-        if connection.is_connected():
-            print("Connected to the database")
-            return connection
-    except Error as e:
-        print(f"Error while connecting to MySQL: {e}")
-        return None
 
-def add_to_prompt_table(features, vocabulary, user_prompt, model_response):
-    """Add a new prompt and its features to the MySQL database."""
-    connection = connect_to_database()
-    if connection:
-        print("Adding new prompt to the database...")
+def _insert_analytics_row(statement, params, success_message):
+    """
+    Record an analytics row with the request's result, in its next unit of work; a
+    failure only drops the row
+    """
+    def write():
         try:
-            cursor = connection.cursor()
-            # Insert the new prompt into the prompts table
-            insert_query = """
-                INSERT INTO prompt_data (features, vocabulary, user_prompt, model_response)
-                VALUES (%s, %s, %s, %s)
-            """
-            cursor.execute(insert_query, (features, vocabulary, user_prompt, model_response))
-            connection.commit()
-            print("New prompt added successfully")
-        except Error as e:
+            with db.session.begin_nested():
+                db.session.execute(text(statement), params)
+            print(success_message)
+        except Exception as e:
             print(f"Error while inserting data: {e}")
-        finally:
-            cursor.close()
-            connection.close()
-    else:
-        print("Failed to connect to the database. Prompt not added.")
+    defer_write(write)
+
+def add_to_prompt_table(features, vocabulary, user_prompt, model_response):
+    """Add a new prompt and its features to the MySQL database."""
+    print("Adding new prompt to the database...")
+    # Insert the new prompt into the prompts table
+    insert_query = """
+        INSERT INTO prompt_data (features, vocabulary, user_prompt, model_response)
+        VALUES (:features, :vocabulary, :user_prompt, :model_response)
+    """
+    _insert_analytics_row(insert_query, {
+        'features': features, 'vocabulary': vocabulary,
+        'user_prompt': user_prompt, 'model_response': model_response}, "New prompt added successfully")
 
 def add_to_meta_prompt_table(user_meta_prompt, prompt_vocabulary, prompt_narratives, model_meta_response, model_meta_vocabulary, model_meta_narratives):
     """Add a new meta prompt and its response to the MySQL database."""
-    connection = connect_to_database()
-    if connection:
-        try:
-            cursor = connection.cursor()
-            # Insert the new meta prompt into the meta_prompts table
-            insert_query = """
-                INSERT INTO meta_prompt_data (user_meta_prompt, prompt_vocabulary, prompt_narratives, model_meta_response, model_meta_vocabulary, model_meta_narratives)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """
-            cursor.execute(insert_query, (user_meta_prompt, prompt_vocabulary, prompt_narratives, model_meta_response, model_meta_vocabulary, model_meta_narratives))
-            connection.commit()
-            print("New meta prompt added successfully")
-        except Error as e:
-            print(f"Error while inserting data: {e}")
-        finally:
-            cursor.close()
-            connection.close()
+    # Insert the new meta prompt into the meta_prompts table
+    insert_query = """
+        INSERT INTO meta_prompt_data (user_meta_prompt, prompt_vocabulary, prompt_narratives, model_meta_response, model_meta_vocabulary, model_meta_narratives)
+        VALUES (:user_meta_prompt, :prompt_vocabulary, :prompt_narratives, :model_meta_response, :model_meta_vocabulary, :model_meta_narratives)
+    """
+    _insert_analytics_row(insert_query, {
+        'user_meta_prompt': user_meta_prompt, 'prompt_vocabulary': prompt_vocabulary,
+        'prompt_narratives': prompt_narratives, 'model_meta_response': model_meta_response,
+        'model_meta_vocabulary': model_meta_vocabulary, 'model_meta_narratives': model_meta_narratives},
+        "New meta prompt added successfully")
 
 # This subprompt is used to handle the language of the user's input.
 language_handling_subprompt = "Important: Respond to the user's input in the language they are using. Interpret their request in their language to make decisions to your instructions."
@@ -291,37 +267,54 @@ story_gen_system_prompt = (
                     "Limit the story to 100 words."
                 )
 
-def new_story_generator(query):
+def new_story_generator(query, user_id=None):
     """Generate a new story based on the user's query."""
     # Fetch vocabulary and narrative features from the query
     formatted_prompt, features, vocabulary = meta_prompt_generator(query)
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": story_gen_system_prompt,
-            },
-            {
-                "role": "user",
-                "content": formatted_prompt,
-            }
-        ],
-        model=model,
-    )
+    # identical writer prompts can reuse an earlier generation (see db/story_cache.py)
+    cache_key = prompt_hash(story_gen_system_prompt, formatted_prompt) if STORY_CACHE else None
+    cached = None
+    if cache_key:
+        # only a lookup; the reuse is counted when the story is logged (see log_story in app.py)
+        try:
+            cached = cached_generation(cache_key, user_id)
+        except Exception as e:
+            cached = None
+            print(f"Error reading the story cache: {e}")
+    if cached is not None:
+        print(f"Reusing cached story for prompt hash {cache_key}")
+        response = cached[1]
+    else:
+        chat_completion = client.chat.completions.create(
+            messages=[
+                {
+                    "role": "system",
+                    "content": story_gen_system_prompt,
+                },
+                {
+                    "role": "user",
+                    "content": formatted_prompt,
+                }
+            ],
+            model=model,
+        )
 
-    response = chat_completion.choices[0].message.content
-    # logging the words, features, query, and response to the db's prompt_data table
-    add_to_prompt_table(
-        features=features,
-        vocabulary=vocabulary,
-        user_prompt=query,
-        model_response=response
-    )
+        response = chat_completion.choices[0].message.content
+        # logging the words, features, query, and response to the db's prompt_data table
+        add_to_prompt_table(
+            features=features,
+            vocabulary=vocabulary,
+            user_prompt=query,
+            model_response=response
+        )
+    if cache_key:
+        # the story is cached with the message body it is logged as (see log_story in app.py)
+        note_generation(cache_key, user_id, cached)
 
     # Parse the response to extract title and story
     try:
-        # Split by the STORY: marker
-        parts = response.split(f"STORY:", 1)
+        # Split by the STORY: marker; cached stories are stored as logged, with "STORY, PART #1:"
+        parts = re.split(r"STORY(?:, PART #\d+)?:", response, maxsplit=1)
 
 
         # Extract title from the first part
@@ -349,17 +342,6 @@ def fetch_conversation_history(conversation_id):
     return messages
 
 
-def update_conversation_history(conversation_id, extended_story):
-    new_message = Message(
-        conversation_id=conversation_id,
-        sender_type=SenderType.MODEL,
-        code=3,
-        content=extended_story
-    )
-    db.session.add(new_message)
-    db.session.commit()
-
-
 def add_to_story(conversation_id, query):
     # Fetch the existing conversation history from the database using conversation_id
     conversation_history = fetch_conversation_history(conversation_id)
@@ -0,0 +1,180 @@
+import abc
+import hashlib
+import importlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from db.db import db, Conversation, SenderType, StoryAssignment
+from db.archive import conversation_messages
+from audio_store import lookup_audio, save_audio
+
+# Engine used to narrate stories: a name from ENGINES or a "module:Class" import path
+TTS_ENGINE = os.getenv("TTS_ENGINE", "espeak")
+NARRATION_VOICE = os.getenv("NARRATION_VOICE", "en-us")
+# Render narrations in the background when a story is assigned
+NARRATION_PRERENDER = os.getenv("NARRATION_PRERENDER", "1") == "1"
+NARRATION_WORKERS = int(os.getenv("NARRATION_WORKERS", 1))
+NARRATION_TIMEOUT = int(os.getenv("NARRATION_TIMEOUT", 300))
+# Audio names starting with this are narrations; uploads can't use them
+NARRATION_PREFIX = "narration-"
+
+
+class TTSEngine(abc.ABC):
+    """
+    Interface for text-to-speech engines. synthesize writes the narration of text to
+    output_path in any format ffmpeg can read; it is converted to MP3 when stored.
+    """
+    name = None
+
+    def available(self):
+        return True
+
+    @abc.abstractmethod
+    def synthesize(self, text, voice, output_path):
+        pass
+
+
+class EspeakEngine(TTSEngine):
+    """
+    Offline engine running the espeak-ng (or espeak) command line synthesizer
+    """
+    name = 'espeak'
+
+    def __init__(self):
+        self.binary = shutil.which('espeak-ng') or shutil.which('espeak')
+
+    def available(self):
+        return self.binary is not None
+
+    def synthesize(self, text, voice, output_path):
+        subprocess.run(
+            [self.binary, '-v', voice, '-s', '150', '-w', output_path, '--stdin'],
+            input=text.encode('utf-8'), check=True, capture_output=True, timeout=NARRATION_TIMEOUT
+        )
+
+
+ENGINES = {'espeak': EspeakEngine}
+
+
+def load_engine(spec=TTS_ENGINE):
+    if spec in ENGINES:
+        return ENGINES[spec]()
+    module_name, _, class_name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+engine = load_engine()
+
+_executor = ThreadPoolExecutor(max_workers=NARRATION_WORKERS, thread_name_prefix='narration')
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def valid_voice(voice):
+    return bool(re.fullmatch(r"[A-Za-z0-9_+-]{1,64}", voice or ''))
+
+
+def story_text(conversation_id):
+    """
+    The text read aloud for a story: its story parts in order
+    """
+    return "\n\n".join(
+        message.content for message in conversation_messages(conversation_id)
+        if message.sender_type == SenderType.MODEL and message.content
+    )
+
+
+def story_digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def narration_name(digest, voice):
+    # keyed on the story content, the voice and the engine that read it
+    key = hashlib.sha256(f"{engine.name}\n{voice}\n{digest}".encode('utf-8')).hexdigest()
+    return f"{NARRATION_PREFIX}{key}"
+
+
+def _record_digest(conversation_id, version, digest):
+    # keep the digest on the story's assignments until the conversation changes again
+    StoryAssignment.query.filter_by(conversation_id=conversation_id).update(
+        {'story_digest': digest, 'story_digest_version': version}, synchronize_session=False)
+    db.session.commit()
+
+
+def assignment_digest(assignment):
+    """
+    Digest of an assigned story's text, read from the assignment while the conversation
+    hasn't changed since it was taken. None if the story has no text.
+    """
+    version = assignment.conversation.version
+    if assignment.story_digest and assignment.story_digest_version == version:
+        return assignment.story_digest
+    text = story_text(assignment.conversation_id)
+    if not text:
+        return None
+    digest = story_digest(text)
+    _record_digest(assignment.conversation_id, version, digest)
+    return digest
+
+
+def narration_path(assignment, voice=NARRATION_VOICE):
+    """
+    Path of the stored narration of an assigned story, or None if it hasn't been rendered
+    """
+    digest = assignment_digest(assignment)
+    return lookup_audio(narration_name(digest, voice)) if digest else None
+
+
+def render_narration(conversation_id, voice=NARRATION_VOICE):
+    """
+    Narrate a story and store the audio, unless it is already stored. Returns its path.
+    """
+    version = db.session.scalar(db.select(Conversation.version).where(Conversation.id == conversation_id))
+    text = story_text(conversation_id)
+    if not text:
+        return None
+    digest = story_digest(text)
+    _record_digest(conversation_id, version, digest)
+    name = narration_name(digest, voice)
+    path = lookup_audio(name)
+    if path:
+        return path
+    with tempfile.TemporaryDirectory() as directory:
+        output_path = os.path.join(directory, 'narration.wav')
+        engine.synthesize(text, voice, output_path)
+        with open(output_path, 'rb') as audio_file:
+            # a stuck transcode fails this narration rather than holding the thread
+            path = save_audio(name, audio_file, timeout=NARRATION_TIMEOUT)['file_path']
+    print(f"Narrated conversation {conversation_id} with {engine.name}/{voice}")
+    return path
+
+
+def _render_in_background(app, conversation_id, voice):
+    try:
+        with app.app_context():
+            render_narration(conversation_id, voice)
+    except Exception as e:
+        print(f"Error narrating conversation {conversation_id}: {e}")
+    finally:
+        with _pending_lock:
+            _pending.discard((conversation_id, voice))
+
+
+def schedule_narration(conversation_id, voice=NARRATION_VOICE):
+    """
+    Render a story's narration on a background thread. Returns False if the engine
+    can't run here; a render already queued for the story isn't queued again.
+    """
+    if not engine.available():
+        return False
+    with _pending_lock:
+        if (conversation_id, voice) in _pending:
+            return True
+        _pending.add((conversation_id, voice))
+    _executor.submit(_render_in_background, current_app._get_current_object(), conversation_id, voice)
+    return True
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Verified principals kept per process; the oldest are evicted past this many
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", 10000))
+# How long a subject revocation is remembered; tokens don't live longer than a day
+PRINCIPAL_REVOCATION_TTL = int(os.getenv("PRINCIPAL_REVOCATION_TTL", 24 * 3600))
+
+
+def _token_times(principal):
+    # child tokens carry their claims at the top level, Firebase users under 'claims'
+    claims = principal.get('claims', principal)
+    return claims.get('exp'), claims.get('iat', 0)
+
+
+def _digest(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class PrincipalCache:
+    """
+    Bounded LRU of verified bearer tokens, keyed by the kind of token (which verifier
+    accepted it) and the token's SHA-256 digest, and expiring at the token's own exp, so a
+    repeat request costs a hash and a dictionary lookup. A token cached by one verifier is
+    never handed to another. Revoking a subject drops its cached tokens and rejects any
+    issued before the revocation.
+    """
+    def __init__(self, max_entries=PRINCIPAL_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (kind, digest) -> (expires_at, subject, principal)
+        self.revoked = {}  # subject -> revoked_at
+        self.hits = 0
+        self.misses = 0
+        self.rejections = 0
+        self.evictions = 0
+        self.revocations = 0
+        self.lock = threading.Lock()
+
+    def _is_revoked(self, subject, issued_at):
+        revoked_at = self.revoked.get(subject)
+        return revoked_at is not None and issued_at <= revoked_at
+
+    def verify(self, token, kind, verify, subject):
+        """
+        Return the principal for token, calling verify(token) only when it isn't cached
+        for this kind ('firebase' or 'child'). subject(principal) names who the token
+        belongs to, for revocation; a principal it doesn't name as this kind is rejected.
+        Tokens without an exp are verified every time.
+        """
+        key = (kind, _digest(token))
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+
+        principal = verify(token)
+        if not principal:
+            with self.lock:
+                self.rejections += 1
+            return None
+        expires_at, issued_at = _token_times(principal)
+        owner = subject(principal)
+        with self.lock:
+            if not owner or not owner.startswith(f"{kind}:") or self._is_revoked(owner, issued_at):
+                self.rejections += 1
+                return None
+            if expires_at is not None:
+                self.entries[key] = (expires_at, owner, principal)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+        return principal
+
+    def revoke_token(self, token):
+        """
+        Forget one cached token, so the next request verifies it again
+        """
+        digest = _digest(token)
+        with self.lock:
+            for key in [key for key in self.entries if key[1] == digest]:
+                del self.entries[key]
+
+    def revoke_subject(self, subject):
+        """
+        Drop every cached token of a subject and reject its tokens issued up to now.
+        Only affects this process.
+        """
+        now = time.time()
+        with self.lock:
+            for digest in [digest for digest, entry in self.entries.items() if entry[1] == subject]:
+                del self.entries[digest]
+            self.revoked[subject] = now
+            self.revocations += 1
+            for stale in [key for key, revoked_at in self.revoked.items()
+                          if revoked_at < now - PRINCIPAL_REVOCATION_TTL]:
+                del self.revoked[stale]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'rejections': self.rejections,
+            'evictions': self.evictions,
+            'revocations': self.revocations,
+        }
+
+
+principal_cache = PrincipalCache()
+
+
+def firebase_subject(user):
+    # child tokens never name a Firebase user, even if a verifier were to accept one
+    if user.get('is_child') or not user.get('localId'):
+        return None
+    return f"firebase:{user['localId']}"
+
+
+def child_subject(username):
+    return f"child:{username}"
+
+
+def child_token_subject(data):
+    if data.get('is_child') is not True or not data.get('username'):
+        return None
+    return child_subject(data['username'])
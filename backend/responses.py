@@ -0,0 +1,108 @@
+import os
+import gzip
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+# Optional accelerators; both are listed in environment.yaml but the app works without them
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than this are sent uncompressed; the framing overhead isn't worth it
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 5))
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/plain', 'text/html', 'application/x-ndjson'}
+
+
+def _available_encodings():
+    # preferred first
+    return (['br'] if brotli is not None else []) + ['gzip']
+
+
+def etag_variants(etag):
+    """
+    The ETag as sent for each content coding, so conditional requests match any of them
+    """
+    return [etag] + [f"{etag}-{encoding}" for encoding in _available_encodings()]
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider that always emits compact, unsorted output and serializes with orjson
+    when it is installed. Values orjson can't handle natively (dates, decimals, ...) go
+    through Flask's default conversion so the output matches the stock provider.
+    """
+    sort_keys = False
+    compact = True
+    ensure_ascii = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs:
+            return self._dumps_bytes(obj).decode()
+        kwargs.setdefault("separators", (",", ":"))
+        return super().dumps(obj, **kwargs)
+
+    def _dumps_bytes(self, obj):
+        if orjson is not None:
+            return orjson.dumps(
+                obj, default=self.default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+        return self.dumps(obj).encode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._dumps_bytes(obj), mimetype=self.mimetype)
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compress_response(response):
+    """
+    after_request hook: compress buffered text responses with the best encoding the client accepts
+    """
+    etag, weak = response.get_etag()
+    if response.status_code == 304:
+        # echo back the encoding-specific ETag the client revalidated with
+        for variant in etag_variants(etag)[1:] if etag else []:
+            if request.if_none_match.contains(variant):
+                response.set_etag(variant, weak)
+        return response
+
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+    encoding = request.accept_encodings.best_match(_available_encodings())
+    if not encoding:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        # a strong ETag must differ between encodings of the same resource
+        response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+
+def init_responses(app):
+    """
+    Install the fast JSON provider and response compression on the app
+    """
+    app.json = FastJSONProvider(app)
+    app.after_request(compress_response)
@@ -1,9 +1,25 @@
+"""
+Sync child accounts from Firebase to the backend database.
+
+Usage: python sync_child_accounts.py [--dry-run] [--full] [--users-file users.json]
+
+Each run diffs the Firebase child users changed since the last run against the
+child_account table and applies the result in chunked transactions. --dry-run only
+prints the inserts, updates and skips. --full ignores the watermark; use it after
+editing custom claims, which doesn't change a user's timestamps. --users-file reads
+a `firebase auth:export` file instead of calling the Firebase API.
+"""
+import argparse
 import os
 import requests
 import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from flask import Flask
-from db.db import db, init_db, ChildAccount
-from child_auth import save_child_account
+from sqlalchemy.exc import IntegrityError
+from db.db import db, init_db, ChildAccount, SyncWatermark
+from child_auth import invalidate_child_accounts
+from cache import read_cache, assigned_namespace
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -15,103 +31,286 @@ app = Flask(__name__)
 # Initialize the database
 init_db(app)
 
+FIREBASE_PROJECT_ID = 'wonder-words-bac10'
+# Users requested per Firebase page, and pages requested at the same time
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', 500))
+SYNC_HTTP_CONCURRENCY = int(os.environ.get('SYNC_HTTP_CONCURRENCY', 4))
+SYNC_HTTP_TIMEOUT = float(os.environ.get('SYNC_HTTP_TIMEOUT', 30))
+# Rows written per transaction
+SYNC_CHUNK_SIZE = int(os.environ.get('SYNC_CHUNK_SIZE', 500))
+WATERMARK_NAME = 'firebase_child_accounts'
+
+SYNCED_FIELDS = ('pin', 'display_name', 'age', 'parent_uid')
+
+
+def get_admin_token(session):
+    """
+    Return a bearer token for the Firebase user listing: FIREBASE_ACCESS_TOKEN if set,
+    otherwise an ID token from signing in with the admin account
+    """
+    if os.environ.get("FIREBASE_ACCESS_TOKEN"):
+        return os.environ["FIREBASE_ACCESS_TOKEN"]
+
+    admin_email = os.environ.get("ADMIN_EMAIL")
+    admin_password = os.environ.get("ADMIN_PASSWORD")
+    if not admin_email or not admin_password:
+        print("Admin email and password are required")
+        return None
+
+    # Sign in with admin account
+    sign_in_url = f'https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={os.environ.get("FIREBASE_API_KEY")}'
+    sign_in_payload = {
+        'email': admin_email,
+        'password': admin_password,
+        'returnSecureToken': True
+    }
+    sign_in_response = session.post(sign_in_url, json=sign_in_payload, timeout=SYNC_HTTP_TIMEOUT)
+    if sign_in_response.status_code != 200:
+        print(f"Failed to sign in with admin account: {sign_in_response.text}")
+        return None
+    return sign_in_response.json().get('idToken')
+
+
 def get_firebase_users():
     """
-    Get all users from Firebase
+    Get all users from Firebase. The first request counts the users; the pages are then
+    fetched SYNC_HTTP_CONCURRENCY at a time.
     """
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=SYNC_HTTP_CONCURRENCY))
     try:
-        # Use Firebase Auth REST API to get all users
-        url = f'https://identitytoolkit.googleapis.com/v1/accounts:lookup?key={os.environ.get("FIREBASE_API_KEY")}'
-        
-        # We need to provide a valid ID token to get all users
-        # First, get an ID token by signing in with the admin account
-        admin_email = os.environ.get("ADMIN_EMAIL")
-        admin_password = os.environ.get("ADMIN_PASSWORD")
-        
-        if not admin_email or not admin_password:
-            print("Admin email and password are required")
-            return []
-        
-        # Sign in with admin account
-        sign_in_url = f'https://identitytoolkit.googleapis.com/v1/accounts:signInWithPassword?key={os.environ.get("FIREBASE_API_KEY")}'
-        sign_in_payload = {
-            'email': admin_email,
-            'password': admin_password,
-            'returnSecureToken': True
-        }
-        sign_in_response = requests.post(sign_in_url, json=sign_in_payload)
-        
-        if sign_in_response.status_code != 200:
-            print(f"Failed to sign in with admin account: {sign_in_response.text}")
-            return []
-        
-        id_token = sign_in_response.json().get('idToken')
-        
-        # Now use the ID token to get all users
-        payload = {'idToken': id_token}
-        response = requests.post(url, json=payload)
-        
-        if response.status_code == 200:
-            user_data = response.json()
-            if 'users' in user_data:
-                return user_data['users']
-        
-        return []
+        token = get_admin_token(session)
+        if not token:
+            return None
+        url = f'https://identitytoolkit.googleapis.com/v1/projects/{FIREBASE_PROJECT_ID}/accounts:query'
+        headers = {'Authorization': f'Bearer {token}'}
+
+        def query(payload):
+            response = session.post(url, json=payload, headers=headers, timeout=SYNC_HTTP_TIMEOUT)
+            response.raise_for_status()
+            return response.json()
+
+        total = int(query({'returnUserInfo': False}).get('recordsCount', 0))
+        pages = [{
+            'returnUserInfo': True,
+            'limit': SYNC_PAGE_SIZE,
+            'offset': offset,
+            'sortBy': 'USER_ID',
+            'order': 'ASC'
+        } for offset in range(0, total, SYNC_PAGE_SIZE)]
+        print(f"Fetching {total} Firebase users in {len(pages)} pages")
+        with ThreadPoolExecutor(max_workers=SYNC_HTTP_CONCURRENCY) as pool:
+            return [user for page in pool.map(query, pages) for user in page.get('userInfo', [])]
     except Exception as e:
         print(f"Error getting Firebase users: {e}")
-        return []
+        return None
+    finally:
+        session.close()
+
+
+def load_users_file(path):
+    """
+    Read users from a `firebase auth:export` JSON file
+    """
+    with open(path) as users_file:
+        data = json.load(users_file)
+    return data['users'] if isinstance(data, dict) else data
+
+
+def _custom_claims(user):
+    # the REST API and auth:export return claims as a JSON string
+    if isinstance(user.get('customClaims'), dict):
+        return user['customClaims']
+    try:
+        return json.loads(user.get('customAttributes') or '{}')
+    except ValueError:
+        return {}
+
+
+def _changed_at(user):
+    """
+    Latest timestamp on a Firebase user record, or None if it has none
+    """
+    stamps = [int(user[field]) / 1000 for field in ('createdAt', 'lastLoginAt', 'lastSignedInAt')
+              if str(user.get(field, '')).isdigit()]
+    if user.get('lastRefreshAt'):
+        try:
+            stamps.append(datetime.fromisoformat(user['lastRefreshAt'].replace('Z', '+00:00')).timestamp())
+        except ValueError:
+            pass
+    return datetime.utcfromtimestamp(max(stamps)) if stamps else None
+
+
+def plan_sync(firebase_users, since=None):
+    """
+    Diff the Firebase child users changed after since against the child_account table.
+    Returns the rows to insert, the rows to update (with their id), the skipped users as
+    (name, reason) pairs, and the watermark to store once the plan is applied.
+    """
+    inserts, updates, skips = [], [], []
+    watermark = since
+    candidates = {}
+    for user in firebase_users:
+        claims = _custom_claims(user)
+        # Child accounts have a custom claim 'accountType' set to 'child'
+        if claims.get('accountType') != 'child':
+            continue
+        changed_at = _changed_at(user)
+        if changed_at is not None:
+            watermark = max(watermark, changed_at) if watermark else changed_at
+            if since is not None and changed_at <= since:
+                continue
+        username = claims.get('username')
+        if not username:
+            skips.append((user.get('localId'), 'no username'))
+            continue
+        if username in candidates:
+            skips.append((username, 'duplicate username in Firebase'))
+            continue
+        row = {
+            'username': username,
+            'pin': claims.get('pin'),
+            'display_name': user.get('displayName'),
+            'age': claims.get('age'),
+            'parent_uid': claims.get('parentUid')
+        }
+        if not all(row[field] for field in SYNCED_FIELDS):
+            skips.append((username, 'missing required fields'))
+            continue
+        row['pin'] = str(row['pin'])
+        try:
+            row['age'] = int(row['age'])
+        except (TypeError, ValueError):
+            skips.append((username, 'invalid age'))
+            continue
+        candidates[username] = row
+
+    # one query for every existing account the candidates could match
+    existing = {}
+    names = list(candidates)
+    for start in range(0, len(names), SYNC_CHUNK_SIZE):
+        for account in db.session.execute(db.select(
+                ChildAccount.id, ChildAccount.username, ChildAccount.pin, ChildAccount.display_name,
+                ChildAccount.age, ChildAccount.parent_uid, ChildAccount.deleted_at
+        ).where(ChildAccount.username.in_(names[start:start + SYNC_CHUNK_SIZE]))):
+            existing[account.username] = account
+
+    for username, row in candidates.items():
+        account = existing.get(username)
+        if account is None:
+            inserts.append(row)
+        elif account.deleted_at is not None:
+            skips.append((username, 'deleted in the backend'))
+        elif any(getattr(account, field) != row[field] for field in SYNCED_FIELDS):
+            updates.append(dict(row, id=account.id))
+        else:
+            skips.append((username, 'unchanged'))
+    return inserts, updates, skips, watermark
+
+
+def _insert_chunk(rows):
+    try:
+        db.session.execute(db.insert(ChildAccount), rows)
+        db.session.commit()
+        return len(rows)
+    except IntegrityError:
+        # an account was created through the app meanwhile; insert the rest
+        db.session.rollback()
+        taken = set(db.session.scalars(db.select(ChildAccount.username).where(
+            ChildAccount.username.in_([row['username'] for row in rows]))))
+        remaining = [row for row in rows if row['username'] not in taken]
+        for username in taken:
+            print(f"Child account {username} was created during the sync; skipped")
+        if remaining:
+            db.session.execute(db.insert(ChildAccount), remaining)
+            db.session.commit()
+        return len(remaining)
+
+
+def _invalidate(parent_uids):
+    """
+    Drop the cached reads of the children a chunk wrote, in every worker process: their
+    parents' child lists, and their assigned story lists, which are cached by username
+    in the parent's namespace
+    """
+    invalidate_child_accounts(*parent_uids)
+    read_cache.invalidate_namespace(*[assigned_namespace(parent_uid) for parent_uid in parent_uids])
+
+
+def apply_sync(inserts, updates):
+    """
+    Write the planned inserts and updates, SYNC_CHUNK_SIZE rows per transaction. The bulk
+    statements skip the ORM, so each chunk invalidates the cached reads it changed itself.
+    """
+    inserted = updated = 0
+    for start in range(0, len(inserts), SYNC_CHUNK_SIZE):
+        chunk = inserts[start:start + SYNC_CHUNK_SIZE]
+        inserted += _insert_chunk(chunk)
+        _invalidate({row['parent_uid'] for row in chunk})
+    for start in range(0, len(updates), SYNC_CHUNK_SIZE):
+        chunk = updates[start:start + SYNC_CHUNK_SIZE]
+        # a child moved to another parent leaves the previous parent's list too
+        parent_uids = set(db.session.scalars(db.select(ChildAccount.parent_uid).where(
+            ChildAccount.id.in_([row['id'] for row in chunk]))))
+        # bulk UPDATE by primary key
+        db.session.execute(db.update(ChildAccount), chunk)
+        db.session.commit()
+        _invalidate(parent_uids | {row['parent_uid'] for row in chunk})
+        updated += len(chunk)
+    return inserted, updated
+
+
+def _store_watermark(watermark):
+    state = db.session.get(SyncWatermark, WATERMARK_NAME)
+    if state is None:
+        db.session.add(SyncWatermark(name=WATERMARK_NAME, synced_until=watermark))
+    else:
+        state.synced_until = watermark
+    db.session.commit()
+
+
+def print_report(inserts, updates, skips):
+    print(f"Would insert {len(inserts)} child accounts:")
+    for row in inserts:
+        print(f"  + {row['username']} (parent {row['parent_uid']})")
+    print(f"Would update {len(updates)} child accounts:")
+    for row in updates:
+        print(f"  ~ {row['username']}")
+    print(f"Would skip {len(skips)} child accounts:")
+    for name, reason in skips:
+        print(f"  - {name}: {reason}")
+
 
-def sync_child_accounts():
+def sync_child_accounts(dry_run=False, full=False, users_file=None):
     """
     Sync child accounts from Firebase to the backend database
     """
     with app.app_context():
-        # Get all users from Firebase
-        firebase_users = get_firebase_users()
-        
-        # Filter for child accounts
-        child_accounts = []
-        for user in firebase_users:
-            # Check if the user is a child account
-            # Child accounts have a custom claim 'accountType' set to 'child'
-            if user.get('customClaims', {}).get('accountType') == 'child':
-                child_accounts.append(user)
-        
-        print(f"Found {len(child_accounts)} child accounts in Firebase")
-        
-        # For each child account, check if it exists in the backend database
-        for child in child_accounts:
-            # Get the child's username from the custom claims
-            username = child.get('customClaims', {}).get('username')
-            
-            if not username:
-                print(f"Child account {child.get('localId')} has no username")
-                continue
-            
-            # Check if the child account exists in the backend database
-            existing_account = ChildAccount.query.filter_by(username=username).first()
-            
-            if existing_account:
-                print(f"Child account {username} already exists in the backend database")
-                continue
-            
-            # Get the child's details from the custom claims
-            pin = child.get('customClaims', {}).get('pin')
-            display_name = child.get('displayName')
-            age = child.get('customClaims', {}).get('age')
-            parent_uid = child.get('customClaims', {}).get('parentUid')
-            
-            if not all([pin, display_name, age, parent_uid]):
-                print(f"Child account {username} is missing required fields")
-                continue
-            
-            # Save the child account to the backend database
-            success = save_child_account(username, pin, parent_uid, display_name, age)
-            
-            if success:
-                print(f"Child account {username} synced to the backend database")
-            else:
-                print(f"Failed to sync child account {username} to the backend database")
+        state = None if full else db.session.get(SyncWatermark, WATERMARK_NAME)
+        since = state.synced_until if state else None
+        if since:
+            print(f"Syncing Firebase users changed after {since}")
+
+        firebase_users = load_users_file(users_file) if users_file else get_firebase_users()
+        if firebase_users is None:
+            print("Could not load Firebase users; nothing synced")
+            return
+
+        inserts, updates, skips, watermark = plan_sync(firebase_users, since)
+        if dry_run:
+            print_report(inserts, updates, skips)
+            return
+
+        inserted, updated = apply_sync(inserts, updates)
+        if watermark is not None:
+            _store_watermark(watermark)
+        print(f"Inserted {inserted}, updated {updated}, skipped {len(skips)} child accounts")
+
 
 if __name__ == '__main__':
-    sync_child_accounts()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dry-run', action='store_true', help="print the changes without writing them")
+    parser.add_argument('--full', action='store_true', help="ignore the watermark and diff every user")
+    parser.add_argument('--users-file', help="read users from a firebase auth:export file")
+    args = parser.parse_args()
+    sync_child_accounts(args.dry_run, args.full, args.users_file)
@@ -0,0 +1,135 @@
+import os
+import sys
+import tempfile
+import time
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# The app reads its configuration at import, so point it at a scratch SQLite database first
+_db_dir = tempfile.mkdtemp(prefix='wonder-words-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+os.environ['PURGE_IN_PROCESS'] = '0'
+os.environ['READ_CACHE_PATH'] = os.path.join(_db_dir, 'read_cache.sqlite3')
+os.environ['AUDIO_UPLOAD_DIR'] = os.path.join(_db_dir, 'uploads')
+os.environ['ARCHIVE_DIR'] = os.path.join(_db_dir, 'archive')
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+@pytest.fixture
+def app():
+    from app import app
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def empty_principal_cache():
+    from principal_cache import principal_cache
+    principal_cache.clear()
+    yield
+    principal_cache.clear()
+
+
+@pytest.fixture
+def firebase_token_for(monkeypatch):
+    """
+    Returns a function making Firebase ID tokens for a uid, signed with a local key the
+    app is set to trust
+    """
+    import firebase_auth
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    monkeypatch.setattr(firebase_auth, 'public_keys',
+                        firebase_auth.PublicKeyCache(fetch=lambda: ({'test-key': key.public_key()}, 3600)))
+
+    def make(uid):
+        now = int(time.time())
+        claims = {
+            'iss': firebase_auth.FIREBASE_ISSUER,
+            'aud': firebase_auth.FIREBASE_PROJECT_ID,
+            'sub': uid,
+            'iat': now,
+            'exp': now + 3600,
+            'auth_time': now
+        }
+        return jwt.encode(claims, key, algorithm='RS256', headers={'kid': 'test-key'})
+    return make
+
+
+def bearer(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+def mp3_bytes(frames=10, fill=0):
+    """
+    A minimal MPEG-1 Layer III stream: 128 kbit/s, 44.1 kHz frames of 417 bytes
+    """
+    frame = b'\xff\xfb\x90\x64' + bytes([fill]) * 413
+    return frame * frames
+
+
+def add_story(user_id, title='Pancake Morning', story='Pip flipped a golden pancake over the stove.',
+              prompt='a story about breakfast', created_at=None):
+    """
+    Add a conversation with a prompt and its story, indexed for search, as the app logs
+    them. Returns the conversation id; the caller commits.
+    """
+    from db.db import db, Conversation, Message, SenderType
+    from db.search import index_message
+    times = {'created_at': created_at} if created_at else {}
+    conversation = Conversation(user_id=user_id, **times)
+    db.session.add(conversation)
+    db.session.flush()
+    content = f"TITLE: {title}\n\n STORY, PART #1: {story}"
+    db.session.add(Message(conversation_id=conversation.id, sender_type=SenderType.USER, code=2,
+                           content=prompt, **times))
+    message = Message(conversation_id=conversation.id, sender_type=SenderType.MODEL, code=2,
+                      content=content, **times)
+    db.session.add(message)
+    conversation.version = 2
+    db.session.flush()
+    index_message(conversation.id, user_id, content, 2, message.id)
+    return conversation.id
+
+
+class FakeOpenAI:
+    """
+    Stands in for the OpenAI client: answers each of the app's prompts with a fixed reply
+    and counts the calls per prompt
+    """
+    def __init__(self, code='2', title='The Brave Kite', story='A kite flew over the hills.'):
+        self.code = code
+        self.title = title
+        self.story = story
+        self.calls = {}
+        self.chat = self
+        self.completions = self
+
+    def create(self, messages, model):
+        from types import SimpleNamespace
+        from llm import llm
+        system_prompt = messages[0]['content']
+        if system_prompt == llm.story_gen_system_prompt or 'extended story' in system_prompt:
+            kind, reply = 'writer', f"TITLE: {self.title}\n\nSTORY: {self.story}"
+        elif system_prompt == llm.meta_prompt_system_prompt:
+            kind, reply = 'meta', "Story Request: a kite story\nVocabulary: kite, breeze\nNarratives: twist"
+        elif 'respond with code' in system_prompt:
+            kind, reply = 'handler', self.code
+        else:
+            kind, reply = 'other', "kite, breeze"
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=reply))])
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    from llm import llm
+    fake = FakeOpenAI()
+    monkeypatch.setattr(llm, 'client', fake)
+    return fake
@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+from db.db import db, ArchivedConversation, Message, SenderType
+from db.archive import archive_cold_conversations, conversation_messages, is_archived
+from conftest import add_story, bearer
+
+
+def message_rows(conversation_id):
+    return [(message.id, message.sender_type, message.code, message.content)
+            for message in conversation_messages(conversation_id)]
+
+
+def test_archived_conversations_read_the_same_and_restore(app, client, firebase_token_for):
+    token = firebase_token_for('archive-parent')
+    long_ago = datetime.utcnow() - timedelta(days=400)
+    with app.app_context():
+        cold_ids = [add_story('archive-parent', title=f'Old Story {n}', created_at=long_ago) for n in range(3)]
+        # other users' and recent conversations interleave with the cold ones
+        other_id = add_story('archive-other', created_at=long_ago)
+        hot_id = add_story('archive-parent', title='New Story')
+        db.session.commit()
+        rows = {cid: message_rows(cid) for cid in cold_ids}
+
+    def read():
+        messages = {cid: client.get('/get_conversation_messages', query_string={'conversation_id': cid},
+                                    headers=bearer(token)).get_json() for cid in cold_ids + [hot_id]}
+        return messages, client.get('/get_conversations', headers=bearer(token)).get_json()
+    before = read()
+    assert all(len(response['messages']) == 2 for response in before[0].values())
+
+    with app.app_context():
+        assert archive_cold_conversations(older_than_days=30, batch_size=2) >= 4
+        assert all(is_archived(cid) for cid in cold_ids + [other_id]) and not is_archived(hot_id)
+        assert Message.query.filter(Message.conversation_id.in_(cold_ids)).count() == 0
+        assert {cid: message_rows(cid) for cid in cold_ids} == rows
+        # a second run finds nothing left to archive
+        assert archive_cold_conversations(older_than_days=30, batch_size=2) == 0
+
+    # fresh reads come from the segments and match what the message table served
+    with app.test_request_context():
+        from app import invalidate_conversation_reads
+        invalidate_conversation_reads(cold_ids + [hot_id], 'archive-parent')
+    assert read() == before
+
+    # continuing a story moves it back into the message table, keeping the message ids
+    with app.test_request_context():
+        from app import log_message
+        log_message(cold_ids[0], SenderType.USER, 3, 'What happens next?')
+    with app.app_context():
+        assert not is_archived(cold_ids[0])
+        assert db.session.get(ArchivedConversation, cold_ids[1]) is not None
+        restored = Message.query.filter_by(conversation_id=cold_ids[0]).order_by(Message.id).all()
+        assert [(message.id, message.sender_type, message.code, message.content)
+                for message in restored[:-1]] == rows[cold_ids[0]]
+        assert restored[-1].content == 'What happens next?'
+        # the other conversations of the segment still read from it
+        assert message_rows(cold_ids[1]) == rows[cold_ids[1]]
@@ -0,0 +1,57 @@
+from db.db import db, ChildAccount, Conversation, StoryAssignment
+from conftest import add_story, bearer
+
+
+def test_bulk_assign_reports_each_item(app, client, firebase_token_for):
+    token = firebase_token_for('bulk-parent')
+    with app.app_context():
+        for username, parent_uid in (('bulk-kid', 'bulk-parent'), ('bulk-sibling', 'bulk-parent'),
+                                     ('bulk-stranger', 'bulk-other')):
+            db.session.add(ChildAccount(username=username, pin='1234', display_name='Kid', age=7,
+                                        parent_uid=parent_uid))
+        story_id = add_story('bulk-parent')
+        assigned_id = add_story('bulk-parent', title='Already Assigned')
+        deleted_id = add_story('bulk-parent', title='Deleted')
+        foreign_id = add_story('bulk-other')
+        db.session.add(StoryAssignment(conversation_id=assigned_id, child_username='bulk-kid', title='Read me'))
+        db.session.get(Conversation, deleted_id).deleted_at = db.func.current_timestamp()
+        db.session.commit()
+
+    items = [
+        {'conversation_id': story_id, 'child_username': 'bulk-kid', 'title': 'Read me'},
+        {'conversation_id': story_id, 'child_username': 'bulk-sibling', 'title': 'Read me'},
+        {'conversation_id': assigned_id, 'child_username': 'bulk-kid', 'title': 'Read me'},
+        # the same pair twice in one batch is only assigned once
+        {'conversation_id': story_id, 'child_username': 'bulk-kid', 'title': 'Read me again'},
+        {'conversation_id': foreign_id, 'child_username': 'bulk-kid', 'title': 'Read me'},
+        {'conversation_id': deleted_id, 'child_username': 'bulk-kid', 'title': 'Read me'},
+        {'conversation_id': 999999, 'child_username': 'bulk-kid', 'title': 'Read me'},
+        {'conversation_id': story_id, 'child_username': 'bulk-stranger', 'title': 'Read me'},
+        {'conversation_id': story_id, 'child_username': 'bulk-nobody', 'title': 'Read me'},
+        {'conversation_id': story_id, 'child_username': 'bulk-kid'},
+        {'conversation_id': 'abc', 'child_username': 'bulk-kid', 'title': 'Read me'},
+        'not an object',
+    ]
+    response = client.post('/assign_stories', json={'assignments': items}, headers=bearer(token))
+
+    assert response.status_code == 200
+    body = response.get_json()
+    assert [result['index'] for result in body['results']] == list(range(len(items)))
+    assert [result['status'] for result in body['results']] == [
+        'assigned', 'assigned', 'duplicate', 'duplicate', 'not_found', 'not_found', 'not_found',
+        'not_found', 'not_found', 'invalid', 'invalid', 'invalid']
+    assert body['assigned'] == 2
+    with app.app_context():
+        created = {(assignment.id, assignment.conversation_id, assignment.child_username)
+                   for assignment in StoryAssignment.query.filter_by(conversation_id=story_id)}
+        assert created == {(result['assignment_id'], result['conversation_id'], result['child_username'])
+                           for result in body['results'][:2]}
+        assert StoryAssignment.query.filter_by(conversation_id=assigned_id).count() == 1
+        assert StoryAssignment.query.filter(
+            StoryAssignment.conversation_id.in_([foreign_id, deleted_id])).count() == 0
+
+
+def test_bulk_assign_rejects_malformed_batches(client, firebase_token_for):
+    token = firebase_token_for('bulk-parent')
+    for payload in ({}, {'assignments': []}, {'assignments': 'all'}):
+        assert client.post('/assign_stories', json=payload, headers=bearer(token)).status_code == 400
@@ -0,0 +1,66 @@
+import pytest
+from narration import ENGINES, TTSEngine, load_engine
+from conftest import bearer, mp3_bytes
+
+
+def upload(client, name, data, token=None):
+    return client.post(f'/upload_audio?filename={name}', data=data, content_type='audio/mpeg',
+                       headers=bearer(token) if token else {})
+
+
+def test_only_the_uploader_can_delete_a_name(client, firebase_token_for):
+    owner, other = firebase_token_for('parent-1'), firebase_token_for('parent-2')
+    assert upload(client, 'owned', mp3_bytes(fill=1), owner).status_code == 200
+
+    assert client.delete('/delete_audio?filename=owned').status_code == 401
+    assert client.delete('/delete_audio?filename=owned', headers=bearer(other)).status_code == 404
+    assert client.get('/download_audio?filename=owned').status_code == 200
+    assert client.delete('/delete_audio?filename=owned', headers=bearer(owner)).status_code == 200
+    assert client.get('/download_audio?filename=owned').status_code == 404
+
+
+def test_anonymous_names_cant_be_deleted(client, firebase_token_for):
+    assert upload(client, 'anonymous', mp3_bytes(fill=2)).status_code == 200
+    response = client.delete('/delete_audio?filename=anonymous', headers=bearer(firebase_token_for('parent-1')))
+    assert response.status_code == 404
+
+
+def test_another_owners_name_cant_be_replaced(client, firebase_token_for):
+    assert upload(client, 'taken', mp3_bytes(fill=3), firebase_token_for('parent-1')).status_code == 200
+    assert upload(client, 'taken', mp3_bytes(fill=4), firebase_token_for('parent-2')).status_code == 403
+    assert upload(client, 'taken', mp3_bytes(fill=4)).status_code == 403
+
+
+def test_narration_names_are_reserved(client):
+    assert upload(client, 'narration-abc', mp3_bytes(fill=5)).status_code == 400
+
+
+def test_oversized_base64_uploads_are_refused_before_decoding(client, monkeypatch):
+    import base64
+    import audio_store
+    monkeypatch.setattr(audio_store, 'AUDIO_MAX_BASE64_BYTES', 1024)
+    encoded = base64.b64encode(mp3_bytes(frames=10, fill=6)).decode('ascii')
+    response = client.post('/upload_audio', json={'filename': 'big', 'bytes': encoded})
+    assert response.status_code == 413
+    response = client.post('/upload_audio', json={'filename': 'big', 'bytes': encoded[:1024]})
+    assert response.status_code != 413
+
+def test_metrics_needs_its_token(client, monkeypatch):
+    import app as app_module
+    monkeypatch.setattr(app_module, 'METRICS_TOKEN', '')
+    assert client.get('/metrics').status_code == 404
+    monkeypatch.setattr(app_module, 'METRICS_TOKEN', 'secret')
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers=bearer('secret')).status_code == 200
+
+
+class SilentEngine(TTSEngine):
+    name = 'silent'
+
+
+def test_an_engine_without_synthesize_fails_when_loaded(monkeypatch):
+    monkeypatch.setitem(ENGINES, 'silent', SilentEngine)
+    with pytest.raises(TypeError):
+        load_engine('silent')
+    with pytest.raises(TypeError):
+        load_engine('test_audio:SilentEngine')
@@ -0,0 +1,37 @@
+import time
+import pytest
+from child_auth import generate_child_token
+from principal_cache import principal_cache
+from conftest import bearer
+
+
+@pytest.fixture
+def firebase_token(firebase_token_for):
+    return firebase_token_for('parent-1')
+
+
+@pytest.fixture
+def child_token():
+    return generate_child_token('kid-1', 'parent-1', 'Kid', 7)
+
+
+def test_tokens_are_accepted_by_their_own_decorator(client, firebase_token, child_token):
+    assert client.get('/get_conversations', headers=bearer(firebase_token)).status_code == 200
+    assert client.get('/get_assigned_stories', headers=bearer(child_token)).status_code == 200
+
+
+def test_cached_child_token_is_rejected_by_firebase_auth(client, child_token):
+    assert client.get('/get_assigned_stories', headers=bearer(child_token)).status_code == 200
+    assert client.get('/get_conversations', headers=bearer(child_token)).status_code == 401
+
+
+def test_cached_firebase_token_is_rejected_by_child_auth(client, firebase_token):
+    assert client.get('/get_conversations', headers=bearer(firebase_token)).status_code == 200
+    assert client.get('/get_assigned_stories', headers=bearer(firebase_token)).status_code == 401
+
+
+def test_principal_of_the_wrong_kind_is_not_cached():
+    child = {'username': 'kid-1', 'is_child': True, 'exp': time.time() + 60}
+    from principal_cache import firebase_subject
+    assert principal_cache.verify('token', 'firebase', lambda token: child, firebase_subject) is None
+    assert principal_cache.stats()['entries'] == 0
@@ -0,0 +1,62 @@
+import os
+from cache import ReadThroughCache, SqliteCacheBackend
+from db.db import db, ChildAccount
+from conftest import bearer
+import child_auth
+import sync_child_accounts
+
+
+def create_child(client, parent_uid, username, pin='1234', display_name='Kid', age=7):
+    response = client.post('/create_child_account', json={
+        'username': username, 'pin': pin, 'display_name': display_name, 'age': age, 'parent_uid': parent_uid})
+    assert response.status_code == 200
+
+
+def login(client, username, pin):
+    return client.post('/child_login', json={'username': username, 'pin': pin}).status_code
+
+
+def listed(client, token, parent_uid):
+    response = client.post('/get_child_accounts', json={'parent_uid': parent_uid}, headers=bearer(token))
+    return response.get_json()['child_accounts']
+
+
+def test_a_pin_change_takes_effect_right_away(app, client, firebase_token_for, monkeypatch):
+    token = firebase_token_for('parent-pin')
+    create_child(client, 'parent-pin', 'pin-kid')
+    assert login(client, 'pin-kid', '1234') == 200
+    assert listed(client, token, 'parent-pin') == [{'username': 'pin-kid', 'display_name': 'Kid', 'age': 7}]
+
+    # the sync job runs in another process, with its own cache client on the shared backend
+    with monkeypatch.context() as sync_process:
+        sync_process.setattr(child_auth, 'read_cache', ReadThroughCache(
+            SqliteCacheBackend(os.environ['READ_CACHE_PATH'])))
+        with app.app_context():
+            account = ChildAccount.query.filter_by(username='pin-kid').one()
+            sync_child_accounts.apply_sync([], [{
+                'id': account.id, 'username': 'pin-kid', 'pin': '9999', 'display_name': 'Kiddo',
+                'age': 7, 'parent_uid': 'parent-pin'}])
+
+    assert login(client, 'pin-kid', '1234') == 401
+    assert login(client, 'pin-kid', '9999') == 200
+    assert listed(client, token, 'parent-pin') == [{'username': 'pin-kid', 'display_name': 'Kiddo', 'age': 7}]
+
+
+def test_deleted_accounts_leave_the_list_at_once(client, firebase_token_for):
+    token = firebase_token_for('parent-gone')
+    create_child(client, 'parent-gone', 'gone-kid')
+    assert [account['username'] for account in listed(client, token, 'parent-gone')] == ['gone-kid']
+
+    assert client.delete('/delete_account_data', headers=bearer(token)).status_code == 200
+    assert listed(client, token, 'parent-gone') == []
+    assert login(client, 'gone-kid', '1234') == 401
+
+
+def test_callers_get_their_own_copy(app, client):
+    create_child(client, 'parent-copy', 'copy-kid')
+    with app.app_context():
+        accounts = child_auth.get_child_accounts_for_parent('parent-copy')
+        accounts[0]['age'] = 99
+        accounts.append({})
+        assert child_auth.get_child_accounts_for_parent('parent-copy') == [
+            {'username': 'copy-kid', 'display_name': 'Kid', 'age': 7}]
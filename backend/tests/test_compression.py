@@ -0,0 +1,59 @@
+import random
+import threading
+from db.db import db, Message, SenderType
+from db import story_compression
+from conftest import add_story
+
+WORDS = ['dragon', 'pancake', 'moon', 'river', 'giggled', 'whispered', 'lantern', 'forest', 'brave',
+         'tiny', 'castle', 'rocket', 'kitten', 'sparkling', 'puddle', 'cloud', 'friend', 'journey']
+
+
+def sentence(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 40))).capitalize() + '.'
+
+
+def test_backfill_compresses_stories_and_reads_them_back(app, monkeypatch):
+    monkeypatch.setattr(story_compression, 'STORY_COMPRESSION', True)
+    monkeypatch.setattr(story_compression, 'DICTIONARY_SIZE', 4096)
+    rng = random.Random(7)
+    with app.app_context():
+        conversation_ids = [
+            add_story('compress-parent', title=f"Tale {number}", story=' '.join(sentence(rng) for _ in range(4)))
+            for number in range(300)
+        ]
+        db.session.commit()
+        originals = {
+            message.id: message.content for message in
+            Message.query.filter(Message.conversation_id.in_(conversation_ids))
+        }
+
+        story_compression.train_dictionary()
+        # the backfill only writes rows that were still plain text before
+        compressed = story_compression.compress_existing(batch_size=100, throttle=0)
+        assert compressed > 0
+        assert story_compression.compress_existing(batch_size=100, throttle=0) == 0
+
+        db.session.expire_all()
+        messages = Message.query.filter(Message.conversation_id.in_(conversation_ids)).all()
+        stories = [message for message in messages if message.sender_type == SenderType.MODEL]
+        assert all(message.content_zstd is not None and message._content == '' for message in stories)
+        assert {message.id: message.content for message in messages} == originals
+
+        # other threads decode with their own decompressor
+        rows = [(message.id, message.content_zstd, message.content_dict_id) for message in stories[:20]]
+        decoded = {}
+
+        def decode():
+            for message_id, data, dictionary_id in rows:
+                decoded[message_id] = story_compression.decompress_content(data, dictionary_id)
+        threads = [threading.Thread(target=decode) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert decoded == {message_id: originals[message_id] for message_id, _, _ in rows}
+
+        # new writes are compressed with the same dictionary
+        message = Message(conversation_id=conversation_ids[0], sender_type=SenderType.MODEL, code=3,
+                          content=originals[stories[0].id])
+        assert message.content_zstd is not None and message.content == originals[stories[0].id]
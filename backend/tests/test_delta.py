@@ -0,0 +1,56 @@
+from db.db import db, Message, SenderType
+from conftest import add_story, bearer
+
+
+def messages_since(client, token, conversation_id, since_message_id=None):
+    query = f'/get_conversation_messages?conversation_id={conversation_id}'
+    if since_message_id is not None:
+        query += f'&since_message_id={since_message_id}'
+    response = client.get(query, headers=bearer(token))
+    return response.status_code, response.get_json()
+
+
+def test_delta_returns_only_newer_messages_and_reflects_deletion(app, client, firebase_token_for):
+    token = firebase_token_for('delta-parent')
+    with app.app_context():
+        conversation_id = add_story('delta-parent')
+        db.session.commit()
+
+    status, full = messages_since(client, token, conversation_id)
+    assert status == 200 and len(full['messages']) == 2
+    last_seen = full['messages'][-1]['id']
+
+    status, delta = messages_since(client, token, conversation_id, last_seen)
+    assert status == 200
+    assert delta == {'messages': [], 'conversation_deleted': False}
+
+    from app import log_message
+    with app.test_request_context():
+        log_message(conversation_id, SenderType.USER, 3, 'What happens next?')
+        log_message(conversation_id, SenderType.MODEL, 3, 'TITLE: Pancake Morning\n\n STORY, PART #2: More.')
+    status, delta = messages_since(client, token, conversation_id, last_seen)
+    assert [message['content'] for message in delta['messages']] == [
+        'What happens next?', 'TITLE: Pancake Morning\n\n STORY, PART #2: More.']
+    assert all(message['id'] > last_seen for message in delta['messages'])
+    assert 'deleted_message_ids' not in delta
+
+    newest = delta['messages'][-1]['id']
+    assert client.delete(f'/delete_conversation?conversation_id={conversation_id}',
+                         headers=bearer(token)).status_code == 200
+    status, delta = messages_since(client, token, conversation_id, newest)
+    with app.app_context():
+        every_id = sorted(db.session.scalars(
+            db.select(Message.id).where(Message.conversation_id == conversation_id)))
+    assert status == 200
+    assert delta == {'messages': [], 'deleted_message_ids': every_id, 'conversation_deleted': True}
+    # a client that had only seen the first messages drops only those
+    status, delta = messages_since(client, token, conversation_id, last_seen)
+    assert delta['deleted_message_ids'] == [message['id'] for message in full['messages']]
+
+
+def test_delta_for_another_users_conversation_is_refused(app, client, firebase_token_for):
+    with app.app_context():
+        conversation_id = add_story('delta-owner')
+        db.session.commit()
+    status, _ = messages_since(client, firebase_token_for('delta-stranger'), conversation_id, 0)
+    assert status == 404
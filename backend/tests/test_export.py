@@ -0,0 +1,52 @@
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from db.db import db, Message, SenderType
+from db import export
+from db.archive import archive_cold_conversations
+from db.story_cache import store_content
+from conftest import add_story, bearer
+
+
+def exported(client, token, after=0):
+    response = client.get('/export_stories', query_string={'after': after}, headers=bearer(token))
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_export_pages_by_conversation_id(app, client, firebase_token_for, monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_BATCH_SIZE', 2)
+    token = firebase_token_for('export-parent')
+    with app.app_context():
+        archived_id = add_story('export-parent', title='Old Story', created_at=datetime.utcnow() - timedelta(days=400))
+        conversation_ids = [archived_id] + [add_story('export-parent', title=f'Story {n}') for n in range(4)]
+        add_story('export-other')
+        # one story kept in the shared content store
+        shared = Message.query.filter_by(conversation_id=conversation_ids[1], sender_type=SenderType.MODEL).one()
+        shared.content_id = store_content(shared.content)
+        shared.content = ''
+        db.session.commit()
+        archive_cold_conversations(older_than_days=30)
+
+    statements = []
+
+    def count(*args):
+        if args[2].lstrip().upper().startswith('SELECT') and 'FROM conversation' in args[2]:
+            statements.append(args[2])
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            records = exported(client, token)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+
+    assert [record['conversation_id'] for record in records] == conversation_ids
+    assert [record['title'] for record in records] == ['Old Story'] + [f'Story {n}' for n in range(4)]
+    assert all(record['parts'][0]['story'].startswith('TITLE: ') for record in records)
+    # one page query per EXPORT_BATCH_SIZE conversations, plus the empty page that ends it
+    assert len(statements) == 4
+
+    # resuming after a conversation skips it and everything before it
+    assert [record['conversation_id'] for record in exported(client, token, after=conversation_ids[2])] == \
+        conversation_ids[3:]
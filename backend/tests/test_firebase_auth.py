@@ -0,0 +1,74 @@
+import time
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+import firebase_auth
+from firebase_auth import FIREBASE_CLOCK_SKEW, FIREBASE_ISSUER, FIREBASE_PROJECT_ID, PublicKeyCache, decode_firebase_token
+
+signing_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture
+def keys():
+    return PublicKeyCache(fetch=lambda: ({'test-key': signing_key.public_key()}, 3600))
+
+
+def token(key=signing_key, algorithm='RS256', kid='test-key', **overrides):
+    now = int(time.time())
+    claims = {
+        'iss': FIREBASE_ISSUER,
+        'aud': FIREBASE_PROJECT_ID,
+        'sub': 'parent-1',
+        'iat': now,
+        'exp': now + 3600,
+        'auth_time': now
+    }
+    claims.update(overrides)
+    return jwt.encode(claims, key, algorithm=algorithm, headers={'kid': kid})
+
+
+def test_a_valid_token_is_decoded(keys):
+    claims = decode_firebase_token(token(), keys)
+    assert claims['sub'] == 'parent-1'
+
+
+@pytest.mark.parametrize('claims', [
+    {'aud': 'another-project'},
+    {'iss': 'https://securetoken.google.com/another-project'},
+    {'exp': int(time.time()) - FIREBASE_CLOCK_SKEW - 60},
+    {'iat': int(time.time()) + FIREBASE_CLOCK_SKEW + 600},
+    {'auth_time': int(time.time()) + FIREBASE_CLOCK_SKEW + 600},
+    {'sub': ''},
+], ids=['wrong aud', 'wrong iss', 'expired', 'issued in the future', 'authenticated in the future', 'no subject'])
+def test_bad_claims_are_rejected(keys, claims):
+    with pytest.raises(jwt.InvalidTokenError):
+        decode_firebase_token(token(**claims), keys)
+
+
+def test_an_unknown_key_id_is_rejected(keys):
+    with pytest.raises(jwt.InvalidTokenError):
+        decode_firebase_token(token(kid='rotated-away'), keys)
+
+
+def test_a_signature_from_another_key_is_rejected(keys):
+    with pytest.raises(jwt.InvalidSignatureError):
+        decode_firebase_token(token(key=other_key), keys)
+
+
+@pytest.mark.parametrize('algorithm, key', [
+    ('RS512', signing_key),
+    ('PS256', signing_key),
+    ('HS256', 'a shared secret'),
+    ('none', None),
+])
+def test_algorithms_other_than_rs256_are_rejected(keys, algorithm, key):
+    with pytest.raises(jwt.InvalidAlgorithmError):
+        decode_firebase_token(token(key=key, algorithm=algorithm), keys)
+
+
+def test_rejected_tokens_do_not_authenticate(keys, monkeypatch):
+    monkeypatch.setattr(firebase_auth, 'FIREBASE_REST_FALLBACK', True)
+    monkeypatch.setattr(firebase_auth, 'lookup_firebase_token', lambda id_token: pytest.fail("fell back to the REST API"))
+    assert firebase_auth.verify_firebase_token(token(aud='another-project'), keys) is None
+    assert firebase_auth.verify_firebase_token(token(), keys)['localId'] == 'parent-1'
@@ -0,0 +1,126 @@
+import os
+import tempfile
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from db.db import db
+from db.migrations import SCHEMA_VERSION, check_query_plans, check_schema_version, run_migrations
+
+# The schema as it was before versioned migrations (the original create_all)
+BASELINE_SCHEMA = [
+    """CREATE TABLE conversation (
+        id INTEGER NOT NULL PRIMARY KEY,
+        created_at DATETIME,
+        user_id VARCHAR(255) NOT NULL
+    )""",
+    """CREATE TABLE message (
+        id INTEGER NOT NULL PRIMARY KEY,
+        conversation_id INTEGER NOT NULL REFERENCES conversation (id),
+        sender_type VARCHAR(5) NOT NULL,
+        code INTEGER NOT NULL,
+        content VARCHAR(5000) NOT NULL,
+        created_at DATETIME
+    )""",
+    """CREATE TABLE child_account (
+        id INTEGER NOT NULL PRIMARY KEY,
+        username VARCHAR(255) NOT NULL UNIQUE,
+        pin VARCHAR(255) NOT NULL,
+        display_name VARCHAR(255) NOT NULL,
+        age INTEGER NOT NULL,
+        parent_uid VARCHAR(255) NOT NULL,
+        created_at DATETIME
+    )""",
+    """CREATE TABLE story_assignment (
+        id INTEGER NOT NULL PRIMARY KEY,
+        conversation_id INTEGER NOT NULL REFERENCES conversation (id),
+        child_username VARCHAR(255) NOT NULL REFERENCES child_account (username),
+        title VARCHAR(255) NOT NULL,
+        assigned_at DATETIME
+    )""",
+]
+
+
+@pytest.fixture
+def baseline_engine():
+    path = os.path.join(tempfile.mkdtemp(prefix='wonder-words-migrations-'), 'baseline.db')
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as connection:
+        for statement in BASELINE_SCHEMA:
+            connection.execute(text(statement))
+        connection.execute(text(
+            "INSERT INTO conversation (id, created_at, user_id) VALUES (1, '2024-01-01 00:00:00', 'parent-1')"))
+        connection.execute(text(
+            "INSERT INTO message (id, conversation_id, sender_type, code, content, created_at) "
+            "VALUES (1, 1, 'MODEL', 2, 'TITLE: Old\n\nSTORY: kept', '2024-01-01 00:00:00')"))
+    return engine
+
+
+def columns(engine, table):
+    return {column['name'] for column in inspect(engine).get_columns(table)}
+
+
+def indexes(engine, table):
+    return {index['name'] for index in inspect(engine).get_indexes(table)}
+
+
+def version_rows(engine):
+    with engine.connect() as connection:
+        return connection.execute(text("SELECT version FROM schema_version")).fetchall()
+
+
+def test_baseline_schema_upgrades_to_head(baseline_engine):
+    assert run_migrations(baseline_engine) == SCHEMA_VERSION
+
+    assert {'deleted_at', 'version'} <= columns(baseline_engine, 'conversation')
+    assert {'content_zstd', 'content_dict_id', 'content_id'} <= columns(baseline_engine, 'message')
+    assert 'deleted_at' in columns(baseline_engine, 'child_account')
+    assert {'story_digest', 'story_digest_version'} <= columns(baseline_engine, 'story_assignment')
+    assert 'ix_conversation_user_id_created_at' in indexes(baseline_engine, 'conversation')
+    assert 'ix_message_conversation_id_id' in indexes(baseline_engine, 'message')
+    assert 'ix_child_account_parent_uid' in indexes(baseline_engine, 'child_account')
+    for table in ('search_term', 'story_content', 'archived_conversation', 'audio_name', 'audio_job'):
+        assert inspect(baseline_engine).has_table(table)
+
+    # existing rows survive and get the new columns' defaults
+    with baseline_engine.connect() as connection:
+        row = connection.execute(text("SELECT user_id, version, deleted_at FROM conversation")).one()
+        assert (row.user_id, row.version, row.deleted_at) == ('parent-1', 0, None)
+        assert connection.execute(text("SELECT content FROM message")).scalar() == 'TITLE: Old\n\nSTORY: kept'
+    check_schema_version(baseline_engine)
+
+
+def test_migrations_are_idempotent(baseline_engine):
+    run_migrations(baseline_engine)
+    schema = {table: columns(baseline_engine, table) for table in inspect(baseline_engine).get_table_names()}
+
+    assert run_migrations(baseline_engine) == SCHEMA_VERSION
+    assert {table: columns(baseline_engine, table)
+            for table in inspect(baseline_engine).get_table_names()} == schema
+
+    # a migration that was interrupted before its version was recorded can run again
+    with baseline_engine.begin() as connection:
+        connection.execute(text("UPDATE schema_version SET version = 1"))
+    assert run_migrations(baseline_engine) == SCHEMA_VERSION
+
+
+def test_version_table_holds_one_row_with_the_head_version(baseline_engine):
+    assert not inspect(baseline_engine).has_table('schema_version')
+    with pytest.raises(RuntimeError):
+        check_schema_version(baseline_engine)
+
+    run_migrations(baseline_engine)
+    assert version_rows(baseline_engine) == [(SCHEMA_VERSION,)]
+    run_migrations(baseline_engine)
+    assert version_rows(baseline_engine) == [(SCHEMA_VERSION,)]
+
+
+def test_older_schema_is_refused(baseline_engine):
+    run_migrations(baseline_engine)
+    with baseline_engine.begin() as connection:
+        connection.execute(text("UPDATE schema_version SET version = :version"), {'version': SCHEMA_VERSION - 1})
+    with pytest.raises(RuntimeError):
+        check_schema_version(baseline_engine)
+
+
+def test_list_queries_use_an_index(app):
+    with app.app_context():
+        assert check_query_plans(db.engine) == []
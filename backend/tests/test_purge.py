@@ -0,0 +1,90 @@
+import os
+from datetime import datetime, timedelta
+from db.db import db, Conversation, Message, ChildAccount, StoryAssignment, SearchTerm, ArchivedConversation
+from db import archive
+from db.purge import purge_batch
+from conftest import add_story
+
+
+def dangling_rows():
+    """
+    Rows referring to a conversation or child account that no longer exists
+    """
+    conversations = db.select(Conversation.id)
+    children = db.select(ChildAccount.username)
+    return {
+        'message': Message.query.filter(Message.conversation_id.notin_(conversations)).count(),
+        'story_assignment': StoryAssignment.query.filter(db.or_(
+            StoryAssignment.conversation_id.notin_(conversations),
+            StoryAssignment.child_username.notin_(children))).count(),
+        'search_term': SearchTerm.query.filter(SearchTerm.conversation_id.notin_(conversations)).count(),
+        'archived_conversation': ArchivedConversation.query.filter(
+            ArchivedConversation.conversation_id.notin_(conversations)).count(),
+    }
+
+
+def rows_of(user_id):
+    conversation_ids = db.select(Conversation.id).where(Conversation.user_id == user_id)
+    return {
+        'conversation': Conversation.query.filter_by(user_id=user_id).count(),
+        'message': Message.query.filter(Message.conversation_id.in_(conversation_ids)).count(),
+        'search_term': SearchTerm.query.filter_by(user_id=user_id).count(),
+        'story_assignment': StoryAssignment.query.filter(
+            StoryAssignment.conversation_id.in_(conversation_ids)).count(),
+        'child_account': ChildAccount.query.filter_by(parent_uid=user_id).count(),
+        'archived_conversation': ArchivedConversation.query.filter_by(user_id=user_id).count(),
+    }
+
+
+def add_family(user_id, stories=3, archived_story=False):
+    conversation_ids = [add_story(user_id) for _ in range(stories)]
+    if archived_story:
+        long_ago = datetime.utcnow() - timedelta(days=400)
+        conversation_ids.append(add_story(user_id, created_at=long_ago))
+    db.session.add(ChildAccount(username=f"{user_id}-kid", pin='1234', display_name='Kid', age=7,
+                                parent_uid=user_id))
+    db.session.flush()
+    for conversation_id in conversation_ids:
+        db.session.add(StoryAssignment(conversation_id=conversation_id, child_username=f"{user_id}-kid",
+                                       title='Pancakes'))
+    db.session.commit()
+    return conversation_ids
+
+
+def test_purge_deletes_dependents_first_in_bounded_batches(app):
+    with app.app_context():
+        add_family('purge-gone', archived_story=True)
+        add_family('purge-kept')
+        archive.archive_cold_conversations(older_than_days=30)
+        segments = {entry.segment for entry in ArchivedConversation.query.filter_by(user_id='purge-gone')}
+        assert segments
+        kept = rows_of('purge-kept')
+
+        now = datetime.utcnow()
+        Conversation.query.filter_by(user_id='purge-gone').update({'deleted_at': now})
+        ChildAccount.query.filter_by(parent_uid='purge-gone').update({'deleted_at': now})
+        db.session.commit()
+
+        batches = []
+        while True:
+            deleted = purge_batch(batch_size=2)
+            if not deleted:
+                break
+            batches.append(deleted)
+            assert deleted <= 2
+            # every batch leaves the tables consistent, as foreign keys would require
+            assert set(dangling_rows().values()) == {0}
+        assert len(batches) > 1
+
+        assert set(rows_of('purge-gone').values()) == {0}
+        assert not any(os.path.exists(archive._segment_path(segment)) for segment in segments)
+        assert rows_of('purge-kept') == kept
+
+
+def test_purge_leaves_live_rows_alone(app):
+    with app.app_context():
+        add_family('purge-live')
+        before = rows_of('purge-live')
+        while purge_batch(batch_size=50):
+            pass
+        assert rows_of('purge-live') == before
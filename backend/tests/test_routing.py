@@ -0,0 +1,89 @@
+import os
+import tempfile
+import pytest
+from flask import g, request
+from sqlalchemy import create_engine
+from cache import SqliteCacheBackend
+from db.db import db, Conversation
+from db.routing import ReplicaRouter, router
+from conftest import bearer
+
+
+@pytest.fixture
+def replica_engine():
+    path = os.path.join(tempfile.mkdtemp(prefix='wonder-words-replica-'), 'replica.db')
+    engine = create_engine(f"sqlite:///{path}")
+    db.metadata.create_all(engine)
+    return engine
+
+
+@pytest.fixture
+def replica_router(replica_engine):
+    replica_router = ReplicaRouter()
+    replica_router.replicas = [{'engine': replica_engine, 'healthy': True}]
+    return replica_router
+
+
+def read_only_request(app, uid):
+    context = app.test_request_context()
+    context.push()
+    g.db_read_only = True
+    request.firebase_user = {'localId': uid}
+    return context
+
+
+def test_reads_go_to_a_replica_without_a_recent_write(app, replica_router, replica_engine):
+    context = read_only_request(app, 'reader')
+    try:
+        assert replica_router.read_engine() is replica_engine
+    finally:
+        context.pop()
+
+
+def test_reads_stay_on_the_primary_after_a_write(app, replica_router):
+    context = read_only_request(app, 'writer')
+    try:
+        replica_router.record_write('writer')
+        assert replica_router.read_engine() is None
+    finally:
+        context.pop()
+
+
+def test_endpoints_that_write_always_use_the_primary(app, replica_router):
+    with app.test_request_context():
+        request.firebase_user = {'localId': 'reader'}
+        assert replica_router.read_engine() is None
+
+
+def test_write_markers_are_seen_by_other_workers(app, replica_engine):
+    store = SqliteCacheBackend(os.path.join(tempfile.mkdtemp(prefix='wonder-words-sticky-'), 'sticky.db'))
+    writer, reader = ReplicaRouter(), ReplicaRouter()
+    for worker in (writer, reader):
+        worker.replicas = [{'engine': replica_engine, 'healthy': True}]
+        worker.sticky_store = store
+    writer.record_write('parent-1')
+    context = read_only_request(app, 'parent-1')
+    try:
+        assert reader.read_engine() is None
+    finally:
+        context.pop()
+
+
+def test_read_your_writes_through_the_endpoints(app, client, replica_engine, firebase_token_for, monkeypatch):
+    token = firebase_token_for('routed-parent')
+    with app.app_context():
+        conversations = [Conversation(user_id='routed-parent') for _ in range(2)]
+        db.session.add_all(conversations)
+        db.session.commit()
+        deleted_id, kept_id = conversations[0].id, conversations[1].id
+    monkeypatch.setattr(router, 'replicas', [{'engine': replica_engine, 'healthy': True}])
+
+    # the empty replica answers while the parent hasn't written
+    response = client.get('/get_conversations', headers=bearer(token))
+    assert response.json['conversations'] == []
+
+    # after a write the parent reads the primary, which has the other conversation
+    response = client.delete(f'/delete_conversation?conversation_id={deleted_id}', headers=bearer(token))
+    assert response.status_code == 200
+    response = client.get('/get_conversations', headers=bearer(token))
+    assert [conversation['id'] for conversation in response.json['conversations']] == [kept_id]
@@ -0,0 +1,39 @@
+from datetime import datetime, timedelta
+from db.db import db, SearchTerm
+from db.archive import archive_cold_conversations, is_archived
+from db.search import reindex_all, search_stories
+from conftest import add_story
+
+
+def test_reindex_keeps_archived_stories_searchable(app):
+    with app.app_context():
+        archived_id = add_story('reindex-parent', created_at=datetime.utcnow() - timedelta(days=400))
+        hot_id = add_story('reindex-parent', title='Rocket Night', story='A rocket zoomed past the moon.')
+        # postings written before search_term.message_id existed
+        SearchTerm.query.filter_by(user_id='reindex-parent').update({'message_id': None})
+        db.session.commit()
+        archive_cold_conversations(older_than_days=30)
+        assert is_archived(archived_id) and not is_archived(hot_id)
+        assert [result['conversation_id'] for result in search_stories('reindex-parent', 'pancake')] == [archived_id]
+
+        reindex_all(batch_size=1)
+
+        results = search_stories('reindex-parent', 'pancake')
+        assert [result['conversation_id'] for result in results] == [archived_id]
+        assert 'pancake' in results[0]['snippet'] and results[0]['title'] == 'Pancake Morning'
+        assert [result['conversation_id'] for result in search_stories('reindex-parent', 'rocket')] == [hot_id]
+        assert SearchTerm.query.filter_by(user_id='reindex-parent', message_id=None).count() == 0
+
+
+def test_reindex_is_idempotent(app):
+    with app.app_context():
+        add_story('reindex-twice')
+        db.session.commit()
+
+        def postings():
+            return sorted((posting.term, posting.weight, posting.message_id) for posting in
+                          SearchTerm.query.filter_by(user_id='reindex-twice'))
+        before = postings()
+        reindex_all()
+        reindex_all()
+        assert postings() == before
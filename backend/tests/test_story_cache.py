@@ -0,0 +1,73 @@
+from sqlalchemy import event
+from child_auth import generate_child_token
+from db.db import db, ChildAccount, GenerationCache, Message, SenderType, StoryContent
+from db import story_cache
+from llm import llm
+from conftest import add_story, bearer
+
+
+def story_messages(conversation_ids):
+    return Message.query.filter(Message.conversation_id.in_(conversation_ids),
+                                Message.sender_type == SenderType.MODEL).all()
+
+
+def test_a_cached_story_keeps_one_content_row(app, client, fake_openai, firebase_token_for, monkeypatch):
+    monkeypatch.setattr(story_cache, 'STORY_CACHE', True)
+    monkeypatch.setattr(llm, 'STORY_CACHE', True)
+    fake_openai.title, fake_openai.story = 'Shared Kite', 'A kite nobody else had flown.'
+
+    responses = [client.post('/confirm_new_story', json={'query': 'a kite story', 'confirmation': 'y'},
+                             headers=bearer(firebase_token_for(uid))).get_json()
+                 for uid in ('cache-parent-1', 'cache-parent-2')]
+
+    assert fake_openai.calls['writer'] == 1
+    assert responses[0]['response'] == responses[1]['response'] == \
+        "TITLE: Shared Kite\n\n STORY, PART #1: A kite nobody else had flown."
+    with app.app_context():
+        messages = story_messages([response['conversation_id'] for response in responses])
+        content_ids = {message.content_id for message in messages}
+        assert len(messages) == 2 and len(content_ids) == 1 and None not in content_ids
+        entry = GenerationCache.query.filter_by(content_id=content_ids.pop()).one()
+        assert entry.reuse_count == 1
+        assert StoryContent.query.filter(StoryContent.body.contains('nobody else had flown')).count() == 1
+
+
+def test_assigned_stories_preview_in_one_query(app, client, firebase_token_for):
+    parent_token = firebase_token_for('preview-parent')
+    with app.app_context():
+        db.session.add(ChildAccount(username='preview-kid', pin='1234', display_name='Kid', age=7,
+                                    parent_uid='preview-parent'))
+        conversation_ids = [add_story('preview-parent', title=f'Story {n}', story=f'Story number {n}. ' * 20)
+                            for n in range(5)]
+        # stories kept in the shared content store read their preview from there
+        for message in story_messages(conversation_ids[1:]):
+            message.content_id = story_cache.store_content(message.content)
+            message.content = ''
+        db.session.commit()
+    child_token = generate_child_token('preview-kid', 'preview-parent', 'Kid', 7)
+
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    def assign_and_list(conversation_ids):
+        client.post('/assign_stories', headers=bearer(parent_token), json={'assignments': [
+            {'conversation_id': cid, 'child_username': 'preview-kid', 'title': 'Read me'}
+            for cid in conversation_ids]})
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                statements.clear()
+                stories = client.get('/get_assigned_stories', headers=bearer(child_token)).get_json()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+        return stories['assigned_stories'], len(statements)
+
+    stories, one_story_queries = assign_and_list(conversation_ids[:1])
+    assert len(stories) == 1
+    stories, five_story_queries = assign_and_list(conversation_ids[1:])
+    assert len(stories) == 5
+    assert five_story_queries == one_story_queries
+    assert {story['preview'] for story in stories} == {
+        f"TITLE: Story {n}\n\n STORY, PART #1: {f'Story number {n}. ' * 20}"[:100] + '...' for n in range(5)}
@@ -0,0 +1,164 @@
+import json
+from datetime import datetime
+import pytest
+from sqlalchemy import event
+from child_auth import generate_child_token
+from db.db import db, ChildAccount, StoryAssignment
+import sync_child_accounts
+from sync_child_accounts import apply_sync, plan_sync
+from conftest import add_story, bearer
+
+
+def firebase_user(username, changed_at=None, local_id=None, display_name='Kid', **claims):
+    user = {'localId': local_id or f"uid-{username}", 'displayName': display_name}
+    if changed_at is not None:
+        user['lastLoginAt'] = str(int(changed_at.timestamp() * 1000))
+    custom = {'accountType': 'child', 'username': username, 'pin': '1234', 'age': 7, 'parentUid': 'sync-parent'}
+    custom.update(claims)
+    user['customAttributes'] = json.dumps({key: value for key, value in custom.items() if value is not None})
+    return user
+
+
+def account(username, parent_uid='sync-parent', **fields):
+    values = {'pin': '1234', 'display_name': 'Kid', 'age': 7}
+    values.update(fields)
+    return ChildAccount(username=username, parent_uid=parent_uid, **values)
+
+
+def test_plan_skips_users_unchanged_since_the_watermark(app):
+    since = datetime(2025, 1, 1)
+    users = [
+        firebase_user('sync-old', changed_at=datetime(2024, 12, 1)),
+        firebase_user('sync-at-mark', changed_at=since),
+        firebase_user('sync-new', changed_at=datetime(2025, 2, 1)),
+        firebase_user('sync-newest', changed_at=datetime(2025, 3, 1)),
+        # users without timestamps are always diffed
+        firebase_user('sync-no-stamp'),
+    ]
+    with app.app_context():
+        inserts, updates, skips, watermark = plan_sync(users, since)
+        assert [row['username'] for row in inserts] == ['sync-new', 'sync-newest', 'sync-no-stamp']
+        assert watermark == datetime(2025, 3, 1)
+
+        # without a watermark every user is diffed
+        inserts, _, _, watermark = plan_sync(users)
+        assert len(inserts) == 5 and watermark == datetime(2025, 3, 1)
+
+        # nothing changed since the last run: the watermark stays
+        _, _, _, watermark = plan_sync(users[:2], since)
+        assert watermark == since
+
+
+def test_plan_diffs_against_the_table(app):
+    with app.app_context():
+        db.session.add_all([
+            account('plan-same'),
+            account('plan-new-pin'),
+            account('plan-moved'),
+            account('plan-deleted', deleted_at=datetime.utcnow()),
+        ])
+        db.session.commit()
+        ids = {row.username: row.id for row in ChildAccount.query.filter(ChildAccount.username.like('plan-%'))}
+
+        users = [
+            {'localId': 'uid-parent', 'customAttributes': json.dumps({'accountType': 'parent'})},
+            firebase_user('plan-same'),
+            firebase_user('plan-new-pin', pin=9999),
+            firebase_user('plan-moved', parentUid='sync-other-parent'),
+            firebase_user('plan-deleted', pin='5555'),
+            firebase_user('plan-fresh'),
+            firebase_user('plan-fresh', local_id='uid-copy'),
+            firebase_user(None, local_id='uid-nameless'),
+            firebase_user('plan-no-pin', pin=None),
+            firebase_user('plan-bad-age', age='seven'),
+        ]
+        inserts, updates, skips, _ = plan_sync(users)
+
+    assert [row['username'] for row in inserts] == ['plan-fresh']
+    assert sorted(updates, key=lambda row: row['username']) == [
+        {'username': 'plan-moved', 'pin': '1234', 'display_name': 'Kid', 'age': 7,
+         'parent_uid': 'sync-other-parent', 'id': ids['plan-moved']},
+        {'username': 'plan-new-pin', 'pin': '9999', 'display_name': 'Kid', 'age': 7,
+         'parent_uid': 'sync-parent', 'id': ids['plan-new-pin']},
+    ]
+    assert sorted(skips) == sorted([
+        ('plan-fresh', 'duplicate username in Firebase'),
+        ('uid-nameless', 'no username'),
+        ('plan-no-pin', 'missing required fields'),
+        ('plan-bad-age', 'invalid age'),
+        ('plan-deleted', 'deleted in the backend'),
+        ('plan-same', 'unchanged'),
+    ])
+
+
+@pytest.fixture
+def invalidated(monkeypatch):
+    """
+    The parents whose cached reads each applied chunk invalidated
+    """
+    chunks = []
+    monkeypatch.setattr(sync_child_accounts, '_invalidate', lambda parent_uids: chunks.append(set(parent_uids)))
+    return chunks
+
+
+def test_apply_writes_in_chunks(app, monkeypatch, invalidated):
+    monkeypatch.setattr(sync_child_accounts, 'SYNC_CHUNK_SIZE', 2)
+    with app.app_context():
+        db.session.add_all([account(f'chunk-old-{n}', parent_uid=f'chunk-parent-{n}') for n in range(3)])
+        db.session.commit()
+        existing = ChildAccount.query.filter(ChildAccount.username.like('chunk-old-%')) \
+            .order_by(ChildAccount.username).all()
+        inserts = [{'username': f'chunk-new-{n}', 'pin': '1234', 'display_name': 'Kid', 'age': 7,
+                    'parent_uid': 'chunk-parent-new'} for n in range(5)]
+        # the first child moves to another parent; the others get a new PIN
+        updates = [{'id': child.id, 'username': child.username, 'pin': '4321', 'display_name': 'Kid', 'age': 7,
+                    'parent_uid': 'chunk-parent-moved' if n == 0 else child.parent_uid}
+                   for n, child in enumerate(existing)]
+
+        commits = []
+
+        def count(connection):
+            commits.append(connection)
+        event.listen(db.engine, 'commit', count)
+        try:
+            assert apply_sync(inserts, updates) == (5, 3)
+        finally:
+            event.remove(db.engine, 'commit', count)
+
+        assert len(commits) == 5
+        assert ChildAccount.query.filter(ChildAccount.username.like('chunk-new-%')).count() == 5
+        assert {child.pin for child in ChildAccount.query.filter(ChildAccount.username.like('chunk-old-%'))} == {'4321'}
+        assert db.session.get(ChildAccount, existing[0].id).parent_uid == 'chunk-parent-moved'
+
+    assert invalidated == [
+        {'chunk-parent-new'}, {'chunk-parent-new'}, {'chunk-parent-new'},
+        {'chunk-parent-0', 'chunk-parent-moved', 'chunk-parent-1'}, {'chunk-parent-2'},
+    ]
+
+
+def test_apply_drops_the_children_cached_reads(app, client, firebase_token_for):
+    parent_token = firebase_token_for('sync-cached-parent')
+    with app.app_context():
+        db.session.add(account('sync-cached-kid', parent_uid='sync-cached-parent'))
+        conversation_id = add_story('sync-cached-parent')
+        db.session.add(StoryAssignment(conversation_id=conversation_id, child_username='sync-cached-kid',
+                                       title='Read me'))
+        db.session.commit()
+        child_id = ChildAccount.query.filter_by(username='sync-cached-kid').one().id
+    child_token = generate_child_token('sync-cached-kid', 'sync-cached-parent', 'Kid', 7)
+
+    def cached_reads():
+        children = client.post('/get_child_accounts', json={'parent_uid': 'sync-cached-parent'},
+                               headers=bearer(parent_token)).get_json()['child_accounts']
+        stories = client.get('/get_assigned_stories', headers=bearer(child_token)).get_json()['assigned_stories']
+        return [child['display_name'] for child in children], [story['title'] for story in stories]
+    assert cached_reads() == (['Kid'], ['Read me'])
+
+    with app.app_context():
+        # an assignment renamed behind the app's back is only seen once the child's list is dropped
+        StoryAssignment.query.filter_by(child_username='sync-cached-kid').update({'title': 'Read me now'})
+        db.session.commit()
+        assert cached_reads() == (['Kid'], ['Read me'])
+        apply_sync([], [{'id': child_id, 'username': 'sync-cached-kid', 'pin': '1234',
+                         'display_name': 'Kiddo', 'age': 8, 'parent_uid': 'sync-cached-parent'}])
+    assert cached_reads() == (['Kiddo'], ['Read me now'])
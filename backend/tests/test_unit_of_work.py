@@ -0,0 +1,90 @@
+import pytest
+from sqlalchemy import event, text
+from db.db import db, Message, SenderType
+from conftest import add_story, bearer
+
+# The analytics tables are created outside the app's migrations (see db/process_model_data.py)
+ANALYTICS_TABLES = [
+    "CREATE TABLE IF NOT EXISTS prompt_data (features TEXT, vocabulary TEXT, user_prompt TEXT, model_response TEXT)",
+    "CREATE TABLE IF NOT EXISTS meta_prompt_data (user_meta_prompt TEXT, prompt_vocabulary TEXT, "
+    "prompt_narratives TEXT, model_meta_response TEXT, model_meta_vocabulary TEXT, model_meta_narratives TEXT)",
+]
+
+
+@pytest.fixture
+def analytics_rows(app):
+    with app.app_context():
+        for statement in ANALYTICS_TABLES:
+            db.session.execute(text(statement))
+        db.session.commit()
+
+    def count():
+        with app.app_context():
+            return tuple(db.session.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar()
+                         for table in ('prompt_data', 'meta_prompt_data'))
+    return count
+
+
+@pytest.fixture
+def commits(app, fake_openai):
+    """
+    The LLM calls made so far at each database commit of the test's requests
+    """
+    made = []
+
+    def record(connection):
+        made.append(dict(fake_openai.calls))
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'commit', record)
+    yield made
+    event.remove(engine, 'commit', record)
+
+
+def test_new_story_commits_before_and_after_the_llm(app, client, fake_openai, firebase_token_for,
+                                                     analytics_rows, commits):
+    token = firebase_token_for('uow-parent')
+    before = analytics_rows()
+    body = client.post('/confirm_new_story', json={'query': 'a kite story', 'confirmation': 'y'},
+                       headers=bearer(token)).get_json()
+
+    # the conversation and prompt before any LLM call; the story, its analytics and the
+    # version bump once they are done
+    assert len(commits) == 2
+    assert commits[0] == {}
+    assert commits[1]['writer'] == 1
+    assert analytics_rows() == (before[0] + 1, before[1] + 1)
+    with app.app_context():
+        messages = Message.query.filter_by(conversation_id=body['conversation_id']).order_by(Message.id).all()
+        assert [message.sender_type for message in messages] == [SenderType.USER, SenderType.MODEL]
+
+
+def test_continuation_commits_twice(app, client, fake_openai, firebase_token_for, analytics_rows, commits):
+    token = firebase_token_for('uow-continue')
+    with app.app_context():
+        conversation_id = add_story('uow-continue')
+        db.session.commit()
+    commits.clear()
+    before = analytics_rows()
+    fake_openai.code = '3'
+    client.post('/handle_request', json={'query': 'What happens next?', 'conversation_id': conversation_id},
+                headers=bearer(token))
+
+    assert len(commits) == 2
+    assert 'writer' not in commits[0] and commits[1]['writer'] == 1
+    assert analytics_rows() == (before[0] + 1, before[1] + 1)
+
+
+def test_refusal_commits_once(client, fake_openai, firebase_token_for, commits):
+    fake_openai.code = '0'
+    body = client.post('/handle_request', json={'query': 'something scary'},
+                       headers=bearer(firebase_token_for('uow-refused'))).get_json()
+    assert body['response'].startswith("Sorry")
+    assert len(commits) == 1
+
+
+def test_writes_deferred_without_a_unit_of_work_commit_at_the_end(client, fake_openai, analytics_rows, commits):
+    before = analytics_rows()
+    client.post('/generate_meta_prompt', json={'user_input': 'a kite story'})
+    assert len(commits) == 1
+    assert analytics_rows() == (before[0], before[1] + 1)